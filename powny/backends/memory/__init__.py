@@ -0,0 +1,101 @@
+import os
+import sys
+import tempfile
+import subprocess
+import contextlib
+import time
+
+from contextlog import get_logger
+
+from ...core import optconf
+
+from . import storage
+from . import ifaces
+
+
+class Backend:
+    """
+        Memory backend keeps all data in the storage server process on the local host
+        (see powny.backends.memory.storage). The server is started by the first backend if it's
+        not running, or it can be started manually: python -m powny.backends.memory --address ...
+        The data is lost when the server is stopped. The server listens only on the UNIX socket
+        which is available to its owner: the storage is single-host.
+    """
+
+    def __init__(self, address=os.path.join(tempfile.gettempdir(), "powny-memory.sock"), authkey="powny",
+                 start_server=True, start_timeout=10):
+        self._address = address
+        self._authkey = authkey
+        self._start_server = start_server
+        self._start_timeout = start_timeout
+        self.storage = None
+        self.session_id = None
+        self.jobs_control = ifaces.JobsControl(self)  # Interface for API
+        self.jobs_process = ifaces.JobsProcess(self)  # Interface for Worker
+        self.jobs_gc = ifaces.JobsGc(self)  # Interface for Collector
+        self.rules = ifaces.Rules(self)  # API and internal interface to control the rules
+        self.system_apps_state = ifaces.AppsState(self)  # API and internal interface to the system statistics
+        self.cas_storage = ifaces.CasStorage(self)  # Basic CAS storage for user scripts
+
+    @classmethod
+    def get_options(cls):
+        return {
+            "address": optconf.Option(default=os.path.join(tempfile.gettempdir(), "powny-memory.sock"),
+                                      help="The UNIX socket path of the storage server (single-host)"),
+            "authkey": optconf.Option(default="powny", help="The authentication key of the storage server"),
+            "start_server": optconf.Option(default=True, help="Start the storage server if it is not running"),
+            "start_timeout": optconf.Option(default=10, help="Timeout for the connection to the server (seconds)"),
+        }
+
+    # ===
+
+    @contextlib.contextmanager
+    def connected(self):
+        self.open()
+        try:
+            yield self
+        finally:
+            self.close()
+
+    def open(self):
+        assert self.storage is None, "Can't open() the opened backend"
+        deadline = time.time() + self._start_timeout
+        started = False
+        while True:
+            try:
+                self.storage = storage.connect(self._address, self._authkey.encode())
+                break
+            except OSError:
+                if time.time() >= deadline:
+                    raise
+                if self._start_server and not started:
+                    self._run_server()
+                    started = True
+                time.sleep(0.1)
+        self.session_id = self.storage.open_session(os.getpid())
+
+    def close(self):
+        assert self.storage is not None, "Can't close() not opened backend"
+        try:
+            self.storage.close_session(self.session_id)
+        finally:
+            self.storage = None
+            self.session_id = None
+
+    def is_connected(self):
+        return (self.storage is not None)
+
+    # ===
+
+    def get_info(self):
+        info = self.storage.get_info()
+        info["address"] = self._address
+        return info
+
+    def _run_server(self):
+        get_logger().info("Starting the memory storage server on %s", self._address)
+        subprocess.Popen(
+            [sys.executable, "-m", "powny.backends.memory", "--address", self._address, "--authkey", self._authkey],
+            stdin=subprocess.DEVNULL,
+            start_new_session=True,  # Survives this process
+        )
@@ -0,0 +1,206 @@
+import os
+import time
+
+from contextlog import get_logger
+
+from ...core.backends import (
+    DeleteTimeoutError,
+    make_job_id,
+    CasNoValue,
+    CasVersionError,
+)
+from ...core.tools import (
+    make_isotime,
+    get_node_name,
+)
+
+
+# =====
+def _make_lock_info(label):
+    return {
+        "from":     label,
+        "when":     make_isotime(),
+        "instance": {
+            "node": get_node_name(),
+            "pid": os.getpid(),
+        },
+    }
+
+
+# =====
+class _Iface:
+    def __init__(self, session):
+        self._session = session  # Backend: storage proxy and session_id
+
+
+class JobsControl(_Iface):
+    """
+        Interface to managing the jobs (add, delete, get metadata).
+        Needs for powny.core.apps.api.
+    """
+
+    def get_jobs_list(self):
+        return self._session.storage.get_jobs_list()
+
+    def get_input_size(self):
+        return self._session.storage.get_input_size()
+
+    def get_jobs_count(self):
+        return self._session.storage.get_jobs_count()
+
+    def get_request_count(self):
+        return self._session.storage.get_request_count()
+
+    def add_jobs(self, head, jobs):
+        jobs = [job._replace(job_id=make_job_id()) for job in jobs]
+        self._session.storage.add_jobs(head, jobs)
+        return [job.job_id for job in jobs]
+
+    def delete_job(self, job_id, timeout=None):
+        logger = get_logger(job_id=job_id)
+        logger.info("Deleting job")
+        deleted = self._session.storage.delete_job(job_id, timeout)
+        if deleted is None:
+            msg = "The job was not removed, try again"
+            logger.error(msg)
+            raise DeleteTimeoutError(msg)
+        if deleted:
+            logger.info("Deleted job")
+        return deleted
+
+    def get_job_info(self, job_id):
+        return self._session.storage.get_job_info(job_id)
+
+
+class JobsProcess(_Iface):
+    """
+        Interface to processing the jobs.
+        Needs for powny.core.apps.worker.
+    """
+
+    def get_ready_jobs(self, timeout=None):
+        deadline = (time.time() + timeout if timeout is not None else None)
+        while True:
+            remaining = (max(deadline - time.time(), 0) if deadline is not None else None)
+            job = self._session.storage.take_job(self._session.session_id, _make_lock_info("get_ready_jobs()"),
+                                                 remaining)
+            if job is None:
+                break
+            yield job
+            if timeout is not None:
+                deadline = time.time() + timeout
+
+    def associate_job(self, job_id):
+        self._session.storage.lock_job(job_id, self._session.session_id, _make_lock_info("associate_job()"))
+
+    def release_job(self, job_id):
+        self._session.storage.release_job(job_id)
+
+    def is_deleted_job(self, job_id):
+        return self._session.storage.is_deleted_job(job_id)
+
+    def watch_input(self, callback):  # pylint: disable=unused-argument
+        return False  # There are no watches, the worker polls the queue
+
+    def watch_deleted_job(self, job_id, callback):  # pylint: disable=unused-argument
+        return False
+
+    def unwatch_deleted_job(self, job_id):
+        pass
+
+    def save_job_state(self, job_id, state, stack):
+        self._session.storage.save_job_state(job_id, state, stack)
+
+    def done_job(self, job_id, retval, exc, lifetime=None):
+        self._session.storage.done_job(job_id, retval, exc, lifetime)
+
+
+class JobsGc(_Iface):
+    """
+        Interface for garbage collector.
+        Needs for powny.core.apps.collector.
+    """
+
+    def get_jobs(self, done_lifetime, full=False):  # pylint: disable=unused-argument
+        # All jobs are in the memory, so there is no difference for the full scan
+        yield from self._session.storage.lock_gc_jobs(
+            self._session.session_id,
+            _make_lock_info("get_unfinished_jobs()"),
+            done_lifetime,
+        )
+
+    def wait_deleted(self, timeout):
+        time.sleep(timeout)  # There are no watches, the collector polls the jobs
+        return False
+
+    def push_back_job(self, job_id):
+        self._session.storage.push_back_job(job_id)
+
+    def remove_job_data(self, job_id):
+        self._session.storage.remove_job_data(job_id)
+
+    def remove_jobs_data(self, job_ids):
+        self._session.storage.remove_jobs_data(list(job_ids))
+
+
+class Rules(_Iface):
+    """
+        Interface to managing the rules HEAD.
+    """
+
+    def set_head(self, head):
+        self._session.storage.set_head(head)
+
+    def get_head(self):
+        return self._session.storage.get_head()
+
+
+class AppsState(_Iface):
+    """
+        Interface to the system statistics about the internal processes
+        (like the worker and collector).
+    """
+
+    def set_state(self, app_name, app_state):
+        self._session.storage.set_app_state(self._session.session_id, app_name, get_node_name(), {
+            "when": make_isotime(),
+            "pid": os.getpid(),
+            "state": app_state,
+        })
+
+    def get_full_state(self):
+        return self._session.storage.get_full_state()
+
+
+class CasStorage(_Iface):
+    """
+        Interface to abstract CAS storage for user scripts.
+    """
+
+    def set_value(self, path, value, version=None):
+        try:
+            self.replace_value(path, value=value, version=version, default=None)
+            return True
+        except CasVersionError:
+            get_logger().exception("Can't set '%s' value with version %s", path, version)
+            return False
+
+    def get_value(self, path, default=CasNoValue):
+        return self.replace_value(path, value=CasNoValue, default=default)[0]
+
+    def replace_value(self, path, value=CasNoValue, version=None, default=CasNoValue, fatal_write=True):
+        return self._session.storage.replace_cas_values([(path, value, version)], default, fatal_write)[0]
+
+    def get_many(self, paths, default=CasNoValue):
+        items = [(path, CasNoValue, None) for path in paths]
+        return [old for (old, _) in self._session.storage.replace_cas_values(items, default, True)]
+
+    def set_many(self, values):
+        return {
+            path: write_ok
+            for (path, (_, write_ok)) in self.replace_many(values, default=None, fatal_write=False).items()
+        }
+
+    def replace_many(self, values, default=CasNoValue, fatal_write=True):
+        items = [(path, value, version) for (path, (value, version)) in values.items()]
+        return dict(zip(values, self._session.storage.replace_cas_values(items, default, fatal_write)))
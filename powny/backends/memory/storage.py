@@ -0,0 +1,377 @@
+import os
+import argparse
+import threading
+import collections
+import time
+import uuid
+import multiprocessing.managers
+
+from contextlog import get_logger
+
+from ...core.backends import (
+    JobState,
+    CasNoValueError,
+    CasVersionError,
+    CasNoValue,
+    CasData,
+)
+from ...core.tools import (
+    make_isotime,
+    from_isotime,
+)
+
+
+# =====
+def check_address(address):
+    # Only the path of the UNIX socket: the manager protocol is pickle and the sessions
+    # are checked by the local pids, so the storage must not be reachable from another host.
+    if ":" in address and not address.startswith("/"):
+        raise RuntimeError("The memory storage supports only the UNIX socket, not {!r}".format(address))
+    return address
+
+
+class _Manager(multiprocessing.managers.BaseManager):
+    pass
+
+
+_Manager.register("get_storage")
+
+
+def connect(address, authkey):
+    manager = _Manager(check_address(address), authkey)
+    manager.connect()
+    return manager.get_storage()  # pylint: disable=no-member
+
+
+def serve(address, authkey):
+    storage = Storage()
+    _Manager.register("get_storage", callable=lambda: storage)
+    old_umask = os.umask(0o077)  # Only the owner of the server can connect to the socket
+    try:
+        server = _Manager(check_address(address), authkey).get_server()
+    finally:
+        os.umask(old_umask)
+    get_logger().info("Serving the memory storage on %s", address)
+    server.serve_forever()
+
+
+def main():
+    args_parser = argparse.ArgumentParser(prog="powny.backends.memory", description="Powny memory storage server")
+    args_parser.add_argument("--address", required=True)
+    args_parser.add_argument("--authkey", required=True)
+    options = args_parser.parse_args()
+    address = check_address(options.address)
+    if os.path.exists(address):
+        try:
+            connect(options.address, options.authkey.encode())
+            return 0  # Another server is already running
+        except OSError:
+            os.remove(address)  # Stale socket
+    try:
+        serve(options.address, options.authkey.encode())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+# =====
+class Storage:
+    """
+        The shared state of the memory backend, it lives in the server process and it's available
+        through the proxy of the multiprocessing manager. All operations are atomic under the one lock.
+        The locks and the application states belong to the sessions (one per opened backend),
+        the session is closed explicitly or when its process is dead (so only one host is supported).
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._sessions = {}  # session_id -> pid
+        self._jobs = collections.OrderedDict()
+        self._input = collections.OrderedDict()  # job_id -> None, ordered by the time of the queueing
+        self._request_counter = 0
+        self._head = None
+        self._apps_state = {}  # (app_name, node_name) -> (session_id, state)
+        self._cas = {}
+
+    # ===
+
+    def open_session(self, pid):
+        with self._cond:
+            for session_id in list(self._sessions):
+                if not self._is_alive(session_id):
+                    self._close_session(session_id)
+            session_id = str(uuid.uuid4())
+            self._sessions[session_id] = pid
+            return session_id
+
+    def close_session(self, session_id):
+        with self._cond:
+            self._close_session(session_id)
+
+    def get_info(self):
+        with self._cond:
+            return {
+                "pid": os.getpid(),
+                "sessions": len(self._sessions),
+                "jobs": len(self._jobs),
+                "input": len(self._input),
+            }
+
+    # ===
+
+    def get_jobs_list(self):
+        with self._cond:
+            return list(self._jobs)
+
+    def get_input_size(self):
+        with self._cond:
+            return len(self._input)
+
+    def get_jobs_count(self):
+        with self._cond:
+            return len(self._jobs)
+
+    def get_request_count(self):
+        with self._cond:
+            return self._request_counter
+
+    def add_jobs(self, head, jobs):
+        with self._cond:
+            request_number = self._request_counter
+            self._request_counter += 1
+            now = make_isotime()
+            for job in jobs:
+                get_logger().info("Registering job", job_id=job.job_id, request_number=request_number,
+                                  head=head, method=job.method_name, kwargs=job.kwargs)
+                self._jobs[job.job_id] = {
+                    "info": {
+                        "head": head,
+                        "method": job.method_name,
+                        "kwargs": job.kwargs,
+                        "created": now,
+                        "request": request_number,
+                    },
+                    "state": {
+                        "state": job.state,
+                        "stack": None,
+                        "finished": None,
+                        "retval": None,
+                        "exc": None,
+                    },
+                    "lock": None,  # (session_id, lock_info)
+                    "taken": None,
+                    "deleted": None,
+                    "lifetime": None,  # The own lifetime of the finished job
+                }
+                self._input[job.job_id] = None
+            self._cond.notify_all()
+
+    def delete_job(self, job_id, timeout=None):
+        # Returns None on timeout
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return False
+            if job["deleted"] is None:
+                job["deleted"] = make_isotime()
+            self._cond.notify_all()
+            if not self._cond.wait_for((lambda: job_id not in self._jobs), timeout):
+                return None
+            return True
+
+    def get_job_info(self, job_id):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            job_info = dict(job["info"])
+            job_info["deleted"] = job["deleted"]
+            job_info["locked"] = self._get_lock_info(job)
+            job_info["taken"] = job["taken"]
+            state_info = dict(job["state"])
+            state_info.pop("state")
+            job_info["finished"] = state_info.pop("finished")
+            job_info.update(state_info)
+            return job_info
+
+    # ===
+
+    def take_job(self, session_id, lock_info, timeout=None):
+        # Returns JobState or None if the queue is empty for timeout seconds
+        with self._cond:
+            if timeout is not None:
+                self._cond.wait_for((lambda: len(self._input) > 0), timeout)
+            if len(self._input) == 0:
+                return None
+            (job_id, _) = self._input.popitem(last=False)
+            job = self._jobs[job_id]
+            job["lock"] = (session_id, lock_info)
+            job["taken"] = make_isotime()
+            return JobState(
+                head=job["info"]["head"],
+                method_name=job["info"]["method"],
+                kwargs=job["info"]["kwargs"],
+                state=job["state"]["state"],
+                job_id=job_id,
+                request=job["info"]["request"],
+            )
+
+    def lock_job(self, job_id, session_id, lock_info):
+        with self._cond:
+            self._jobs[job_id]["lock"] = (session_id, lock_info)
+
+    def release_job(self, job_id):
+        with self._cond:
+            self._jobs[job_id]["lock"] = None
+
+    def is_deleted_job(self, job_id):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            return (job is not None and job["deleted"] is not None)
+
+    def save_job_state(self, job_id, state, stack):
+        with self._cond:
+            self._jobs[job_id]["state"] = {
+                "state":    state,
+                "stack":    stack,
+                "finished": None,
+                "retval":   None,
+                "exc":      None,
+            }
+
+    def done_job(self, job_id, retval, exc, lifetime=None):
+        with self._cond:
+            job = self._jobs[job_id]
+            job["lifetime"] = lifetime
+            job["state"] = {
+                "state":    None,
+                "stack":    None,
+                "finished": make_isotime(),
+                "retval":   retval,
+                "exc":      exc,
+            }
+            job["lock"] = None
+
+    # ===
+
+    def lock_gc_jobs(self, session_id, lock_info, done_lifetime):
+        # Returns the list of (job_id, done) for the locked jobs
+        with self._cond:
+            result = []
+            for (job_id, job) in self._jobs.items():
+                to_delete = (job["deleted"] is not None)
+                if (to_delete or job["taken"] is not None) and self._get_lock_info(job) is None:
+                    finished = job["state"]["finished"]
+                    lifetime = (done_lifetime if job["lifetime"] is None else job["lifetime"])
+                    if to_delete or finished is None or from_isotime(finished) + lifetime <= time.time():
+                        job["lock"] = (session_id, lock_info)
+                        result.append((job_id, to_delete or finished is not None))
+            return result
+
+    def push_back_job(self, job_id):
+        with self._cond:
+            job = self._jobs[job_id]
+            job["taken"] = None
+            job["lock"] = None
+            self._input[job_id] = None
+            self._cond.notify_all()
+
+    def remove_job_data(self, job_id):
+        self.remove_jobs_data([job_id])
+
+    def remove_jobs_data(self, job_ids):
+        with self._cond:
+            for job_id in job_ids:
+                self._jobs.pop(job_id, None)
+                self._input.pop(job_id, None)
+            self._cond.notify_all()
+
+    # ===
+
+    def set_head(self, head):
+        with self._cond:
+            self._head = head
+
+    def get_head(self):
+        with self._cond:
+            return self._head
+
+    def set_app_state(self, session_id, app_name, node_name, state):
+        with self._cond:
+            self._apps_state[(app_name, node_name)] = (session_id, state)
+
+    def get_full_state(self):
+        with self._cond:
+            full_state = {}
+            for ((app_name, node_name), (session_id, state)) in self._apps_state.items():
+                if self._is_alive(session_id):
+                    full_state.setdefault(app_name, {})
+                    full_state[app_name][node_name] = state
+            return full_state
+
+    # ===
+
+    def replace_cas_values(self, items, default, fatal_write):
+        # items -- [(path, value, version), ...], see CasStorage.replace_value()
+        with self._cond:
+            results = []
+            writes = []
+            for (path, value, version) in items:
+                old = self._cas.get(path)
+                if old is None:
+                    if default is CasNoValue:
+                        raise CasNoValueError()
+                    old = CasData(value=default, version=None, stored=None)
+                else:
+                    old = CasData(value=old["value"], version=old["version"], stored=from_isotime(old["stored"]))
+
+                if value is CasNoValue:
+                    write_ok = None
+                elif version is not None and old.version is not None and version <= old.version:
+                    msg = "Can't rewrite '{}' with version {} (old version: {})".format(path, version, old.version)
+                    if fatal_write:
+                        raise CasVersionError(msg)
+                    get_logger().debug(msg)
+                    write_ok = False
+                else:
+                    writes.append((path, {
+                        "value":   value,
+                        "version": version,
+                        "stored":  make_isotime(),
+                    }))
+                    write_ok = True
+                results.append((old, write_ok))
+            self._cas.update(writes)
+            return results
+
+    # ===
+
+    def _is_alive(self, session_id):
+        pid = self._sessions.get(session_id)
+        if pid is None:
+            return False
+        try:
+            os.kill(pid, 0)
+            return True
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+
+    def _close_session(self, session_id):
+        self._sessions.pop(session_id, None)
+        for job in self._jobs.values():
+            if job["lock"] is not None and job["lock"][0] == session_id:
+                job["lock"] = None
+        for (key, (owner, _)) in list(self._apps_state.items()):
+            if owner == session_id:
+                self._apps_state.pop(key)
+
+    def _get_lock_info(self, job):
+        if job["lock"] is None:
+            return None
+        (session_id, lock_info) = job["lock"]
+        if not self._is_alive(session_id):
+            job["lock"] = None  # Like the ephemeral node
+            return None
+        return lock_info
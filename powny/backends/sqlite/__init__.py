@@ -0,0 +1,64 @@
+import contextlib
+
+from ...core import optconf
+
+from . import db
+from . import ifaces
+
+
+class Backend:
+    """
+        SQLite backend keeps all data in the single database file in the WAL mode, it's durable,
+        but it works only on one host (the processes must share the local file system).
+    """
+
+    def __init__(self, path="powny.sqlite3", timeout=10, synchronous="normal", poll_interval=0.1, save_interval=0):
+        self._db = db.Database(path, timeout, synchronous)
+        self.jobs_control = ifaces.JobsControl(self._db, poll_interval)  # Interface for API
+        self.jobs_process = ifaces.JobsProcess(self._db, poll_interval, save_interval)  # Interface for Worker
+        self.jobs_gc = ifaces.JobsGc(self._db)  # Interface for Collector
+        self.rules = ifaces.Rules(self._db)  # API and internal interface to control the rules
+        self.system_apps_state = ifaces.AppsState(self._db)  # API and internal interface to the system statistics
+        self.cas_storage = ifaces.CasStorage(self._db)  # Basic CAS storage for user scripts
+
+    @classmethod
+    def get_options(cls):
+        return {
+            "path": optconf.Option(default="powny.sqlite3", help="Path to the database file"),
+            "timeout": optconf.Option(default=10.0, help="Timeout for the database locks (seconds)"),
+            "synchronous": optconf.Option(default="normal", help="PRAGMA synchronous: normal (fsync only on the "
+                                                                 "WAL checkpoints, the last commits can be lost "
+                                                                 "on the power failure) or full"),
+            "poll_interval": optconf.Option(default=0.1, help="Interval of the checks for the changes while "
+                                                              "waiting for the jobs (seconds)"),
+            "save_interval": optconf.Option(default=0.0, help="Minimal interval between the writes of the job "
+                                                              "state, the intermediate states are coalesced "
+                                                              "(seconds, 0 - write each state)"),
+        }
+
+    # ===
+
+    @contextlib.contextmanager
+    def connected(self):
+        self.open()
+        try:
+            yield self
+        finally:
+            self.close()
+
+    def open(self):
+        self._db.open()
+
+    def close(self):
+        try:
+            self.jobs_process.flush()
+        finally:
+            self._db.close()
+
+    def is_connected(self):
+        return self._db.is_opened()
+
+    # ===
+
+    def get_info(self):
+        return self._db.get_info()
@@ -0,0 +1,182 @@
+import os
+import sqlite3
+import pickle
+import threading
+import contextlib
+import uuid
+
+from contextlog import get_logger
+
+
+# =====
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        job_id      TEXT PRIMARY KEY,
+        head        TEXT NOT NULL,
+        method      TEXT NOT NULL,
+        kwargs      BLOB NOT NULL,
+        created     TEXT NOT NULL,
+        request     INTEGER NOT NULL,
+        queued      INTEGER,  -- The position in the input queue, NULL if the job is not in the queue
+        taken       TEXT,
+        deleted     TEXT,
+        lock_owner  TEXT,  -- session_id
+        lock_info   BLOB,
+        state       BLOB,
+        stack       BLOB,
+        finished    TEXT,
+        finished_at REAL,  -- The same as finished, but in the unix time for the index
+        expires_at  REAL,  -- The expiration time of the finished job with the own lifetime
+        retval      BLOB,
+        exc         TEXT
+    );
+    CREATE INDEX IF NOT EXISTS jobs_queued ON jobs (queued) WHERE queued IS NOT NULL;
+    CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished_at) WHERE finished_at IS NOT NULL AND expires_at IS NULL;
+    CREATE INDEX IF NOT EXISTS jobs_expires ON jobs (expires_at) WHERE expires_at IS NOT NULL;
+    CREATE INDEX IF NOT EXISTS jobs_running ON jobs (taken) WHERE taken IS NOT NULL AND finished_at IS NULL;
+    CREATE INDEX IF NOT EXISTS jobs_deleted ON jobs (deleted) WHERE deleted IS NOT NULL;
+    CREATE INDEX IF NOT EXISTS jobs_lock_owner ON jobs (lock_owner) WHERE lock_owner IS NOT NULL;
+
+    CREATE TABLE IF NOT EXISTS sessions (
+        session_id  TEXT PRIMARY KEY,
+        pid         INTEGER NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS apps_state (
+        app_name    TEXT NOT NULL,
+        node_name   TEXT NOT NULL,
+        session_id  TEXT NOT NULL,
+        state       BLOB NOT NULL,
+        PRIMARY KEY (app_name, node_name)
+    );
+
+    CREATE TABLE IF NOT EXISTS cas (
+        path        TEXT PRIMARY KEY,
+        value       BLOB,
+        version     BLOB,
+        stored      TEXT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS meta (
+        key         TEXT PRIMARY KEY,
+        value       BLOB
+    );
+"""
+
+HAS_RETURNING = (sqlite3.sqlite_version_info >= (3, 35, 0))
+
+
+def dumps(value):
+    return (None if value is None else pickle.dumps(value))
+
+
+def loads(value):
+    return (None if value is None else pickle.loads(value))
+
+
+# =====
+class Database:
+    """
+        The connection to the SQLite database in the WAL mode. The locks and the application states
+        belong to the sessions (one per opened backend), the session is dropped when it's closed or
+        when its process is dead (like the ephemeral nodes in ZooKeeper, but only for one host).
+    """
+
+    def __init__(self, path, timeout, synchronous):
+        self._path = path
+        self._timeout = timeout
+        self._synchronous = synchronous
+        self._conn = None
+        self._lock = threading.RLock()
+        self._commits = 0
+        self.session_id = None
+
+    def open(self):
+        assert self._conn is None, "Can't open() the opened database"
+        self._conn = sqlite3.connect(
+            self._path,
+            timeout=self._timeout,
+            isolation_level=None,  # Explicit transactions by transaction()
+            check_same_thread=False,
+        )
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = {}".format(self._synchronous.upper()))
+        self._conn.executescript(_SCHEMA)
+        self.session_id = str(uuid.uuid4())
+        with self.transaction() as cursor:
+            for (session_id, pid) in cursor.execute("SELECT session_id, pid FROM sessions").fetchall():
+                if not is_alive(pid):
+                    drop_session(cursor, session_id)
+            cursor.execute("INSERT INTO sessions (session_id, pid) VALUES (?, ?)", (self.session_id, os.getpid()))
+        get_logger().debug("Opened SQLite database %s", self._path)
+
+    def close(self):
+        assert self._conn is not None, "Can't close() not opened database"
+        try:
+            with self.transaction() as cursor:
+                drop_session(cursor, self.session_id)
+        finally:
+            self._conn.close()
+            self._conn = None
+            self.session_id = None
+
+    def is_opened(self):
+        return (self._conn is not None)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock at the beginning, so there are no deadlocks
+        # on the upgrade of the read transaction.
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                yield cursor
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+            self._commits += 1
+
+    @contextlib.contextmanager
+    def reading(self):
+        with self._lock:
+            yield self._conn.cursor()
+
+    def get_data_version(self):
+        # The data_version is changed after the commits of the other connections, it's cheap to poll it
+        with self.reading() as cursor:
+            return (cursor.execute("PRAGMA data_version").fetchone()[0], self._commits)
+
+    def get_info(self):
+        with self.reading() as cursor:
+            return {
+                "path": self._path,
+                "sqlite_version": sqlite3.sqlite_version,
+                "journal_mode": cursor.execute("PRAGMA journal_mode").fetchone()[0],
+                "sessions": cursor.execute("SELECT COUNT(*) FROM sessions").fetchone()[0],
+                "jobs": cursor.execute("SELECT COUNT(*) FROM jobs").fetchone()[0],
+            }
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def is_alive_session(cursor, session_id):
+    if session_id is None:
+        return False
+    row = cursor.execute("SELECT pid FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+    return (row is not None and is_alive(row[0]))
+
+
+def drop_session(cursor, session_id):
+    cursor.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+    cursor.execute("UPDATE jobs SET lock_owner = NULL, lock_info = NULL WHERE lock_owner = ?", (session_id,))
+    cursor.execute("DELETE FROM apps_state WHERE session_id = ?", (session_id,))
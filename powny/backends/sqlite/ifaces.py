@@ -0,0 +1,464 @@
+import os
+import time
+
+from contextlog import get_logger
+
+from ...core.backends import (
+    DeleteTimeoutError,
+    JobState,
+    make_job_id,
+    CasNoValueError,
+    CasVersionError,
+    CasNoValue,
+    CasData,
+)
+from ...core.tools import (
+    make_isotime,
+    from_isotime,
+    get_node_name,
+)
+
+from . import db
+
+
+# =====
+def _make_lock_info(label):
+    return {
+        "from":     label,
+        "when":     make_isotime(),
+        "instance": {
+            "node": get_node_name(),
+            "pid": os.getpid(),
+        },
+    }
+
+
+# The deleted, finished, expired and running jobs. Each part is selected by its own partial index
+# and repeats the condition of the index: SQLite doesn't use the indexes for the OR of these conditions
+# and scans the whole table. UNION removes the duplicates (the deleted job can be running).
+_GC_QUERY = " UNION ".join([
+    "SELECT job_id, lock_owner, deleted, finished FROM jobs WHERE {}".format(where)
+    for where in (
+        "deleted IS NOT NULL",
+        "finished_at <= ? AND finished_at IS NOT NULL AND expires_at IS NULL",
+        "expires_at <= ? AND expires_at IS NOT NULL",
+        "taken IS NOT NULL AND finished_at IS NULL",
+    )
+])
+
+
+def _get_next_queued(cursor):
+    return cursor.execute("SELECT IFNULL(MAX(queued), 0) + 1 FROM jobs WHERE queued IS NOT NULL").fetchone()[0]
+
+
+def _get_meta(cursor, key, default=None):
+    row = cursor.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return (default if row is None else db.loads(row[0]))
+
+
+def _set_meta(cursor, key, value):
+    cursor.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, db.dumps(value)))
+
+
+def _wait_change(database, check, timeout, poll_interval):
+    # Polls the data version of the database and calls check() after the changes
+    deadline = (None if timeout is None else time.time() + timeout)
+    version = database.get_data_version()
+    while True:
+        if deadline is not None and time.time() >= deadline:
+            return False
+        time.sleep(poll_interval if deadline is None else min(poll_interval, max(deadline - time.time(), 0)))
+        new_version = database.get_data_version()
+        if new_version != version:
+            version = new_version
+            if check():
+                return True
+
+
+# =====
+class JobsControl:
+    """
+        Interface to managing the jobs (add, delete, get metadata).
+        Needs for powny.core.apps.api.
+    """
+
+    def __init__(self, database, poll_interval):
+        self._db = database
+        self._poll_interval = poll_interval
+
+    def get_jobs_list(self):
+        with self._db.reading() as cursor:
+            return [row[0] for row in cursor.execute("SELECT job_id FROM jobs")]
+
+    def get_input_size(self):
+        with self._db.reading() as cursor:
+            return cursor.execute("SELECT COUNT(*) FROM jobs WHERE queued IS NOT NULL").fetchone()[0]
+
+    def get_jobs_count(self):
+        with self._db.reading() as cursor:
+            return cursor.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def get_request_count(self):
+        with self._db.reading() as cursor:
+            return _get_meta(cursor, "request_counter", 0)
+
+    def add_jobs(self, head, jobs):
+        now = make_isotime()
+        added_ids = []
+        with self._db.transaction() as cursor:
+            request_number = _get_meta(cursor, "request_counter", 0)
+            _set_meta(cursor, "request_counter", request_number + 1)
+            queued = _get_next_queued(cursor)
+            for job in jobs:
+                job_id = make_job_id()
+                get_logger().info("Registering job", job_id=job_id, request_number=request_number,
+                                  head=head, method=job.method_name, kwargs=job.kwargs)
+                cursor.execute(
+                    "INSERT INTO jobs (job_id, head, method, kwargs, created, request, queued, state)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, head, job.method_name, db.dumps(job.kwargs), now, request_number, queued,
+                     db.dumps(job.state)),
+                )
+                queued += 1
+                added_ids.append(job_id)
+        return added_ids
+
+    def delete_job(self, job_id, timeout=None):
+        logger = get_logger(job_id=job_id)
+        logger.info("Deleting job")
+        with self._db.transaction() as cursor:
+            cursor.execute("UPDATE jobs SET deleted = IFNULL(deleted, ?) WHERE job_id = ?", (make_isotime(), job_id))
+            if cursor.rowcount == 0:
+                return False
+        if not self._is_removed(job_id) and not _wait_change(self._db, (lambda: self._is_removed(job_id)),
+                                                             timeout, self._poll_interval):
+            msg = "The job was not removed, try again"
+            logger.error(msg)
+            raise DeleteTimeoutError(msg)
+        logger.info("Deleted job")
+        return True
+
+    def _is_removed(self, job_id):
+        with self._db.reading() as cursor:
+            return (cursor.execute("SELECT 1 FROM jobs WHERE job_id = ?", (job_id,)).fetchone() is None)
+
+    def get_job_info(self, job_id):
+        with self._db.reading() as cursor:
+            row = cursor.execute(
+                "SELECT head, method, kwargs, created, request, deleted, lock_owner, lock_info, taken,"
+                " finished, stack, retval, exc FROM jobs WHERE job_id = ?",
+                (job_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            (head, method, kwargs, created, request, deleted, lock_owner, lock_info, taken,
+             finished, stack, retval, exc) = row
+            locked = (db.loads(lock_info) if db.is_alive_session(cursor, lock_owner) else None)
+        return {
+            "head":     head,
+            "method":   method,
+            "kwargs":   db.loads(kwargs),
+            "created":  created,
+            "request":  request,
+            "deleted":  deleted,
+            "locked":   locked,
+            "taken":    taken,
+            "finished": finished,
+            "stack":    db.loads(stack),
+            "retval":   db.loads(retval),
+            "exc":      exc,
+        }
+
+
+class JobsProcess:
+    """
+        Interface to processing the jobs.
+        Needs for powny.core.apps.worker.
+    """
+
+    def __init__(self, database, poll_interval, save_interval):
+        self._db = database
+        self._poll_interval = poll_interval
+        self._save_interval = save_interval
+        self._saved = {}  # job_id -> time of the last write
+        self._pending = {}  # job_id -> (state, stack)
+
+    def get_ready_jobs(self, timeout=None):
+        """
+            Takes the jobs from the input queue. If timeout is not None, the iterator is blocked when
+            the queue is empty, and waits for the new jobs up to timeout seconds before the stop.
+        """
+
+        while True:
+            job = self._claim_job()
+            if job is None:
+                if timeout is None or not _wait_change(self._db, self._has_input, timeout, self._poll_interval):
+                    break
+            else:
+                yield job
+
+    def _has_input(self):
+        with self._db.reading() as cursor:
+            return (cursor.execute("SELECT 1 FROM jobs WHERE queued IS NOT NULL LIMIT 1").fetchone() is not None)
+
+    def _claim_job(self):
+        params = (make_isotime(), self._db.session_id, db.dumps(_make_lock_info("get_ready_jobs()")))
+        with self._db.transaction() as cursor:
+            if db.HAS_RETURNING:
+                rows = cursor.execute(
+                    "UPDATE jobs SET queued = NULL, taken = ?, lock_owner = ?, lock_info = ?"
+                    " WHERE job_id = (SELECT job_id FROM jobs WHERE queued IS NOT NULL ORDER BY queued LIMIT 1)"
+                    " RETURNING job_id, head, method, kwargs, state, request",
+                    params,
+                ).fetchall()  # The statement must be completed before the commit
+                row = (rows[0] if len(rows) > 0 else None)
+            else:
+                row = cursor.execute(
+                    "SELECT job_id, head, method, kwargs, state, request FROM jobs"
+                    " WHERE queued IS NOT NULL ORDER BY queued LIMIT 1",
+                ).fetchone()
+                if row is not None:
+                    cursor.execute(
+                        "UPDATE jobs SET queued = NULL, taken = ?, lock_owner = ?, lock_info = ? WHERE job_id = ?",
+                        params + (row[0],),
+                    )
+        if row is None:
+            return None
+        (job_id, head, method, kwargs, state, request) = row
+        return JobState(
+            head=head,
+            method_name=method,
+            kwargs=db.loads(kwargs),
+            state=db.loads(state),
+            job_id=job_id,
+            request=request,
+        )
+
+    def associate_job(self, job_id):
+        with self._db.transaction() as cursor:
+            cursor.execute(
+                "UPDATE jobs SET lock_owner = ?, lock_info = ? WHERE job_id = ?",
+                (self._db.session_id, db.dumps(_make_lock_info("associate_job()")), job_id),
+            )
+
+    def release_job(self, job_id):
+        with self._db.transaction() as cursor:
+            cursor.execute("UPDATE jobs SET lock_owner = NULL, lock_info = NULL WHERE job_id = ?", (job_id,))
+
+    def is_deleted_job(self, job_id):
+        with self._db.reading() as cursor:
+            return (cursor.execute(
+                "SELECT 1 FROM jobs WHERE job_id = ? AND deleted IS NOT NULL",
+                (job_id,),
+            ).fetchone() is not None)
+
+    def watch_input(self, callback):  # pylint: disable=unused-argument
+        return False  # There are no watches, the worker polls the queue
+
+    def watch_deleted_job(self, job_id, callback):  # pylint: disable=unused-argument
+        return False
+
+    def unwatch_deleted_job(self, job_id):
+        pass
+
+    def save_job_state(self, job_id, state, stack):
+        # With save_interval, the frequent checkpoints are coalesced: the last one is written
+        # on the next save after the interval, on done_job() or on close().
+        if time.time() - self._saved.get(job_id, 0) < self._save_interval:
+            self._pending[job_id] = (state, stack)
+            return
+        self._pending.pop(job_id, None)
+        self._write_state(job_id, state, stack)
+        self._saved[job_id] = time.time()
+
+    def flush(self):
+        for (job_id, (state, stack)) in list(self._pending.items()):
+            self._write_state(job_id, state, stack)
+            self._pending.pop(job_id)
+
+    def _write_state(self, job_id, state, stack):
+        with self._db.transaction() as cursor:
+            cursor.execute(
+                "UPDATE jobs SET state = ?, stack = ?, finished = NULL, finished_at = NULL, expires_at = NULL,"
+                " retval = NULL, exc = NULL WHERE job_id = ?",
+                (db.dumps(state), db.dumps(stack), job_id),
+            )
+
+    def done_job(self, job_id, retval, exc, lifetime=None):
+        self._pending.pop(job_id, None)
+        self._saved.pop(job_id, None)
+        now = time.time()
+        with self._db.transaction() as cursor:
+            cursor.execute(
+                "UPDATE jobs SET state = NULL, stack = NULL, finished = ?, finished_at = ?, expires_at = ?,"
+                " retval = ?, exc = ?, lock_owner = NULL, lock_info = NULL WHERE job_id = ?",
+                (make_isotime(now), now, (None if lifetime is None else now + lifetime), db.dumps(retval), exc, job_id),
+            )
+
+
+class JobsGc:
+    """
+        Interface for garbage collector.
+        Needs for powny.core.apps.collector.
+    """
+
+    def __init__(self, database):
+        self._db = database
+
+    def get_jobs(self, done_lifetime, full=False):  # pylint: disable=unused-argument
+        # The index mode: the jobs are selected by the partial indexes (see _GC_QUERY). SQLite keeps
+        # the indexes consistent with the table, so the full scan is the same.
+        with self._db.reading() as cursor:
+            alive = {
+                session_id
+                for (session_id, pid) in cursor.execute("SELECT session_id, pid FROM sessions").fetchall()
+                if db.is_alive(pid)
+            }
+            now = time.time()
+            rows = cursor.execute(_GC_QUERY, (now - done_lifetime, now)).fetchall()
+        for (job_id, lock_owner, deleted, finished) in rows:
+            if lock_owner in alive:
+                continue
+            with self._db.transaction() as cursor:
+                cursor.execute(
+                    "UPDATE jobs SET lock_owner = ?, lock_info = ? WHERE job_id = ? AND lock_owner IS ?",
+                    (self._db.session_id, db.dumps(_make_lock_info("get_unfinished_jobs()")), job_id, lock_owner),
+                )
+                if cursor.rowcount == 0:
+                    continue
+            yield (job_id, (deleted is not None or finished is not None))  # (id, done)
+
+    def wait_deleted(self, timeout):
+        time.sleep(timeout)  # There are no watches, the collector polls the jobs
+        return False
+
+    def push_back_job(self, job_id):
+        with self._db.transaction() as cursor:
+            cursor.execute(
+                "UPDATE jobs SET taken = NULL, lock_owner = NULL, lock_info = NULL, queued = ? WHERE job_id = ?",
+                (_get_next_queued(cursor), job_id),
+            )
+
+    def remove_job_data(self, job_id):
+        self.remove_jobs_data([job_id])
+
+    def remove_jobs_data(self, job_ids):
+        with self._db.transaction() as cursor:
+            cursor.executemany("DELETE FROM jobs WHERE job_id = ?", [(job_id,) for job_id in job_ids])
+
+
+class Rules:
+    """
+        Interface to managing the rules HEAD.
+    """
+
+    def __init__(self, database):
+        self._db = database
+
+    def set_head(self, head):
+        with self._db.transaction() as cursor:
+            _set_meta(cursor, "head", head)
+
+    def get_head(self):
+        with self._db.reading() as cursor:
+            return _get_meta(cursor, "head")
+
+
+class AppsState:
+    """
+        Interface to the system statistics about the internal processes
+        (like the worker and collector).
+    """
+
+    def __init__(self, database):
+        self._db = database
+
+    def set_state(self, app_name, app_state):
+        state = {
+            "when": make_isotime(),
+            "pid": os.getpid(),
+            "state": app_state,
+        }
+        with self._db.transaction() as cursor:
+            cursor.execute(
+                "INSERT OR REPLACE INTO apps_state (app_name, node_name, session_id, state) VALUES (?, ?, ?, ?)",
+                (app_name, get_node_name(), self._db.session_id, db.dumps(state)),
+            )
+
+    def get_full_state(self):
+        full_state = {}
+        with self._db.reading() as cursor:
+            rows = cursor.execute(
+                "SELECT app_name, node_name, pid, state FROM apps_state"
+                " JOIN sessions ON apps_state.session_id = sessions.session_id",
+            ).fetchall()
+        for (app_name, node_name, pid, state) in rows:
+            if db.is_alive(pid):
+                full_state.setdefault(app_name, {})
+                full_state[app_name][node_name] = db.loads(state)
+        return full_state
+
+
+class CasStorage:
+    """
+        Interface to abstract CAS storage for user scripts.
+    """
+
+    def __init__(self, database):
+        self._db = database
+
+    def set_value(self, path, value, version=None):
+        try:
+            self.replace_value(path, value=value, version=version, default=None)
+            return True
+        except CasVersionError:
+            get_logger().exception("Can't set '%s' value with version %s", path, version)
+            return False
+
+    def get_value(self, path, default=CasNoValue):
+        return self.replace_value(path, value=CasNoValue, default=default)[0]
+
+    def replace_value(self, path, value=CasNoValue, version=None, default=CasNoValue, fatal_write=True):
+        return self._replace([(path, value, version)], default, fatal_write)[0]
+
+    def get_many(self, paths, default=CasNoValue):
+        return [old for (old, _) in self._replace([(path, CasNoValue, None) for path in paths], default, True)]
+
+    def set_many(self, values):
+        return {
+            path: write_ok
+            for (path, (_, write_ok)) in self.replace_many(values, default=None, fatal_write=False).items()
+        }
+
+    def replace_many(self, values, default=CasNoValue, fatal_write=True):
+        items = [(path, value, version) for (path, (value, version)) in values.items()]
+        return dict(zip(values, self._replace(items, default, fatal_write)))
+
+    def _replace(self, items, default, fatal_write):
+        results = []
+        with self._db.transaction() as cursor:
+            for (path, value, version) in items:
+                row = cursor.execute("SELECT value, version, stored FROM cas WHERE path = ?", (path,)).fetchone()
+                if row is None:
+                    if default is CasNoValue:
+                        raise CasNoValueError()
+                    old = CasData(value=default, version=None, stored=None)
+                else:
+                    old = CasData(value=db.loads(row[0]), version=db.loads(row[1]), stored=from_isotime(row[2]))
+
+                if value is CasNoValue:
+                    write_ok = None
+                elif version is not None and old.version is not None and version <= old.version:
+                    msg = "Can't rewrite '{}' with version {} (old version: {})".format(path, version, old.version)
+                    if fatal_write:
+                        raise CasVersionError(msg)
+                    get_logger().debug(msg)
+                    write_ok = False
+                else:
+                    cursor.execute(
+                        "INSERT OR REPLACE INTO cas (path, value, version, stored) VALUES (?, ?, ?, ?)",
+                        (path, db.dumps(value), db.dumps(version), make_isotime()),
+                    )
+                    write_ok = True
+                results.append((old, write_ok))
+        return results
@@ -1,5 +1,6 @@
 import contextlib
 
+from ...core import optconf
 
 from . import zoo
 from . import ifaces
@@ -12,18 +13,65 @@ class Backend:
         any operation.
     """
 
-    def __init__(self, **zoo_kwargs):
+    def __init__(self, input_partitions=1, preferred_partitions=(), claim_batch=10,
+                 blob_store="none", blob_dir=None, blob_threshold=524288, blob_chunk_size=262144,
+                 request_counter_reserve=1, cas_cache=False, job_info_cache_size=0, job_info_cache_bytes=67108864,
+                 rules_head_cache=True, gc_sharding=True, **zoo_kwargs):
         self._client = zoo.Client(**zoo_kwargs)
-        self.jobs_control = ifaces.JobsControl(self._client)  # Interface for API
-        self.jobs_process = ifaces.JobsProcess(self._client)  # Interface for Worker
-        self.jobs_gc = ifaces.JobsGc(self._client)  # Interface for Collector
-        self.rules = ifaces.Rules(self._client)  # API and internal interface to control the rules
+        self._input_partitions = input_partitions
+        offloader = ifaces.make_offloader(self._client, blob_store, blob_dir, blob_threshold, blob_chunk_size)
+        self.jobs_control = ifaces.JobsControl(  # Interface for API
+            client=self._client,
+            input_partitions=input_partitions,
+            offloader=offloader,
+            request_counter_reserve=request_counter_reserve,
+            info_cache_size=job_info_cache_size,
+            info_cache_bytes=job_info_cache_bytes,
+        )
+        self.jobs_process = ifaces.JobsProcess(  # Interface for Worker
+            client=self._client,
+            input_partitions=input_partitions,
+            preferred_partitions=preferred_partitions,
+            claim_batch=claim_batch,
+            offloader=offloader,
+        )
+        self.jobs_gc = ifaces.JobsGc(self._client, input_partitions, offloader, gc_sharding)  # Interface for Collector
+        self.rules = ifaces.Rules(self._client, rules_head_cache)  # API and internal interface to control the rules
         self.system_apps_state = ifaces.AppsState(self._client)  # API and internal interface to the system statistics
-        self.cas_storage = ifaces.CasStorage(self._client)  # Basic CAS storage for user scripts
+        self.cas_storage = ifaces.CasStorage(self._client, cas_cache)  # Basic CAS storage for user scripts
 
     @classmethod
     def get_options(cls):
-        return zoo.Client.get_options()
+        options = zoo.Client.get_options()
+        options.update({
+            "input_partitions": optconf.Option(default=1, help="The number of the input queue partitions "
+                                                               "(must be the same for all nodes)"),
+            "preferred_partitions": optconf.Option(default=[], help="The partitions that are checked by the worker "
+                                                                    "before the others (by default, it's chosen "
+                                                                    "by the node name)"),
+            "claim_batch": optconf.Option(default=10, help="The maximum number of the jobs claimed by the worker "
+                                                           "from the input queue in one round"),
+            "blob_store": optconf.Option(default="none", help="Where to store the large job states and results: "
+                                                              "none (inline), fs (blob_dir on the shared mount) "
+                                                              "or znode (chunked nodes)"),
+            "blob_dir": optconf.Option(default=None, type=str, help="Directory for the fs blob store"),
+            "blob_threshold": optconf.Option(default=524288, help="Minimal size of the offloaded value (in bytes)"),
+            "blob_chunk_size": optconf.Option(default=262144, help="Chunk size for the znode blob store (in bytes)"),
+            "request_counter_reserve": optconf.Option(default=1, help="The number of the request numbers reserved "
+                                                                      "by the API process at once (the numbers from "
+                                                                      "the different processes will be unordered)"),
+            "cas_cache": optconf.Option(default=False, help="Cache the values of the CAS storage in the process "
+                                                            "(invalidated by the watches)"),
+            "job_info_cache_size": optconf.Option(default=0, help="The maximum number of the job infos cached "
+                                                                  "by the API process (0=disabled)"),
+            "job_info_cache_bytes": optconf.Option(default=67108864, help="The maximum size of the cached "
+                                                                          "job infos (in bytes, 0=unlimited)"),
+            "rules_head_cache": optconf.Option(default=True, help="Cache the rules HEAD in the process "
+                                                                  "(invalidated by the watch)"),
+            "gc_sharding": optconf.Option(default=True, help="Share the jobs between the running collectors "
+                                                             "by the consistent hashing of the job ids"),
+        })
+        return options
 
     # ===
 
@@ -37,7 +85,7 @@ class Backend:
 
     def open(self):
         self._client.open()
-        ifaces.init(self._client)
+        ifaces.init(self._client, self._input_partitions)
 
     def close(self):
         self._client.close()
@@ -48,4 +96,6 @@ class Backend:
     # ===
 
     def get_info(self):
-        return self._client.get_server_info()
+        info = self._client.get_server_info()
+        info["stats"] = self._client.get_stats()
+        return info
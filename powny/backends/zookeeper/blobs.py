@@ -0,0 +1,176 @@
+import os
+import shutil
+import tempfile
+import hashlib
+import pickle
+import collections
+
+from contextlog import get_logger
+
+from . import zoo
+
+
+# =====
+class BlobError(Exception):
+    pass
+
+
+BlobRef = collections.namedtuple("BlobRef", (
+    "digest",   # SHA-256 of the data
+    "size",
+    "pickled",  # The original value was not bytes and it was pickled
+))
+
+
+def _make_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+# =====
+class Offloader:
+    """
+        Replaces the large values by the references to the blob store. The blobs are grouped
+        by the namespaces (one namespace per job), so they can be removed with the job.
+        Without the store (store=None), the values are passed as is.
+    """
+
+    def __init__(self, store, threshold):
+        self._store = store
+        self._threshold = threshold
+
+    def pack(self, namespace, value):
+        if self._store is None or value is None:
+            return value
+        pickled = (not isinstance(value, bytes))
+        data = (pickle.dumps(value) if pickled else value)
+        if len(data) < self._threshold:
+            return value
+        digest = _make_digest(data)
+        self._store.put(namespace, digest, data)
+        get_logger().debug("Offloaded %d bytes to the blob %s", len(data), digest, namespace=namespace)
+        return BlobRef(digest=digest, size=len(data), pickled=pickled)
+
+    def unpack(self, namespace, value):
+        if not isinstance(value, BlobRef):
+            return value
+        if self._store is None:
+            raise BlobError("Can't read the blob {} without the blob store".format(value.digest))
+        data = self._store.get(namespace, value.digest)
+        if len(data) != value.size or _make_digest(data) != value.digest:
+            raise BlobError("The blob {} is corrupted".format(value.digest))
+        return (pickle.loads(data) if value.pickled else data)
+
+    def cleanup(self, namespace, keep=()):
+        """
+            Removes the blobs of the namespace, excluding the referenced by the values from keep
+            (the values which are not references are ignored).
+        """
+
+        if self._store is not None:
+            keep = [value.digest for value in keep if isinstance(value, BlobRef)]
+            self._store.remove(namespace, keep)
+
+
+# =====
+class FsStore:
+    """
+        Content-addressed blob store in the local directory or in the shared mount:
+            <root>/<namespace>/<digest>
+        The files are written through the temporary file and rename().
+    """
+
+    def __init__(self, root):
+        self._root = root
+
+    def put(self, namespace, digest, data):
+        path = os.path.join(self._root, namespace, digest)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as blob_file:
+                blob_file.write(data)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def get(self, namespace, digest):
+        try:
+            with open(os.path.join(self._root, namespace, digest), "rb") as blob_file:
+                return blob_file.read()
+        except FileNotFoundError:
+            raise BlobError("Can't find the blob {}".format(digest))
+
+    def remove(self, namespace, keep=()):
+        path = os.path.join(self._root, namespace)
+        if len(keep) == 0:
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            for name in os.listdir(path):
+                if name not in keep and not name.startswith(".tmp-"):
+                    try:
+                        os.remove(os.path.join(path, name))
+                    except FileNotFoundError:
+                        pass
+
+
+class ZnodeStore:
+    """
+        Blob store in the ZooKeeper: the data is splitted to the chunks smaller than the request limit.
+            <path>/<namespace>/<digest> -- the number of the chunks (empty while writing)
+            <path>/<namespace>/<digest>/<index> -- the chunks
+        Each chunk is written by a separate request, the number of the chunks is written last.
+    """
+
+    def __init__(self, client, path, chunk_size):
+        self._client = client
+        self._path = path
+        self._chunk_size = chunk_size
+
+    def put(self, namespace, digest, data):
+        path = zoo.join(self._path, namespace, digest)
+        if self._client.get(path, None) not in (None, zoo.EmptyValue):
+            return  # Already stored
+        try:
+            with self._client.make_write_request("blob_create()") as request:
+                request.create(path, recursive=True)
+        except zoo.NodeExistsError:
+            pass
+        chunks = [data[offset:offset + self._chunk_size] for offset in range(0, len(data), self._chunk_size)]
+        for (index, chunk) in enumerate(chunks):
+            try:
+                with self._client.make_write_request("blob_put_chunk()") as request:
+                    request.create(zoo.join(path, str(index)), chunk)
+            except zoo.NodeExistsError:
+                pass  # Another writer of the same content
+        with self._client.make_write_request("blob_commit()") as request:
+            request.set(path, len(chunks))
+
+    def get(self, namespace, digest):
+        path = zoo.join(self._path, namespace, digest)
+        count = self._client.get(path, None)
+        if count is None or count is zoo.EmptyValue:
+            raise BlobError("Can't find the blob {}".format(digest))
+        chunks = self._client.get_many([zoo.join(path, str(index)) for index in range(count)])
+        if zoo.MissingValue in chunks:
+            raise BlobError("Can't find some chunks of the blob {}".format(digest))
+        return b"".join(chunks)
+
+    def remove(self, namespace, keep=()):
+        path = zoo.join(self._path, namespace)
+        if len(keep) == 0:
+            paths = [path]
+        else:
+            try:
+                paths = [zoo.join(path, name) for name in self._client.get_children(path) if name not in keep]
+            except zoo.NoNodeError:
+                return
+        for item in paths:
+            try:
+                # The recursive removal works only for a single operation in the request
+                with self._client.make_write_request("blob_remove()") as request:
+                    request.delete(item, recursive=True)
+            except zoo.NoNodeError:
+                pass
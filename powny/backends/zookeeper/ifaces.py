@@ -1,11 +1,21 @@
 import os
+import posixpath
+import functools
+import bisect
+import hashlib
+import uuid
+import pickle
+import collections
 import threading
 import time
+import zlib
+import traceback
 
 from contextlog import get_logger
 
 from ...core.backends import (
     DeleteTimeoutError,
+    PartialAddError,
     JobState,
     make_job_id,
     CasNoValueError,
@@ -18,8 +28,10 @@ from ...core.tools import (
     from_isotime,
     get_node_name,
 )
+from ...core.checkpoints import IncrementalState
 
 from . import zoo
+from . import blobs
 
 
 # =====
@@ -28,9 +40,33 @@ _PATH_SYSTEM = "/system"
 _PATH_REQUEST_COUNTER = zoo.join(_PATH_SYSTEM, "request_counter")
 _PATH_RULES_HEAD = zoo.join(_PATH_SYSTEM, "rules_head")
 _PATH_APPS_STATE = zoo.join(_PATH_SYSTEM, "apps_state")
+_PATH_COLLECTORS = zoo.join(_PATH_SYSTEM, "collectors")
 _PATH_JOBS = "/jobs"
 _PATH_USER = "/user"
 _PATH_CAS_STORAGE = zoo.join(_PATH_USER, "cas_storage")
+_PATH_BLOBS = "/blobs"
+
+# The indexes for the collector: the finished jobs are bucketed by the finish time (with the default
+# lifetime) or by the expiration time (with the own lifetime of the job).
+_PATH_FINISHED = "/finished"
+_PATH_EXPIRES = "/expires"
+_PATH_RUNNING = "/running"
+_PATH_DELETED = "/deleted"
+_INDEX_BUCKET = 60  # Seconds
+
+_RING_POINTS = 64  # The number of the points of each collector on the hash ring
+
+
+def _get_path_input_queue(partition):
+    # The first partition is the old non-partitioned queue
+    if partition == 0:
+        return _PATH_INPUT_QUEUE
+    else:
+        return "{}_{}".format(_PATH_INPUT_QUEUE, partition)
+
+
+def _get_input_partition(job_id, partitions):
+    return zlib.crc32(job_id.encode()) % partitions
 
 
 def _get_path_job(job_id):
@@ -49,10 +85,27 @@ def _get_path_job_state(job_id):
     return zoo.join(_get_path_job(job_id), "state")
 
 
+def _get_path_job_base(job_id):
+    # The base of the incremental state (powny.core.checkpoints), it's rewritten only on the compaction
+    return zoo.join(_get_path_job(job_id), "base")
+
+
 def _get_path_job_delete(job_id):
     return zoo.join(_get_path_job(job_id), "delete")
 
 
+def _get_path_index_bucket(root, when):
+    return zoo.join(root, str(int(when // _INDEX_BUCKET)))
+
+
+def _get_path_running(job_id):
+    return zoo.join(_PATH_RUNNING, job_id)
+
+
+def _get_path_deleted(job_id):
+    return zoo.join(_PATH_DELETED, job_id)
+
+
 def _get_path_app_state(app_name, node_name):
     return zoo.join(_PATH_APPS_STATE, "{}@{}".format(app_name, node_name))
 
@@ -65,8 +118,16 @@ def _get_path_cas_storage(path):
     return zoo.join(_PATH_CAS_STORAGE, path)
 
 
-def _get_path_cas_storage_lock(path):
-    return zoo.join(_get_path_cas_storage(path), "__lock__")
+def make_offloader(client, store, blob_dir, threshold, chunk_size):
+    if store == "none":
+        return blobs.Offloader(None, threshold)
+    elif store == "fs":
+        assert blob_dir is not None, "Required the directory for the fs-store"
+        return blobs.Offloader(blobs.FsStore(blob_dir), threshold)
+    elif store == "znode":
+        return blobs.Offloader(blobs.ZnodeStore(client, _PATH_BLOBS, chunk_size), threshold)
+    else:
+        raise RuntimeError("Unknown blob store: {}".format(store))
 
 
 def _make_lock_info(label):
@@ -81,18 +142,23 @@ def _make_lock_info(label):
 
 
 # =====
-def init(client):
+def init(client, input_partitions=1):
     logger = get_logger()
-    for path in (
-        _PATH_INPUT_QUEUE,
+    for path in [_get_path_input_queue(partition) for partition in range(input_partitions)] + [
         _PATH_SYSTEM,
         _PATH_REQUEST_COUNTER,
         _PATH_RULES_HEAD,
         _PATH_APPS_STATE,
+        _PATH_COLLECTORS,
         _PATH_JOBS,
         _PATH_USER,
         _PATH_CAS_STORAGE,
-    ):
+        _PATH_BLOBS,
+        _PATH_FINISHED,
+        _PATH_EXPIRES,
+        _PATH_RUNNING,
+        _PATH_DELETED,
+    ]:
         try:
             with client.make_write_request("backend::init()::create({})".format(path)) as request:
                 request.create(path)
@@ -108,16 +174,31 @@ class JobsControl:
         Needs for powny.core.apps.api.
     """
 
-    def __init__(self, client):
+    def __init__(self, client, input_partitions=1, offloader=None, request_counter_reserve=1,
+                 info_cache_size=0, info_cache_bytes=0):
         self._client = client
-        self._input_queue = self._client.get_queue(_PATH_INPUT_QUEUE)
-        self._request_counter = self._client.get_counter(_PATH_REQUEST_COUNTER)
+        self._input_queues = [
+            self._client.get_queue(_get_path_input_queue(partition))
+            for partition in range(input_partitions)
+        ]
+        self._request_counter = self._client.get_counter(_PATH_REQUEST_COUNTER, request_counter_reserve)
+        self._offloader = (offloader or blobs.Offloader(None, 0))
+        self._info_cache = (_JobInfoCache(client, info_cache_size, info_cache_bytes) if info_cache_size > 0 else None)
+
+    def close(self):
+        for queue in self._input_queues:
+            queue.close()
+        if self._info_cache is not None:
+            self._info_cache.close()
 
     def get_jobs_list(self):
         return self._client.get_children(_PATH_JOBS)
 
     def get_input_size(self):
-        return len(self._input_queue)
+        return sum(self._client.get_children_counts([
+            _get_path_input_queue(partition)
+            for partition in range(len(self._input_queues))
+        ]))
 
     def get_jobs_count(self):
         return self._client.get_children_count(_PATH_JOBS)
@@ -126,38 +207,62 @@ class JobsControl:
         return self._request_counter.get()
 
     def add_jobs(self, head, jobs):
+        """
+            Registers the jobs and returns their ids. The jobs are added atomically if the request
+            is not larger than max_request_size, otherwise they are committed by the chunks of the whole
+            jobs. If some chunk fails, PartialAddError is raised and its added attribute contains
+            the ids of the jobs that have been registered (they are not rolled back). The offloaded
+            states of the jobs that have not been registered are removed.
+        """
+
         request_number = self._request_counter.increment()
         now = make_isotime()
         added_ids = []
-        with self._client.make_write_request("add_jobs()") as request:
-            for job in jobs:
-                job_id = make_job_id()
-                get_logger().info("Registering job", job_id=job_id, request_number=request_number,
-                                  head=head, method=job.method_name, kwargs=job.kwargs)
-                request.create(_get_path_job(job_id), {
-                    "head": head,
-                    "method": job.method_name,
-                    "kwargs": job.kwargs,
-                    "created": now,
-                    "request": request_number,
-                })
-                request.create(_get_path_job_state(job_id), {
-                    "state": job.state,
-                    "stack": None,
-                    "finished": None,
-                    "retval": None,
-                    "exc": None,
-                })
-                self._input_queue.put(request, job_id)
-                added_ids.append(job_id)
+        try:
+            with self._client.make_write_request("add_jobs()", splittable=True) as request:
+                for job in jobs:
+                    job_id = make_job_id()
+                    added_ids.append(job_id)  # Before the offloading, for the cleanup
+                    get_logger().info("Registering job", job_id=job_id, request_number=request_number,
+                                      head=head, method=job.method_name, kwargs=job.kwargs)
+                    request.create(_get_path_job(job_id), {
+                        "head": head,
+                        "method": job.method_name,
+                        "kwargs": job.kwargs,
+                        "created": now,
+                        "request": request_number,
+                    })
+                    request.create(_get_path_job_state(job_id), {
+                        "state": self._offloader.pack(job_id, job.state),
+                        "stack": None,
+                        "finished": None,
+                        "retval": None,
+                        "exc": None,
+                    })
+                    self._input_queues[_get_input_partition(job_id, len(self._input_queues))].put(request, job_id)
+                    request.mark_boundary(job_id)
+        except zoo.PartialWriteError as err:
+            self._remove_blobs([job_id for job_id in added_ids if job_id not in err.committed])
+            raise PartialAddError(str(err), err.committed) from err
+        except Exception:
+            self._remove_blobs(added_ids)
+            raise
         return added_ids
 
+    def _remove_blobs(self, job_ids):
+        for job_id in job_ids:
+            try:
+                self._offloader.cleanup(job_id)
+            except Exception:
+                get_logger(job_id=job_id).exception("Can't remove the blobs of the job that has not been added")
+
     def delete_job(self, job_id, timeout=None):
         logger = get_logger(job_id=job_id)
         logger.info("Deleting job")
         try:
             with self._client.make_write_request("delete_job()") as request:
                 request.create(_get_path_job_delete(job_id), make_isotime())
+                request.create(_get_path_deleted(job_id))
         except zoo.NodeExistsError:
             pass  # Lock on existent delete-op
         except zoo.NoNodeError:
@@ -173,21 +278,140 @@ class JobsControl:
         return True
 
     def get_job_info(self, job_id):
+        """
+            With the cache, the init info of the job is read once, and the whole info
+            of the finished job is not read again until the job is deleted or removed.
+        """
+
+        (cached, generation, watch) = (None, None, None)
+        if self._info_cache is not None:
+            (cached, generation) = self._info_cache.get(job_id)
+            if cached is not None and cached.final:
+                return dict(cached.job_info)
+            watch = self._info_cache.on_node_changed
+
+        results = [
+            self._client.get_async(path)
+            for path in (
+                _get_path_job_delete(job_id),
+                _get_path_job_lock(job_id),
+                _get_path_job_taken(job_id),
+                _get_path_job_state(job_id),
+            )
+        ]
+        if cached is None:
+            job_info = self._client.get_async(_get_path_job(job_id), watch).get(zoo.MissingValue)  # init info
+        else:
+            job_info = dict(cached.job_info)
+        (deleted, locked, taken, state_info) = [result.get(zoo.MissingValue) for result in results]
+        if zoo.MissingValue in (job_info, state_info):
+            return None
+        if self._info_cache is not None and cached is None:
+            self._info_cache.put(job_id, dict(job_info), False, generation)
+
+        job_info["deleted"] = (None if deleted is zoo.MissingValue else deleted)
+        job_info["locked"] = (None if locked is zoo.MissingValue else locked)
+        job_info["taken"] = (None if taken is zoo.MissingValue else taken)
+
+        state_info.pop("state", None)  # Remove state
+        state_info.pop("index", None)
+        job_info["finished"] = state_info.pop("finished")
         try:
-            job_info = self._client.get(_get_path_job(job_id))  # init info
+            state_info["retval"] = self._offloader.unpack(job_id, state_info["retval"])
+        except blobs.BlobError:
+            if not self._client.exists(_get_path_job(job_id)):
+                return None  # The blobs are removed with the job by the collector
+            raise  # The missing blob of the existing job is the error of the server, not a missing job
+        job_info.update(state_info)  # + stack OR retval OR exc
+
+        if (
+            self._info_cache is not None
+            and job_info["finished"] is not None
+            and deleted is zoo.MissingValue
+            and not self._client.exists(_get_path_job_delete(job_id), watch=watch)
+        ):
+            self._info_cache.put(job_id, dict(job_info), True, generation)
+        return job_info
+
+
+class _JobInfoCache:
+    """
+        LRU cache of the job infos in the API process, bounded by the number of the items and by
+        their pickled size. The item contains the init info of the job or the whole info of the finished
+        job (final). The watches on the job node and on the delete node evict the item when the job is
+        deleted or removed by the collector. The whole cache is dropped when the connection is suspended
+        or lost, because the watches may be missed. The info read during the eviction of its job is not
+        cached; the last evictions are remembered by the generations, so the reads of the other jobs
+        are not affected.
+    """
 
-            job_info["deleted"] = self._client.get(_get_path_job_delete(job_id), None)
-            job_info["locked"] = self._client.get(_get_path_job_lock(job_id), None)
-            job_info["taken"] = self._client.get(_get_path_job_taken(job_id), None)
+    _Item = collections.namedtuple("_Item", ("job_info", "final", "size"))
 
-            state_info = self._client.get(_get_path_job_state(job_id))
-            state_info.pop("state", None)  # Remove state
-            job_info["finished"] = state_info.pop("finished")
-            job_info.update(state_info)  # + stack OR retval OR exc
+    def __init__(self, client, max_size, max_bytes):
+        self._client = client
+        self._max_size = max_size
+        self._max_bytes = max_bytes
+        self._items = collections.OrderedDict()
+        self._bytes = 0
+        self._generation = 0  # Incremented by each eviction
+        self._evicted = collections.OrderedDict()  # job_id -> the generation of its last eviction
+        self._floor = 0  # The reads before it are stale: the cache was dropped or the evictions were forgotten
+        self._lock = threading.Lock()
+        self._client.add_listener(self._on_state_changed)
+
+    def close(self):
+        self._client.remove_listener(self._on_state_changed)
+
+    def get(self, job_id):
+        with self._lock:
+            item = self._items.get(job_id)
+            if item is not None:
+                self._items.move_to_end(job_id)
+            return (item, self._generation)
+
+    def put(self, job_id, job_info, final, generation):
+        size = len(pickle.dumps(job_info))
+        if self._max_bytes > 0 and size > self._max_bytes:
+            return
+        with self._lock:
+            if generation < self._floor or self._evicted.get(job_id, -1) > generation:
+                return  # Invalidated during the reading
+            self._pop(job_id)
+            self._items[job_id] = self._Item(job_info, final, size)
+            self._bytes += size
+            while len(self._items) > self._max_size or (self._max_bytes > 0 and self._bytes > self._max_bytes):
+                self._pop(next(iter(self._items)))
+
+    def evict(self, job_id=None):
+        with self._lock:
+            self._generation += 1
+            if job_id is None:
+                self._items.clear()
+                self._bytes = 0
+                self._evicted.clear()
+                self._floor = self._generation
+            else:
+                self._pop(job_id)
+                self._evicted.pop(job_id, None)
+                self._evicted[job_id] = self._generation
+                if len(self._evicted) > self._max_size:
+                    self._floor = self._evicted.popitem(last=False)[1]
 
-            return job_info
-        except zoo.NoNodeError:
-            return None
+    def __len__(self):
+        return len(self._items)
+
+    def on_node_changed(self, event):
+        # /jobs/<job_id> or /jobs/<job_id>/delete
+        self.evict(event.path[len(_PATH_JOBS) + 1:].split("/")[0])
+
+    def _pop(self, job_id):
+        item = self._items.pop(job_id, None)
+        if item is not None:
+            self._bytes -= item.size
+
+    def _on_state_changed(self, state):
+        if state != zoo.STATE_CONNECTED:
+            self.evict()
 
 
 class JobsProcess:
@@ -196,29 +420,191 @@ class JobsProcess:
         Needs for powny.core.apps.worker.
     """
 
-    def __init__(self, client):
+    def __init__(self, client, input_partitions=1, preferred_partitions=(), claim_batch=10, offloader=None):
         self._client = client
-        self._input_queue = self._client.get_queue(_PATH_INPUT_QUEUE)
-
-    def get_ready_jobs(self):
-        for job_id in self._input_queue:
-            job_info = self._client.get(_get_path_job(job_id))
-            exec_info = self._client.get(_get_path_job_state(job_id))
-
-            with self._client.make_write_request("get_ready_jobs()") as request:
-                lock = self._client.get_lock(_get_path_job_lock(job_id))
-                lock.acquire(request, _make_lock_info("get_ready_jobs()"))
-                request.create(_get_path_job_taken(job_id), make_isotime())
-                self._input_queue.consume(request)
-
-            yield JobState(
-                head=job_info["head"],
-                method_name=job_info["method"],
-                kwargs=job_info["kwargs"],
-                state=exec_info["state"],
-                job_id=job_id,
-                request=job_info["request"],
+        self._claim_batch = claim_batch
+        self._offloader = (offloader or blobs.Offloader(None, 0))
+        self._offloaded = set()
+        self._bases = {}  # job_id -> (base, packed_base)
+        self._buckets = set()  # The known buckets of the indexes
+        self._input_changed = threading.Event()
+        self._input_watchers = []
+        self._deleted_watchers = {}  # job_id -> callback
+        self._input_queues = [
+            self._client.get_queue(_get_path_input_queue(partition), self._on_input_changed)
+            for partition in range(input_partitions)
+        ]
+        if len(preferred_partitions) == 0:
+            preferred_partitions = [_get_input_partition(get_node_name(), input_partitions)]
+        self._preferred_queues = [
+            queue
+            for (partition, queue) in enumerate(self._input_queues)
+            if partition in preferred_partitions
+        ]
+        self._other_queues = [queue for queue in self._input_queues if queue not in self._preferred_queues]
+        self._round = 0
+        self._client.add_listener(self._on_state_changed)
+
+    def close(self):
+        for queue in self._input_queues:
+            queue.close()
+        self._client.remove_listener(self._on_state_changed)
+
+    def get_ready_jobs(self, timeout=None):
+        """
+            Takes the jobs from the input queue. If timeout is not None, the iterator is blocked when
+            the queue is empty, and waits for the new jobs up to timeout seconds before the stop.
+
+            The jobs are claimed by the rounds of claim_batch entries with the pipelined reads
+            and one write request per round. The entries taken but not claimed are released, and
+            the jobs claimed but not yielded are returned to the queue on close() of the generator.
+            The partitions of the queue are visited by round-robin, preferred partitions first.
+        """
+
+        deadline = None
+        queue = None
+        pending = []
+        claimed = []
+        try:
+            while True:
+                self._input_changed.clear()
+                for queue in self._get_input_queues_order():
+                    pending = queue.take(self._claim_batch)
+                    if len(pending) > 0:
+                        break
+
+                if len(pending) > 0:
+                    deadline = None
+                    claimed = self._claim_jobs(queue, pending)
+                    pending = []
+                    while len(claimed) > 0:
+                        (job_id, job_info, exec_info) = claimed.pop(0)
+                        try:
+                            state = self._read_state(job_id, exec_info["state"])
+                        except blobs.BlobError:
+                            get_logger(job_id=job_id).exception("Can't read the state of the job")
+                            self.done_job(job_id, retval=None, exc=traceback.format_exc())
+                            continue
+                        yield JobState(
+                            head=job_info["head"],
+                            method_name=job_info["method"],
+                            kwargs=job_info["kwargs"],
+                            state=state,
+                            job_id=job_id,
+                            request=job_info["request"],
+                        )
+                    continue
+
+                if timeout is None:
+                    break
+                if deadline is None:
+                    deadline = time.time() + timeout
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self._wait_input(remaining):
+                    break
+        finally:
+            for (name, _) in pending:
+                queue.release(name)
+            if len(claimed) > 0:
+                self._unclaim_jobs(queue, [job_id for (job_id, _, _) in claimed])
+
+    def _claim_jobs(self, queue, pending):
+        # Returns [(job_id, job_info, exec_info), ...] for the claimed entries [(name, job_id), ...]
+        # of the queue. The claims of the round are committed by one splittable write request,
+        # if it fails, the rest of the entries are claimed one by one.
+        reads = [
+            (
+                self._client.get_async(_get_path_job(job_id)),
+                self._client.get_async(_get_path_job_state(job_id)),
             )
+            for (_, job_id) in pending
+        ]
+        entries = [
+            (name, job_id, job_result.get(None), exec_result.get(None))
+            for ((name, job_id), (job_result, exec_result)) in zip(pending, reads)
+        ]
+        try:
+            with self._client.make_write_request("get_ready_jobs()", splittable=True) as request:
+                for entry in entries:
+                    self._claim_job_ops(request, queue, *entry)
+                    request.mark_boundary(entry[0])
+            committed = len(entries)
+        except (zoo.NoNodeError, zoo.NodeExistsError, zoo.PartialWriteError) as err:
+            committed = (len(err.committed) if isinstance(err, zoo.PartialWriteError) else 0)
+            get_logger().warning("Can't claim %d jobs by the batch, claiming them one by one",
+                                 len(entries) - committed)
+            failed = set()
+            for entry in entries[committed:]:
+                try:
+                    with self._client.make_write_request("get_ready_jobs()") as request:
+                        self._claim_job_ops(request, queue, *entry)
+                except (zoo.NoNodeError, zoo.NodeExistsError):
+                    get_logger(job_id=entry[1]).exception("Can't claim the job, skipped")
+                    queue.release(entry[0])
+                    failed.add(entry[0])
+            entries = [entry for entry in entries if entry[0] not in failed]
+
+        claimed = []
+        for (_, job_id, job_info, exec_info) in entries:
+            if job_info is None or exec_info is None:
+                get_logger(job_id=job_id).info("Dropped the queue entry of the removed job")
+            else:
+                claimed.append((job_id, job_info, exec_info))
+        return claimed
+
+    def _claim_job_ops(self, request, queue, name, job_id, job_info, exec_info):
+        if job_info is not None and exec_info is not None:
+            lock = self._client.get_lock(_get_path_job_lock(job_id))
+            lock.acquire(request, _make_lock_info("get_ready_jobs()"))
+            request.create(_get_path_job_taken(job_id), make_isotime())
+            request.create(_get_path_running(job_id))
+        queue.consume(request, name)
+
+    def _unclaim_jobs(self, queue, job_ids):
+        # The claimed jobs which were not yielded are returned to the queue for the other workers
+        with self._client.make_write_request("unclaim_jobs()") as request:
+            for job_id in job_ids:
+                request.delete(_get_path_job_taken(job_id))
+                request.delete(_get_path_running(job_id))
+                self._client.get_lock(_get_path_job_lock(job_id)).release(request)
+                queue.put(request, job_id)
+
+    def _read_state(self, job_id, state):
+        state = self._offloader.unpack(job_id, state)
+        if isinstance(state, IncrementalState) and state.base is None:
+            base = self._client.get(_get_path_job_base(job_id), None)
+            state = state._replace(base=self._offloader.unpack(job_id, base))
+        return state
+
+    def _get_input_queues_order(self):
+        self._round += 1
+        order = []
+        for queues in (self._preferred_queues, self._other_queues):
+            if len(queues) > 0:
+                offset = self._round % len(queues)
+                order += queues[offset:] + queues[:offset]
+        return order
+
+    def watch_input(self, callback):
+        """ The callback is called on each change of the input queue, returns False if it's not supported """
+
+        self._input_watchers.append(callback)
+        return True
+
+    def _on_input_changed(self):
+        self._input_changed.set()
+        for callback in self._input_watchers:
+            callback()
+
+    def _wait_input(self, timeout):
+        # self._input_changed is cleared at the beginning of each round
+        if any(queue.is_stale() for queue in self._input_queues):
+            return True
+        if self._input_changed.wait(timeout):
+            return True
+        for queue in self._input_queues:
+            queue.wait(0)  # Forces re-reading of the queues with the skipped entries
+        return False
 
     def associate_job(self, job_id):
         with self._client.make_write_request("associate_job()") as request:
@@ -234,8 +620,61 @@ class JobsProcess:
     def is_deleted_job(self, job_id):
         return self._client.exists(_get_path_job_delete(job_id))
 
+    def watch_deleted_job(self, job_id, callback):
+        """
+            The callback is called once when the job is marked as deleted (at once if it's already marked).
+            Returns False if it's not supported. The children of the job node are watched: the watch
+            is triggered by the mark of the deletion and by the removal of the job, so it doesn't outlive
+            the job. It's not set again after unwatch_deleted_job(), and the watches of the watched jobs
+            are set again after the reconnection (they are lost with the expired session).
+        """
+
+        self._deleted_watchers[job_id] = callback
+        self._watch_job(job_id)
+        return True
+
+    def unwatch_deleted_job(self, job_id):
+        self._deleted_watchers.pop(job_id, None)
+
+    def _watch_job(self, job_id):
+        self._client.get_children_async(_get_path_job(job_id), self._on_job_changed,
+                                        functools.partial(self._on_job_children, job_id))
+
+    def _on_job_changed(self, event):
+        # Called from the kazoo thread, kazoo keeps one watcher per path for the same callback
+        job_id = posixpath.basename(event.path)
+        if job_id in self._deleted_watchers:
+            self._watch_job(job_id)
+
+    def _on_job_children(self, job_id, children):
+        if children is not None and posixpath.basename(_get_path_job_delete(job_id)) in children:
+            callback = self._deleted_watchers.pop(job_id, None)
+            if callback is not None:
+                callback()
+
+    def _on_state_changed(self, state):
+        if state == zoo.STATE_CONNECTED:
+            for job_id in list(self._deleted_watchers):
+                self._watch_job(job_id)
+
     def save_job_state(self, job_id, state, stack):
+        (base, packed_base) = self._bases.get(job_id, (None, None))
+        base_op = None
+        if isinstance(state, IncrementalState):
+            # Only the deltas are rewritten while the base is the same
+            if state.base is not base:
+                if job_id in self._bases or self._client.exists(_get_path_job_base(job_id)):
+                    base_op = "set"
+                else:
+                    base_op = "create"
+                base = state.base
+                packed_base = self._offloader.pack(job_id, base)
+            state = state._replace(base=None)
+        state = self._offloader.pack(job_id, state)
+
         with self._client.make_write_request("save_job_state()") as request:
+            if base_op is not None:
+                getattr(request, base_op)(_get_path_job_base(job_id), packed_base)
             request.set(_get_path_job_state(job_id), {
                 "state":    state,
                 "stack":    stack,
@@ -243,40 +682,258 @@ class JobsProcess:
                 "retval":   None,
                 "exc":      None,
             })
+        if base is not None:
+            self._bases[job_id] = (base, packed_base)
+        self._cleanup_blobs(job_id, [state, packed_base])
 
-    def done_job(self, job_id, retval, exc):
-        with self._client.make_write_request("done_job()") as request:
-            request.set(_get_path_job_state(job_id), {
-                "state":    None,
-                "stack":    None,
-                "finished": make_isotime(),
-                "retval":   retval,
-                "exc":      exc,
-            })
-            self._client.get_lock(_get_path_job_lock(job_id)).release(request)
+    def done_job(self, job_id, retval, exc, lifetime=None):
+        """
+            Finishes the job and adds it to the index of the finished jobs. The job is removed
+            by the collector after done_lifetime or after the own lifetime (in seconds) if it's not None.
+        """
+
+        retval = self._offloader.pack(job_id, retval)
+        now = time.time()
+        if lifetime is None:
+            (root, when) = (_PATH_FINISHED, now)
+        else:
+            (root, when) = (_PATH_EXPIRES, now + lifetime)
+        bucket_path = _get_path_index_bucket(root, when)
+        index_path = zoo.join(bucket_path, job_id)
+        running = self._client.exists(_get_path_running(job_id))  # The jobs taken by the old versions are not indexed
+
+        for retry in (True, False):
+            self._ensure_bucket(bucket_path)
+            try:
+                with self._client.make_write_request("done_job()") as request:
+                    request.set(_get_path_job_state(job_id), {
+                        "state":    None,
+                        "stack":    None,
+                        "finished": make_isotime(now),
+                        "retval":   retval,
+                        "exc":      exc,
+                        "index":    index_path,
+                    })
+                    request.create(index_path, when)
+                    if running:
+                        request.delete(_get_path_running(job_id))
+                    if job_id in self._bases:
+                        request.delete(_get_path_job_base(job_id))
+                    self._client.get_lock(_get_path_job_lock(job_id)).release(request)
+                break
+            except zoo.NoNodeError:
+                # The old empty bucket can be removed by the collector (if the clocks are not synchronized)
+                if not retry:
+                    raise
+                self._buckets.discard(bucket_path)
+        self._bases.pop(job_id, None)
+        self._cleanup_blobs(job_id, [retval])
+        self._offloaded.discard(job_id)
+
+    def _ensure_bucket(self, path):
+        if path not in self._buckets:
+            try:
+                with self._client.make_write_request("ensure_bucket()") as request:
+                    request.create(path)
+            except zoo.NodeExistsError:
+                pass
+            if len(self._buckets) > 100:
+                self._buckets.clear()
+            self._buckets.add(path)
+
+    def _cleanup_blobs(self, job_id, values):
+        # Removes the blobs which are not referenced by the job anymore. The first checkpoint
+        # replaces the initial state (from the API), so its blob is removed here too. The blobs of
+        # the job which has never offloaded the values in this process are removed by the GC.
+        if any(isinstance(value, blobs.BlobRef) for value in values):
+            self._offloaded.add(job_id)
+        if job_id in self._offloaded:
+            self._offloader.cleanup(job_id, keep=values)
+
+
+class _HashRing:
+    """
+        Consistent hashing of the job ids to the members. Each member has _RING_POINTS points
+        on the ring, so only ~1/N of the jobs change the owner when a member joins or leaves.
+    """
+
+    def __init__(self, members):
+        self._points = sorted(
+            (self._hash("{}#{}".format(member, number)), member)
+            for member in members
+            for number in range(_RING_POINTS)
+        )
+        self._keys = [key for (key, _) in self._points]
+
+    def get_owner(self, job_id):
+        if len(self._points) == 0:
+            return None
+        return self._points[bisect.bisect(self._keys, self._hash(job_id)) % len(self._points)][1]
+
+    def _hash(self, value):
+        return int(hashlib.md5(value.encode()).hexdigest()[:8], 16)
 
 
 class JobsGc:
     """
         Interface for garbage collector.
         Needs for powny.core.apps.collector.
+
+        With sharding, each collector registers itself by the ephemeral node and examines
+        only the jobs that are owned by it on the hash ring of the registered collectors.
+        The ring is rebuilt by the children watch when the collectors join or leave;
+        the jobs are still locked, so the short overlaps during the rebalancing are safe.
+
+        The watches of the deleted jobs index and of the locks of the deleted jobs wake up
+        wait_deleted(), so the deleted job is removed right after the release by the worker.
     """
 
-    def __init__(self, client):
+    def __init__(self, client, input_partitions=1, offloader=None, sharding=False):
         self._client = client
-        self._input_queue = self._client.get_queue(_PATH_INPUT_QUEUE)
+        self._input_queues = [
+            self._client.get_queue(_get_path_input_queue(partition))
+            for partition in range(input_partitions)
+        ]
+        self._offloader = (offloader or blobs.Offloader(None, 0))
+        self._sharding = sharding
+        self._member = "{}@{}-{}".format(get_node_name(), os.getpid(), uuid.uuid4().hex[:8])
+        self._ring = None
+        self._members_changed = threading.Event()
+        self._members_changed.set()
+        self._deleted_changed = threading.Event()
+        self._client.add_listener(self._on_state_changed)
+
+    def close(self):
+        for queue in self._input_queues:
+            queue.close()
+        self._client.remove_listener(self._on_state_changed)
+
+    def _is_owned(self, job_id):
+        return (self._ring is None or self._ring.get_owner(job_id) == self._member)
+
+    def _update_ring(self):
+        if not self._sharding:
+            return
+        if self._members_changed.is_set():
+            self._members_changed.clear()
+            members = self._client.get_children(_PATH_COLLECTORS, watch=self._on_members_changed)
+            if self._member not in members:
+                try:
+                    with self._client.make_write_request("register_collector()") as request:
+                        request.create(zoo.join(_PATH_COLLECTORS, self._member),
+                                       _make_lock_info("register_collector()"), ephemeral=True)
+                except zoo.NodeExistsError:
+                    pass
+                members.append(self._member)
+            self._ring = _HashRing(members)
+            get_logger().info("Collectors on the ring: %s", sorted(members), member=self._member)
+
+    def _on_members_changed(self, _):
+        self._members_changed.set()
+
+    def _on_state_changed(self, state):
+        if state != zoo.STATE_CONNECTED:
+            self._members_changed.set()  # The ephemeral node and the watch may be lost
+            self._deleted_changed.set()
+
+    def _on_deleted_changed(self, _=None):
+        self._deleted_changed.set()
+
+    def wait_deleted(self, timeout):
+        """
+            Waits up to timeout seconds for the new deleted jobs and for the release of the deleted jobs
+            which were locked on the last get_jobs(). Returns True on the event.
+        """
+
+        return self._deleted_changed.wait(timeout)
 
-    def get_jobs(self, done_lifetime):
-        for job_id in self._client.get_children(_PATH_JOBS):
+    def get_jobs(self, done_lifetime, full=False):
+        """
+            Locks and yields (job_id, done) for the deleted jobs, for the finished jobs after
+            their lifetime and for the lost unfinished jobs. Only the indexes are visited:
+            the deleted and the running jobs, and the buckets of the finished jobs older than
+            the lifetime. The full scan of all jobs must be made sometimes to reconcile the indexes
+            and to process the jobs from the old versions.
+        """
+
+        self._update_ring()
+        if full:
+            yield from self._get_jobs_full(done_lifetime)
+            return
+
+        now = time.time()
+        candidates = collections.OrderedDict()  # job_id -> (done, index_path)
+        self._deleted_changed.clear()
+        for job_id in self._client.get_children(_PATH_DELETED, watch=self._on_deleted_changed):
+            candidates[job_id] = (True, _get_path_deleted(job_id))
+        for job_id in self._client.get_children(_PATH_RUNNING):
+            candidates.setdefault(job_id, (False, _get_path_running(job_id)))
+        for (root, cutoff) in ((_PATH_FINISHED, now - done_lifetime), (_PATH_EXPIRES, now)):
+            for (job_id, index_path) in self._get_expired(root, cutoff):
+                candidates.setdefault(job_id, (True, index_path))
+
+        # The jobs held by the live workers are skipped by one pipelined check of the locks,
+        # so they cost neither the reading of the state nor the failed creation of the lock.
+        candidates = [
+            (job_id, done, index_path)
+            for (job_id, (done, index_path)) in candidates.items()
+            if self._is_owned(job_id)
+        ]
+        locks = self._client.exists_many([_get_path_job_lock(job_id) for (job_id, _, _) in candidates])
+        unlocked = []
+        for ((job_id, done, index_path), locked) in zip(candidates, locks):
+            if not locked:
+                unlocked.append((job_id, done, index_path))
+            elif index_path == _get_path_deleted(job_id):
+                self._watch_deleted_lock(job_id)
+        states = iter(self._client.get_many([
+            _get_path_job_state(job_id)
+            for (job_id, done, _) in unlocked
+            if not done
+        ]))
+
+        for (job_id, done, index_path) in unlocked:
+            if not done:
+                state_info = next(states)
+                if state_info is zoo.MissingValue or state_info["finished"] is not None:
+                    self._remove_index_entry(index_path)  # The job has been finished or removed
+                    continue
+            try:
+                with self._client.make_write_request("get_jobs()") as request:
+                    self._client.get_lock(_get_path_job_lock(job_id)).acquire(request, _make_lock_info("get_jobs()"))
+            except zoo.NodeExistsError:
+                if index_path == _get_path_deleted(job_id):
+                    self._watch_deleted_lock(job_id)
+                continue
+            except zoo.NoNodeError:
+                self._remove_index_entry(index_path)  # The job has been removed
+                continue
+            yield (job_id, done)
+
+    def _watch_deleted_lock(self, job_id):
+        # The worker is killing the job, we will be woken up by the release
+        if not self._client.exists(_get_path_job_lock(job_id), watch=self._on_deleted_changed):
+            self._deleted_changed.set()
+
+    def _get_jobs_full(self, done_lifetime):
+        for job_id in filter(self._is_owned, self._client.get_children(_PATH_JOBS)):
             to_delete = self._client.exists(_get_path_job_delete(job_id))
             taken = self._client.exists(_get_path_job_taken(job_id))
             lock = self._client.get_lock(_get_path_job_lock(job_id))
 
             if (to_delete or taken) and not lock.is_locked():
                 try:
-                    finished = self._client.get(_get_path_job_state(job_id))["finished"]
+                    state_info = self._client.get(_get_path_job_state(job_id))
                 except zoo.NoNodeError:
                     continue
+                finished = state_info["finished"]
+                if (
+                    not to_delete
+                    and finished is not None
+                    and state_info.get("index") is not None
+                    and self._client.exists(state_info["index"])
+                ):
+                    continue  # Will be processed by the index
                 if to_delete or finished is None or from_isotime(finished) + done_lifetime <= time.time():
                     try:
                         with self._client.make_write_request("get_unfinished_jobs()") as request:
@@ -285,40 +942,137 @@ class JobsGc:
                         continue
                     yield (job_id, to_delete or finished is not None)  # (id, done)
 
+    def _get_expired(self, root, cutoff):
+        expired = []
+        for bucket in sorted(self._client.get_children(root), key=int):
+            start = int(bucket) * _INDEX_BUCKET
+            if start > cutoff:
+                break
+            bucket_path = zoo.join(root, bucket)
+            try:
+                names = self._client.get_children(bucket_path)
+            except zoo.NoNodeError:
+                continue
+            paths = [zoo.join(bucket_path, name) for name in names]
+            if start + _INDEX_BUCKET <= cutoff:  # The whole bucket is expired
+                if len(names) == 0:
+                    self._remove_index_entry(bucket_path)
+                expired += zip(names, paths)
+            else:
+                expired += [
+                    (name, path)
+                    for (name, path, when) in zip(names, paths, self._client.get_many(paths))
+                    if when is not zoo.MissingValue and when <= cutoff
+                ]
+        return expired
+
+    def _remove_index_entry(self, path):
+        try:
+            with self._client.make_write_request("remove_index_entry()") as request:
+                request.delete(path)
+        except (zoo.NoNodeError, zoo.NotEmptyError):
+            pass
+
     def push_back_job(self, job_id):
+        running = self._client.exists(_get_path_running(job_id))
         with self._client.make_write_request("push_back_job()") as request:
             request.delete(_get_path_job_taken(job_id))
             request.delete(_get_path_job_lock(job_id))
-            self._input_queue.put(request, job_id)
+            if running:
+                request.delete(_get_path_running(job_id))
+            self._input_queues[_get_input_partition(job_id, len(self._input_queues))].put(request, job_id)
 
     def remove_job_data(self, job_id):
         with self._client.make_write_request("remove_job_data()") as request:
-            for path_maker in (
-                _get_path_job_delete,
-                _get_path_job_taken,
-            ):
-                path = path_maker(job_id)
-                if self._client.exists(path):
-                    request.delete(path)
-            request.delete(_get_path_job_lock(job_id))
-            request.delete(_get_path_job_state(job_id))
-            request.delete(_get_path_job(job_id))
+            self._remove_job_ops(request, job_id, *self._read_removal_info([job_id])[0])
+        self._offloader.cleanup(job_id)
+
+    def remove_jobs_data(self, job_ids):
+        """
+            Removes the locked jobs by the splittable transactions (up to max_request_size),
+            the presence of the nodes is checked for all jobs by the pipelined reads. If a chunk
+            fails, the rest of the jobs are removed one by one (the removed ones are skipped).
+        """
+
+        job_ids = list(job_ids)
+        infos = self._read_removal_info(job_ids)
+        try:
+            with self._client.make_write_request("remove_jobs_data()", splittable=True) as request:
+                for (job_id, info) in zip(job_ids, infos):
+                    self._remove_job_ops(request, job_id, *info)
+                    request.mark_boundary(job_id)
+            committed = job_ids
+        except (zoo.NoNodeError, zoo.PartialWriteError) as err:
+            committed = (err.committed if isinstance(err, zoo.PartialWriteError) else [])
+            get_logger().warning("Can't remove %d jobs by the batch, removing them one by one",
+                                 len(job_ids) - len(committed))
+            for job_id in job_ids[len(committed):]:
+                try:
+                    self.remove_job_data(job_id)
+                except zoo.NoNodeError:
+                    get_logger(job_id=job_id).exception("Can't remove the job")
+        for job_id in committed:
+            self._offloader.cleanup(job_id)
+
+    def _read_removal_info(self, job_ids):
+        # Returns [(existing_optional_paths, index_path), ...]
+        optional_paths = [
+            [
+                _get_path_job_delete(job_id),
+                _get_path_job_taken(job_id),
+                _get_path_job_base(job_id),
+                _get_path_running(job_id),
+                _get_path_deleted(job_id),
+            ]
+            for job_id in job_ids
+        ]
+        state_results = [self._client.get_async(_get_path_job_state(job_id)) for job_id in job_ids]
+        existing = iter(self._client.exists_many([path for paths in optional_paths for path in paths]))
+        infos = []
+        for (paths, state_result) in zip(optional_paths, state_results):
+            state_info = state_result.get(zoo.MissingValue)
+            infos.append((
+                [path for path in paths if next(existing)],
+                (None if state_info is zoo.MissingValue else state_info.get("index")),
+            ))
+        return infos
+
+    def _remove_job_ops(self, request, job_id, optional_paths, index_path):
+        for path in optional_paths:
+            request.delete(path)
+        if index_path is not None:
+            request.delete(index_path)
+        request.delete(_get_path_job_lock(job_id))
+        request.delete(_get_path_job_state(job_id))
+        request.delete(_get_path_job(job_id))
 
 
 class Rules:
     """
         Interface to managing the rules HEAD.
+        With the cache, the HEAD is read once and then kept current by the data watch
+        (it's read again after the reconnection, because the watch may be missed).
     """
 
-    def __init__(self, client):
+    def __init__(self, client, cache=False):
         self._client = client
+        self._cache = (client.get_cache() if cache else None)
 
     def set_head(self, head):
-        with self._client.make_write_request("set_head()") as request:
-            request.set(_PATH_RULES_HEAD, head)
+        try:
+            with self._client.make_write_request("set_head()") as request:
+                request.set(_PATH_RULES_HEAD, head)
+        finally:
+            if self._cache is not None:
+                self._cache.invalidate(_PATH_RULES_HEAD)  # Don't wait for the watch in this process
 
     def get_head(self):
-        head = self._client.get(_PATH_RULES_HEAD)
+        if self._cache is None:
+            head = self._client.get(_PATH_RULES_HEAD)
+        else:
+            head = self._cache.get_versioned(_PATH_RULES_HEAD)[0]
+            if head is zoo.MissingValue:
+                raise zoo.NoNodeError
         if head is zoo.EmptyValue:
             return None
         else:
@@ -354,11 +1108,16 @@ class AppsState:
 
     def get_full_state(self):
         full_state = {}
-        for app_state_node in self._client.get_children(_PATH_APPS_STATE):
-            (app_name, node_name) = _parse_app_state_node(app_state_node)
-            try:
-                state = self._client.get(_get_path_app_state(app_name, node_name))
-            except zoo.NoNodeError:
+        names = [
+            _parse_app_state_node(app_state_node)
+            for app_state_node in self._client.get_children(_PATH_APPS_STATE)
+        ]
+        states = self._client.get_many([
+            _get_path_app_state(app_name, node_name)
+            for (app_name, node_name) in names
+        ])
+        for ((app_name, node_name), state) in zip(names, states):
+            if state is zoo.MissingValue:
                 continue
             full_state.setdefault(app_name, {})
             full_state[app_name][node_name] = state
@@ -368,10 +1127,13 @@ class AppsState:
 class CasStorage:
     """
         Interface to abstract CAS storage for user scripts.
+        The values are written by the versioned set() without locks. With cache=True, the read values
+        are kept in the process and invalidated by the data watches and by the reconnections.
     """
 
-    def __init__(self, client):
+    def __init__(self, client, cache=False):
         self._client = client
+        self._cache = (client.get_cache() if cache else None)
 
     def set_value(self, path, value, version=None):
         try:
@@ -398,44 +1160,109 @@ class CasStorage:
                 version is not None -- write if version >= old_version
         """
 
-        path = _get_path_cas_storage(path)
+        return self._replace([(path, value, version)], default, fatal_write)[0]
 
-        try:
-            with self._client.make_write_request("cas_ensure_path()") as request:
-                request.create(path, recursive=True)
-        except zoo.NodeExistsError:
-            pass
+    def get_many(self, paths, default=CasNoValue):
+        """ The same as get_value() for several paths with the pipelined reads, returns a list of CasData """
 
-        with self._client.get_lock(_get_path_cas_storage_lock(path)):
-            old = self._client.get(path)
-            if old is zoo.EmptyValue:
-                if default is CasNoValue:
-                    raise CasNoValueError()
-                old = CasData(value=default, version=None, stored=None)
-            else:
-                old = CasData(
-                    value=old["value"],
-                    version=old["version"],
-                    stored=from_isotime(old["stored"]),
-                )
-
-            if value is not CasNoValue:
-                if version is not None and old.version is not None and version <= old.version:
-                    write_ok = False
+        return [old for (old, _) in self._replace([(path, CasNoValue, None) for path in paths], default, True)]
+
+    def set_many(self, values):
+        """
+            The same as set_value() for several paths in one transaction.
+            values -- dict {path: (value, version)}, returns {path: write_ok}.
+        """
+
+        return {
+            path: write_ok
+            for (path, (_, write_ok)) in self.replace_many(values, default=None, fatal_write=False).items()
+        }
+
+    def replace_many(self, values, default=CasNoValue, fatal_write=True):
+        """
+            The same as replace_value() for several paths, all the values are written in one transaction.
+            values -- dict {path: (value, version)}, returns {path: (old, write_ok)}.
+            With fatal_write=True, nothing is written if any version is not superior to the existing one.
+        """
+
+        items = [(path, value, version) for (path, (value, version)) in values.items()]
+        return dict(zip(values, self._replace(items, default, fatal_write)))
+
+    def _replace(self, items, default, fatal_write):
+        paths = [_get_path_cas_storage(path) for (path, _, _) in items]
+        while True:
+            results = []
+            writes = []
+            for ((path, value, version), (old, node_version)) in zip(items, self._read_many(paths)):
+                if old is None:
+                    if default is CasNoValue:
+                        raise CasNoValueError()
+                    old = CasData(value=default, version=None, stored=None)
+
+                if value is CasNoValue:
+                    write_ok = None
+                elif version is not None and old.version is not None and version <= old.version:
                     msg = "Can't rewrite '{}' with version {} (old version: {})".format(path, version, old.version)
                     if fatal_write:
                         raise CasVersionError(msg)
-                    else:
-                        get_logger().debug(msg)
+                    get_logger().debug(msg)
+                    write_ok = False
                 else:
-                    with self._client.make_write_request("cas_save()") as request:
-                        request.set(path, {
-                            "value":   value,
-                            "version": version,
-                            "stored":  make_isotime(),
-                        })
-                        write_ok = True
-            else:
-                write_ok = None
+                    writes.append((_get_path_cas_storage(path), node_version, {
+                        "value":   value,
+                        "version": version,
+                        "stored":  make_isotime(),
+                    }))
+                    write_ok = True
+                results.append((old, write_ok))
+
+            if len(writes) == 0:
+                return results
+            try:
+                self._write(writes)
+            except (zoo.BadVersionError, zoo.NodeExistsError, zoo.NoNodeError):
+                # Concurrent modification, retry with the new values
+                continue
+            finally:
+                for (path, _, _) in writes:
+                    self._invalidate(path)
+            return results
+
+    def _write(self, writes):
+        if len(writes) > 1:
+            # The recursive creation works only for a single operation in the request
+            for (path, node_version, _) in writes:
+                if node_version is None:
+                    try:
+                        with self._client.make_write_request("cas_ensure_parent()") as request:
+                            request.create(posixpath.dirname(path), recursive=True)
+                    except zoo.NodeExistsError:
+                        pass
+        with self._client.make_write_request("cas_save()") as request:
+            for (path, node_version, new) in writes:
+                if node_version is None:
+                    request.create(path, new, recursive=(len(writes) == 1))
+                else:
+                    request.set(path, new, version=node_version)
+
+    def _read_many(self, paths):
+        # Returns [(CasData or None, node version or None), ...]
+        if self._cache is not None:
+            values = self._cache.get_versioned_many(paths)
+        else:
+            values = self._client.get_versioned_many(paths)
+        return [
+            (
+                (None if value is zoo.MissingValue or value is zoo.EmptyValue else CasData(
+                    value=value["value"],
+                    version=value["version"],
+                    stored=from_isotime(value["stored"]),
+                )),
+                node_version,
+            )
+            for (value, node_version) in values
+        ]
 
-        return (old, write_ok)
+    def _invalidate(self, path):
+        if self._cache is not None:
+            self._cache.invalidate(path)
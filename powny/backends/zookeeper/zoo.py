@@ -1,6 +1,11 @@
 import pickle
+import bisect
+import zlib
+import lzma
 import threading
+import random
 import contextlib
+import time
 import re
 
 from ...core import optconf
@@ -22,25 +27,81 @@ class NodeExistsError(Exception):
     pass
 
 
+class BadVersionError(Exception):
+    pass
+
+
+class NotEmptyError(Exception):
+    pass
+
+
+class PartialWriteError(Exception):
+    """
+        The splittable write request has failed after some chunks were committed.
+        The committed attribute contains the tags of the committed groups (see mark_boundary()),
+        the original error is available as __cause__.
+    """
+
+    def __init__(self, msg, committed):
+        super().__init__(msg)
+        self.committed = committed
+
+
 class EmptyValue:  # pylint: disable=no-init
     def __new__(cls):
         raise RuntimeError("Use a class rather than an object of class")
 
 
+class MissingValue:  # pylint: disable=no-init
+    # Marker of the non-existent node for Client.get_many()
+    def __new__(cls):
+        raise RuntimeError("Use a class rather than an object of class")
+
+
+STATE_CONNECTED = kazoo.client.KazooState.CONNECTED  # For the listeners, see Client.add_listener()
+
+
 # ====
-def _encode_value(value):
+# The compressed values have one byte header: _CODEC_MAGIC | codec id. The old values are headerless
+# pickles, they begins from the PROTO opcode (0x80) or from the ASCII opcode for the protocols 0 and 1.
+# Any pickle opcode is less than _CODEC_MAGIC, so both formats can be stored together. The protocol of
+# the pickle is not the part of the header, because the pickle stream describes it by itself.
+_CODEC_MAGIC = 0xF0
+
+_CODECS = {
+    # name: (id, compress, decompress)
+    "zlib": (1, zlib.compress, zlib.decompress),
+    "lzma": (2, lzma.compress, lzma.decompress),
+}
+
+_DECOMPRESSORS = {codec_id: decompress for (codec_id, _, decompress) in _CODECS.values()}
+
+_OP_OVERHEAD = 64  # Approximate size of the operation header, the flags and the ACL in the multi-request
+
+_LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10)  # Upper bounds (in seconds)
+
+
+def _encode_value(value, protocol=None, compression=None, compress_threshold=0):
     if value is EmptyValue:
         return b""
-    else:
-        return pickle.dumps(value)
+    data = pickle.dumps(value, protocol=protocol)
+    if compression is not None and len(data) >= compress_threshold:
+        (codec_id, compress, _) = _CODECS[compression]
+        compressed = compress(data)
+        if len(compressed) + 1 < len(data):
+            return bytes((_CODEC_MAGIC | codec_id,)) + compressed
+    return data
 
 
 def _decode_value(value):
     assert isinstance(value, bytes), "Invalid ZK output value type: {}".format(type(value))
     if len(value) == 0:
         return EmptyValue
-    else:
-        return pickle.loads(value)
+    if value[0] & _CODEC_MAGIC == _CODEC_MAGIC:
+        decompress = _DECOMPRESSORS.get(value[0] & ~_CODEC_MAGIC)
+        assert decompress is not None, "Unknown codec in the value header: 0x{:x}".format(value[0])
+        value = decompress(value[1:])
+    return pickle.loads(value)
 
 
 def _catch_zk(method):
@@ -51,6 +112,10 @@ def _catch_zk(method):
             raise NoNodeError
         except kazoo.exceptions.NodeExistsError:
             raise NodeExistsError
+        except kazoo.exceptions.BadVersionError:
+            raise BadVersionError
+        except kazoo.exceptions.NotEmptyError:
+            raise NotEmptyError
     return decorator.decorator(wrap, method)
 
 
@@ -61,16 +126,27 @@ class Client:
         with a friendly interface and the logged write operations.
     """
 
-    def __init__(self, nodes, timeout, start_timeout, start_retries, randomize_hosts, chroot):
+    def __init__(self, nodes, timeout, start_timeout, start_retries, randomize_hosts, chroot,
+                 pickle_protocol=None, compression="none", compress_threshold=1024, max_request_size=1000000,
+                 slow_threshold=1.0):
         assert isinstance(nodes, (list, tuple))
         for node in nodes:
             assert re.match(r"[^:]+:\d+", node) is not None, "zookeeper node should has format host:port"
+        assert compression == "none" or compression in _CODECS, "Unknown compression: {}".format(compression)
         self._hosts = ",".join(nodes)
         self._timeout = timeout
         self._start_timeout = start_timeout
         self._start_retries = start_retries
         self._randomize_hosts = randomize_hosts
         self._chroot = chroot
+        self._codec_kwargs = {
+            "protocol": pickle_protocol,
+            "compression": (None if compression == "none" else compression),
+            "compress_threshold": compress_threshold,
+        }
+        self._max_request_size = max_request_size
+        self._slow_threshold = slow_threshold
+        self._listeners = []
         self.zk = None
 
     @classmethod
@@ -83,6 +159,17 @@ class Client:
                                                                       "connection to ZooKeeper (0=infinite)"),
             "randomize_hosts": optconf.Option(default=True, help="Randomize host selection"),
             "chroot": optconf.Option(default=None, help="Use specified node as root (it must be created manually)"),
+            "pickle_protocol": optconf.Option(default=None, type=int, help="Pickle protocol for the stored values "
+                                                                           "(default for the Python if null)"),
+            "compression": optconf.Option(default="none", help="Compression for the large values: none, zlib or lzma "
+                                                               "(the values compressed by any method can be read)"),
+            "compress_threshold": optconf.Option(default=1024, help="The minimal size of the value for compression "
+                                                                    "(in bytes)"),
+            "max_request_size": optconf.Option(default=1000000, help="The maximum size of the splittable write "
+                                                                     "transaction (in bytes, must be less than "
+                                                                     "jute.maxbuffer of ZooKeeper)"),
+            "slow_threshold": optconf.Option(default=1.0, help="Log the operations that take longer than this "
+                                                               "(in seconds, 0=disabled)"),
         }
 
     @contextlib.contextmanager
@@ -120,6 +207,8 @@ class Client:
         )
         if self._chroot is not None:
             self.zk.chroot = self._chroot
+        for listener in self._listeners:
+            self.zk.add_listener(listener)
 
         logger = get_logger()
 
@@ -150,6 +239,25 @@ class Client:
     def is_connected(self):
         return (False if self.zk is None else self.zk.connected)
 
+    def add_listener(self, listener):
+        """
+            Adds the connection state listener (see kazoo.client.KazooClient.add_listener()).
+            It survives the reconnections by close() and open().
+        """
+
+        self._listeners.append(listener)
+        if self.zk is not None:
+            self.zk.add_listener(listener)
+
+    def remove_listener(self, listener):
+        """
+            Removes the listener added by add_listener().
+        """
+
+        self._listeners.remove(listener)
+        if self.zk is not None:
+            self.zk.remove_listener(listener)
+
     # ===
 
     def get_server_info(self):
@@ -180,93 +288,334 @@ class Client:
             for item in self.zk.command(b"mntr").split("\n")[:-1]
         )
 
+    def get_stats(self):
+        """
+            Returns the statistics of the operations of all clients in the process:
+            {"ops": {op_name: stat}, "labels": {comment: stat}}, see _Stats.
+        """
+
+        return _stats.get()
+
+    @contextlib.contextmanager
+    def measure(self, op_name, label=None):
+        """
+            Records the operation to the statistics. The context yields the _Measurement object,
+            the caller can set the sizes of the read and written data and the number of the operations
+            for the batch of the pipelined calls.
+        """
+
+        measurement = _Measurement()
+        start = time.monotonic()
+        try:
+            yield measurement
+        except Exception:
+            measurement.error = True
+            raise
+        finally:
+            self._record(op_name, label, time.monotonic() - start, measurement)
+
+    def _record(self, op_name, label, latency, measurement):
+        _stats.record(op_name, label, latency, measurement)
+        if self._slow_threshold > 0 and latency >= self._slow_threshold:
+            get_logger().warning("Slow ZooKeeper operation %s: %.3f seconds", op_name, latency,
+                                 comment=label, read=measurement.read, written=measurement.written)
+
     # ===
 
     @_catch_zk
-    def get_children(self, path):
-        return self.zk.get_children(path)
+    def get_children(self, path, watch=None):
+        with self.measure("get_children") as measurement:
+            children = self.zk.get_children(path, watch=watch)
+            measurement.read = sum(map(len, children))
+            return children
+
+    def get_children_async(self, path, watch, callback):
+        """
+            Reads the children without blocking. The callback is called from the kazoo thread with
+            the list of the children or with None if the node does not exist. It's not called on the
+            connection errors, the caller must set the watch again after the reconnection.
+        """
+
+        start = time.monotonic()
+
+        def on_result(result):
+            measurement = _Measurement()
+            try:
+                children = result.get()
+                measurement.read = sum(map(len, children))
+            except kazoo.exceptions.NoNodeError:
+                children = None
+            except Exception as err:
+                measurement.error = True
+                get_logger().warning("Can't read the children of %s: %s", path, err)
+                return
+            finally:
+                self._record("get_children", None, time.monotonic() - start, measurement)
+            callback(children)
+
+        self.zk.get_children_async(path, watch=watch).rawlink(on_result)
 
     @_catch_zk
     def get_children_count(self, path):
-        stat = self.zk.retry(self.zk.get, path)[1]
+        with self.measure("get") as measurement:
+            (value, stat) = self.zk.retry(self.zk.get, path)
+            measurement.read = len(value)
         return stat.children_count
 
+    @_catch_zk
+    def get_children_counts(self, paths):
+        with self.measure("exists") as measurement:
+            measurement.count = len(paths)
+            results = [self.zk.exists_async(path) for path in paths]
+            counts = []
+            for result in results:
+                stat = result.get()
+                if stat is None:
+                    raise NoNodeError
+                counts.append(stat.children_count)
+        return counts
+
+    @_catch_zk
+    def exists_many(self, paths):
+        """ Checks several nodes concurrently, returns a list of bools in the same order """
+
+        with self.measure("exists") as measurement:
+            measurement.count = len(paths)
+            results = [self.zk.exists_async(path) for path in paths]
+            return [(result.get() is not None) for result in results]
+
     @_catch_zk
     def exists(self, path, watch=None):
-        return (self.zk.exists(path, watch=watch) is not None)
+        with self.measure("exists"):
+            return (self.zk.exists(path, watch=watch) is not None)
 
     def get(self, path, default=EmptyValue):
         try:
-            return _decode_value(self.zk.get(path)[0])
+            with self.measure("get") as measurement:
+                value = self.zk.get(path)[0]
+                measurement.read = len(value)
+            return _decode_value(value)
         except kazoo.exceptions.NoNodeError:
             if default is EmptyValue:
                 raise NoNodeError
             return default
 
-    def make_write_request(self, comment="<unnamed>"):
-        return _WriteRequest(self, comment)
+    @_catch_zk
+    def get_versioned(self, path, watch=None):
+        """
+            Returns (value, version) of the node or (MissingValue, None) if it does not exist.
+            The watch is set in both cases (on the data or on the creation of the node).
+        """
+
+        try:
+            return self.get_async(path, watch).get_versioned()
+        except NoNodeError:
+            if watch is not None and self.exists(path, watch=watch):
+                return self.get_versioned(path, watch)  # Has just been created
+            return (MissingValue, None)
+
+    @_catch_zk
+    def get_versioned_many(self, paths, watch=None):
+        """ The same as get_versioned() for several paths with the pipelined reads """
+
+        results = [self.get_async(path, watch) for path in paths]
+        values = []
+        for (path, result) in zip(paths, results):
+            try:
+                values.append(result.get_versioned())
+            except NoNodeError:
+                values.append(self.get_versioned(path, watch) if watch is not None else (MissingValue, None))
+        return values
+
+    def encode_value(self, value):
+        return _encode_value(value, **self._codec_kwargs)
+
+    def get_async(self, path, watch=None):
+        return _AsyncValue(self, self.zk.get_async(path, watch=watch))
+
+    def get_many(self, paths):
+        """
+            Reads several nodes concurrently. Returns a list of values in the same order,
+            the missing nodes are represented by MissingValue.
+        """
+
+        results = [self.get_async(path) for path in paths]
+        return [result.get(MissingValue) for result in results]
+
+    def make_write_request(self, comment="<unnamed>", splittable=False):
+        return _WriteRequest(self, comment, (self._max_request_size if splittable else None))
 
     # ===
 
     def get_lock(self, path, comment="<unnamed>"):
         return _Lock(self, path, comment)
 
-    def get_queue(self, path):
-        return _Queue(self, path)
+    def get_queue(self, path, on_change=None):
+        return _Queue(self, path, on_change)
 
-    def get_counter(self, path):
-        return _Counter(self, path)
+    def get_counter(self, path, reserve=1):
+        return _Counter(self, path, reserve)
+
+    def get_cache(self):
+        return _Cache(self)
+
+
+class _AsyncValue:
+    """
+        The result of Client.get_async(). Several reads can be started one after another
+        and then collected by get() without waiting for each round trip.
+    """
+
+    def __init__(self, client, async_result):
+        self._client = client
+        self._async_result = async_result
+        self._start = time.monotonic()
+
+    def get(self, default=EmptyValue):
+        try:
+            return _decode_value(self._get_result()[0])
+        except kazoo.exceptions.NoNodeError:
+            if default is EmptyValue:
+                raise NoNodeError
+            return default
+
+    def get_versioned(self):
+        try:
+            (value, stat) = self._get_result()
+        except kazoo.exceptions.NoNodeError:
+            raise NoNodeError
+        return (_decode_value(value), stat.version)
+
+    def _get_result(self):
+        # The latency is counted from the sending of the request
+        measurement = _Measurement()
+        try:
+            result = self._async_result.get()
+            measurement.read = len(result[0])
+            return result
+        except Exception:
+            measurement.error = True
+            raise
+        finally:
+            latency = time.monotonic() - self._start
+            self._client._record("get", None, latency, measurement)  # pylint: disable=protected-access
 
 
 class _WriteRequest:
     """
         This class is used to perform write operations in a single context.
         For several operations, the transaction is automatically used.
+
+        The splittable request (with max_size) is committed by the chunks of the transactions
+        no larger than max_size. The operations between the calls of mark_boundary() form a group
+        that is never split. If a chunk fails, the previous chunks stay committed: the error
+        is raised as is for the first chunk (nothing is written) or as PartialWriteError.
     """
 
-    def __init__(self, client, comment):
+    def __init__(self, client, comment, max_size=None):
         self._client = client
         self._comment = comment
+        self._max_size = max_size
         self._ops = []
+        self._groups = []  # [(tag, ops_end, size), ...]
+        self._size = 0
 
     def create(self, path, value=EmptyValue, ephemeral=False, sequence=False, recursive=False):
         kwargs = {
             "path":      path,
-            "value":     _encode_value(value),
+            "value":     self._client.encode_value(value),
             "ephemeral": ephemeral,
             "sequence":  sequence,
         }
         if recursive:
             kwargs["makepath"] = True  # XXX: Only for a single operation!
-        self._ops.append(("create", kwargs))
+        self._add_op("create", kwargs)
 
-    def set(self, path, value=EmptyValue):
-        self._ops.append(("set", {
-            "path":  path,
-            "value": _encode_value(value),
-        }))
+    def set(self, path, value=EmptyValue, version=-1):
+        self._add_op("set", {
+            "path":    path,
+            "value":   self._client.encode_value(value),
+            "version": version,  # -1 for any version
+        })
 
     def delete(self, path, recursive=False):
         kwargs = {"path": path}
         if recursive:
             kwargs["recursive"] = True  # XXX: Only for a single operation!
-        self._ops.append(("delete", kwargs))
+        self._add_op("delete", kwargs)
+
+    def mark_boundary(self, tag=None):
+        """ Closes the group of the operations, the request can be split only between the groups """
+
+        if len(self._ops) > (self._groups[-1][1] if len(self._groups) > 0 else 0):
+            self._groups.append((tag, len(self._ops), self._size))
+
+    def get_size(self):
+        """ Returns the approximate encoded size of the operations (in bytes) """
+
+        return self._size
+
+    def _add_op(self, op_name, kwargs):
+        self._ops.append((op_name, kwargs))
+        self._size += _OP_OVERHEAD + len(kwargs["path"].encode()) + len(kwargs.get("value", b""))
 
     def __enter__(self):
         get_logger().debug("Created write-request", comment=self._comment)
         return self
 
-    @_catch_zk  # for "len(self._ops) == 1"
     def __exit__(self, exc_type, exc_value, traceback):
         if exc_value is not None:
             raise exc_value
         assert len(self._ops) > 0, "_WriteRequest() does not contain operations"
-        if len(self._ops) == 1:
-            (op_name, kwargs) = self._ops[0]
+        if self._max_size is None or self._size <= self._max_size:
+            self._commit(self._ops)
+        else:
+            self.mark_boundary()
+            chunks = self._make_chunks()
+            committed = []
+            for (number, (tags, ops)) in enumerate(chunks):
+                try:
+                    self._commit(ops)
+                except Exception as err:
+                    if number == 0:
+                        raise
+                    raise PartialWriteError("Committed {} of {} chunks of the write-request {}".format(
+                                            number, len(chunks), self._comment), committed) from err
+                committed.extend(tags)
+                get_logger().debug("Committed chunk %d of %d (%d ops)", number + 1, len(chunks),
+                                   len(ops), comment=self._comment)
+        get_logger().debug("Completed write-request", comment=self._comment)
+
+    def _make_chunks(self):
+        chunks = []  # [(tags, ops), ...]
+        (begin, begin_size) = (0, 0)
+        (prev_end, prev_size) = (0, 0)
+        tags = []
+        for (tag, end, size) in self._groups:
+            if size - begin_size > self._max_size and prev_end > begin:
+                chunks.append((tags, self._ops[begin:prev_end]))
+                (begin, begin_size) = (prev_end, prev_size)
+                tags = []
+            if tag is not None:
+                tags.append(tag)
+            (prev_end, prev_size) = (end, size)
+        chunks.append((tags, self._ops[begin:]))
+        return chunks
+
+    @_catch_zk  # for "len(ops) == 1"
+    def _commit(self, ops):
+        op_name = (ops[0][0] if len(ops) == 1 else "transaction")
+        with self._client.measure(op_name, self._comment) as measurement:
+            measurement.written = sum(len(kwargs.get("value", b"")) for (_, kwargs) in ops)
+            self._commit_ops(ops)
+
+    def _commit_ops(self, ops):
+        if len(ops) == 1:
+            (op_name, kwargs) = ops[0]
             getattr(self._client.zk, op_name)(**kwargs)
         else:
             trans = self._client.zk.transaction()
-            for (op_name, kwargs) in self._ops:
+            for (op_name, kwargs) in ops:
                 if op_name == "set":
                     op_name = "set_data"
                 getattr(trans, op_name)(**kwargs)
@@ -279,7 +628,6 @@ class _WriteRequest:
                 elif isinstance(result, Exception):
                     raise result
             assert not need_err, "No other exceptions, but runtime is inconsistent: {}".format(results)
-        get_logger().debug("Completed write-request", comment=self._comment)
 
 
 # =====
@@ -312,14 +660,16 @@ class _Lock:
 
     def __exit__(self, exc_type, exc_value, traceback):
         try:
-            self._client.zk.delete(self._path)
+            with self._client.measure("delete", self._comment):
+                self._client.zk.delete(self._path)
         except kazoo.exceptions.NoNodeError:
             pass
         get_logger().debug("Released lock", comment=self._comment)
 
     def _try_acquire(self):
         try:
-            self._client.zk.create(self._path, ephemeral=True)
+            with self._client.measure("create", self._comment):
+                self._client.zk.create(self._path, ephemeral=True)
             return True
         except kazoo.exceptions.NodeExistsError:
             return False
@@ -332,13 +682,28 @@ class _Queue:
             https://zookeeper.apache.org/doc/r3.1.2/recipes.html#sc_recipes_Queues
         Our implementation does not save items order on failure (when consume() has not been called).
         This behaviour is acceptable for Powny.
+
+        The list of entries is fetched with the children watch. When the queue has been drained,
+        the iteration stops without requests to ZooKeeper until the watch is triggered, and wait()
+        allows to sleep until the queue is changed. The optional on_change() callback is called from
+        the kazoo thread after the change, it can be used to wait for several queues. The entry
+        locked by another consumer may be released without changing the queue (if the consumer
+        has failed before consume()), so the locks of the skipped entries are watched as well.
     """
 
-    def __init__(self, client, path):
+    def __init__(self, client, path, on_change=None):
         self._client = client
         self._path = path
+        self._on_change = on_change
         self._children = []
         self._last = None
+        self._changed = threading.Event()
+        self._changed.set()  # The first __next__() must fetch the entries
+        self._client.add_listener(self._on_state_changed)
+
+    def close(self):
+        # The listener is kept by the client, so the dropped queue must be closed
+        self._client.remove_listener(self._on_state_changed)
 
     def put(self, request, value):
         assert isinstance(request, _WriteRequest), "Required _WriteRequest() object or None"
@@ -350,63 +715,318 @@ class _Queue:
         return self
 
     def __next__(self):
-        # FIXME: need children watcher
         if self._last is not None:
             self._children.pop(0)
             self._last = None
 
         while True:
-            if len(self._children) == 0:
-                try:
-                    self._children = self._client.zk.retry(self._client.zk.get_children, self._path)  # FIXME: retry?
-                except kazoo.exceptions.NoNodeError:
-                    raise NoNodeError
-                self._children = list(sorted(self._children))
+            if len(self._children) == 0 and self._changed.is_set():
+                self._children = self._fetch_children()
             if len(self._children) == 0:
                 raise StopIteration
 
             name = self._children[0]
             path = join(self._path, name)
             try:
-                self._client.zk.create(join(path, "__lock__"), ephemeral=True)
-            except (kazoo.exceptions.NoNodeError, kazoo.exceptions.NodeExistsError):
-                self._children.pop(0)  # FIXME: need a watcher
+                with self._client.measure("create", "queue_lock()"):
+                    self._client.zk.create(join(path, "__lock__"), ephemeral=True)
+            except kazoo.exceptions.NoNodeError:
+                self._children.pop(0)
+                continue
+            except kazoo.exceptions.NodeExistsError:
+                self._children.pop(0)
+                self._watch_locks([name])
                 continue
             self._last = name
 
-            return _decode_value(self._client.zk.get(path)[0])
+            return self._client.get_async(path).get()
+
+    def take(self, count):
+        """
+            Locks up to count entries and returns a list of (name, value). The lock creation and
+            the reading of the values are pipelined. The search begins from a random entry in the
+            list to reduce the lock contention between the consumers, so the order is not saved.
+            Each returned entry must be consume()'d or release()'d. On an error, the entries
+            locked by the call are released.
+        """
+
+        taken = []
+        owned = []  # The entries locked by this call (or maybe locked, if the creation has failed)
+        try:
+            while len(taken) < count:
+                if len(self._children) == 0 and self._changed.is_set():
+                    children = self._fetch_children()
+                    offset = random.randrange(len(children)) if len(children) > 0 else 0
+                    self._children = children[offset:] + children[:offset]
+                if len(self._children) == 0:
+                    break
+
+                names = self._children[:count - len(taken)]
+                del self._children[:len(names)]
+                owned += names
+                with self._client.measure("create", "queue_lock()") as measurement:
+                    measurement.count = len(names)
+                    results = [
+                        (name, self._client.zk.create_async(join(self._path, name, "__lock__"), ephemeral=True))
+                        for name in names
+                    ]
+                    locked = []
+                    skipped = []
+                    for (name, result) in results:
+                        try:
+                            result.get()
+                            locked.append(name)
+                        except kazoo.exceptions.NoNodeError:
+                            owned.remove(name)
+                        except kazoo.exceptions.NodeExistsError:
+                            owned.remove(name)
+                            skipped.append(name)
+                if len(skipped) > 0:
+                    self._watch_locks(skipped)
+                results = [(name, self._client.get_async(join(self._path, name))) for name in locked]
+                for (name, result) in results:
+                    taken.append((name, result.get()))
+        except Exception:
+            for name in owned:
+                try:
+                    self.release(name)
+                except Exception:
+                    pass  # The ephemeral lock will be removed with the lost session
+            raise
+        return taken
+
+    def consume(self, request, name=None):
+        if name is None:
+            name = self._last
+        request.delete(join(self._path, name, "__lock__"))
+        request.delete(join(self._path, name))
+
+    def release(self, name):
+        try:
+            with self._client.measure("delete", "queue_release()"):
+                self._client.zk.delete(join(self._path, name, "__lock__"))
+        except kazoo.exceptions.NoNodeError:
+            pass
+
+    def wait(self, timeout=None):
+        """
+            Waits until the queue is changed after the last fetching of the entries.
+            Returns False on timeout.
+        """
+
+        return self._changed.wait(timeout)
 
-    def consume(self, request):
-        request.delete(join(self._path, self._last, "__lock__"))
-        request.delete(join(self._path, self._last))
+    def is_stale(self):
+        """
+            Returns True if the queue has been changed after the last fetching of the entries,
+            and the next take() or __next__() will read them again.
+        """
+
+        return self._changed.is_set()
 
     def __len__(self):
         return self._client.get_children_count(self._path)
 
+    def _fetch_children(self):
+        self._changed.clear()
+        try:
+            with self._client.measure("get_children") as measurement:
+                children = self._client.zk.retry(self._client.zk.get_children, self._path,
+                                                 watch=self._on_children_changed)
+                measurement.read = sum(map(len, children))
+        except kazoo.exceptions.NoNodeError:
+            self._changed.set()
+            raise NoNodeError
+        return list(sorted(children))
+
+    def _watch_locks(self, names):
+        with self._client.measure("exists", "queue_watch_lock()") as measurement:
+            measurement.count = len(names)
+            results = [
+                self._client.zk.exists_async(join(self._path, name, "__lock__"), watch=self._on_lock_changed)
+                for name in names
+            ]
+            released = [(result.get() is None) for result in results]
+        if any(released):
+            self._notify()  # Has been released before the watch
+
+    def _on_children_changed(self, _):
+        self._notify()
+
+    def _on_lock_changed(self, _):
+        self._notify()
+
+    def _on_state_changed(self, state):
+        if state != kazoo.client.KazooState.CONNECTED:
+            self._notify()  # The watch may be lost with the session
+
+    def _notify(self):
+        self._changed.set()
+        if self._on_change is not None:
+            self._on_change()
+
 
 class _Counter:
     """
-        Incremental integer counter.
+        Incremental integer counter without locks: the value is changed by the versioned set()
+        with retries on the concurrent modification. With reserve > 1, the counter takes the ranges
+        of the numbers and returns them locally, so the numbers from the different processes
+        are unique but not ordered.
     """
 
-    def __init__(self, client, path):
+    def __init__(self, client, path, reserve=1):
         self._client = client
         self._path = path
+        self._reserve = reserve
+        self._lock = threading.Lock()
+        self._next = 0
+        self._limit = 0
 
     def get(self):
-        try:
-            value = _decode_value(self._client.zk.get(self._path)[0])
-            if value is EmptyValue:
-                return 0
-            else:
-                return value
-        except kazoo.exceptions.NoNodeError:
-            raise NoNodeError
+        value = self._client.get(self._path)
+        if value is EmptyValue:
+            return 0
+        else:
+            return value
 
     def increment(self):
-        with self._client.zk.Lock(join(self._path, "__lock__")):
-            old = self.get()
-            new = old + 1
-            self._client.zk.set(self._path, _encode_value(new))
+        if self._reserve <= 1:
+            return self._add(1)
+        with self._lock:
+            if self._next >= self._limit:
+                self._next = self._add(self._reserve)
+                self._limit = self._next + self._reserve
+            value = self._next
+            self._next += 1
+            return value
+
+    def _add(self, count):
+        while True:
+            (old, version) = self._client.get_versioned(self._path)
+            if old is MissingValue:
+                raise NoNodeError
+            if old is EmptyValue:
+                old = 0
+            new = old + count
+            try:
+                with self._client.make_write_request("counter_add()") as request:
+                    request.set(self._path, new, version=version)
+            except BadVersionError:
+                continue
             get_logger().debug("Value changed: %d -> %d", old, new, comment=self._path)
-        return old
+            return old
+
+
+class _Cache:
+    """
+        Process-level cache of the nodes values. Each cached node has a watch (on the data or on
+        the creation), which removes it from the cache. The whole cache is dropped when
+        the connection is suspended or lost, because the watches may be missed.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._items = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._client.add_listener(self._on_state_changed)
+
+    def get_versioned(self, path):
+        return self.get_versioned_many([path])[0]
+
+    def get_versioned_many(self, paths):
+        with self._lock:
+            found = {path: self._items[path] for path in paths if path in self._items}
+            generation = self._generation
+        missed = [path for path in paths if path not in found]
+        found.update(zip(missed, self._client.get_versioned_many(missed, self._on_node_changed)))
+        with self._lock:
+            if generation == self._generation:  # No invalidations during the reading
+                self._items.update(found)
+        return [found[path] for path in paths]
+
+    def invalidate(self, path=None):
+        with self._lock:
+            self._generation += 1
+            if path is None:
+                self._items.clear()
+            else:
+                self._items.pop(path, None)
+
+    def __len__(self):
+        return len(self._items)
+
+    def _on_node_changed(self, event):
+        self.invalidate(event.path)
+
+    def _on_state_changed(self, state):
+        if state != kazoo.client.KazooState.CONNECTED:
+            self.invalidate()
+
+
+# =====
+class _Measurement:  # pylint: disable=too-few-public-methods
+    def __init__(self):
+        self.read = 0
+        self.written = 0
+        self.error = False
+        self.count = 1  # The number of the pipelined operations
+
+
+class _Stats:
+    """
+        Process-wide statistics of the ZooKeeper operations by the operation type
+        and by the comment of the request. Each item contains the number of the operations
+        (each entry of the pipelined batch is counted, the transaction is one operation)
+        and the failed calls, the total time of the calls, the read and written bytes
+        and the latency histogram ({"<upper bound in seconds>": count, ..., "inf": count}).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ops = {}
+        self._labels = {}
+
+    def record(self, op_name, label, latency, measurement):
+        with self._lock:
+            self._update(self._ops, op_name, latency, measurement)
+            if label is not None:
+                self._update(self._labels, label, latency, measurement)
+
+    def get(self):
+        with self._lock:
+            return {
+                "ops": {key: self._make_item(item) for (key, item) in self._ops.items()},
+                "labels": {key: self._make_item(item) for (key, item) in self._labels.items()},
+            }
+
+    def reset(self):
+        with self._lock:
+            self._ops.clear()
+            self._labels.clear()
+
+    def _update(self, items, key, latency, measurement):
+        item = items.get(key)
+        if item is None:
+            item = items[key] = {
+                "count": 0,
+                "errors": 0,
+                "time": 0.0,
+                "read": 0,
+                "written": 0,
+                "latency": [0] * (len(_LATENCY_BUCKETS) + 1),
+            }
+        item["count"] += measurement.count
+        item["errors"] += int(measurement.error)
+        item["time"] += latency
+        item["read"] += measurement.read
+        item["written"] += measurement.written
+        item["latency"][bisect.bisect_left(_LATENCY_BUCKETS, latency)] += measurement.count
+
+    def _make_item(self, item):
+        item = dict(item)
+        item["latency"] = dict(zip(list(map(str, _LATENCY_BUCKETS)) + ["inf"], item["latency"]))
+        return item
+
+
+_stats = _Stats()
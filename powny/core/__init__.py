@@ -22,6 +22,9 @@ from .context import (
     get_extra,
     get_cas_storage,
     save_job_state,
+    set_job_lifetime,
+    sleep,
+    wait_read,
 )
 
 __version__ = get_version()
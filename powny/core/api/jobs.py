@@ -3,7 +3,10 @@ from flask import request
 from ulib.validatorlib import ValidatorError
 from ulib.validators.extra import valid_uuid
 
-from ..backends import DeleteTimeoutError
+from ..backends import (
+    DeleteTimeoutError,
+    PartialAddError,
+)
 from .. import tools
 
 from . import get_url_for
@@ -59,6 +62,8 @@ class JobsResource(Resource):
                     404 -- Method not found (for method call).
                     503 -- In the queue is more then N jobs.
                     503 -- No HEAD or exposed methods.
+                    500 -- Only some of the handlers were launched (the result contains
+                           the launched jobs in the same format).
     """
 
     def __init__(self, pool, loader, input_limit):
@@ -112,11 +117,19 @@ class JobsResource(Resource):
         jobs = tools.make_jobs_by_matchers(head, kwargs, exposed)
         if len(jobs) == 0:
             return {}
-        else:
-            return {
-                job_id: {"method": job.method_name, "url": self._get_job_url(job_id)}
-                for (job_id, job) in zip(backend.jobs_control.add_jobs(head, jobs), jobs)
-            }
+        try:
+            job_ids = backend.jobs_control.add_jobs(head, jobs)
+        except PartialAddError as err:
+            # The added jobs are running, so their ids are returned with the error
+            raise ApiError(500, "Only {} of {} handlers were launched: {}".format(len(err.added), len(jobs), err),
+                           self._make_jobs_result(err.added, jobs))
+        return self._make_jobs_result(job_ids, jobs)
+
+    def _make_jobs_result(self, job_ids, jobs):
+        return {
+            job_id: {"method": job.method_name, "url": self._get_job_url(job_id)}
+            for (job_id, job) in zip(job_ids, jobs)
+        }
 
     def _get_job_url(self, job_id):
         return get_url_for(JobControlResource, job_id=job_id)
@@ -75,7 +75,8 @@ class InfoResource(Resource):
                        "version": "<...>",
                        "backend": {
                            "name": "<backend_name>",
-                           "info": {...},  # Backen-specific data
+                           "info": {...},  # Backen-specific data (for ZooKeeper: the server info
+                                           # and the "stats" of the operations of the API process)
                        },
                    },
                }
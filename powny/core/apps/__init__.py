@@ -196,10 +196,41 @@ def _get_config_scheme():
             "max_jobs_sleep": optconf.Option(default=1, help="If we have reached the maximum concurrent jobs - "
                                                              "the process goes to sleep (seconds)"),
             "max_jobs": optconf.Option(default=100, help="The maximum number of job processes"),
+            "state_interval": optconf.Option(default=10, help="Interval of the rewriting of the unchanged worker "
+                                                              "state and of the checking of all deleted jobs "
+                                                              "(seconds)"),
+            "checkpoint_deltas": optconf.Option(default=0, help="The maximum number of the incremental deltas "
+                                                                "in the job state before the compaction (0 - disabled, "
+                                                                "enable it after the upgrade of all nodes)"),
+            "checkpoint_compact_ratio": optconf.Option(default=0.5, help="Write a new full state when the deltas "
+                                                                         "exceed this ratio of the base state size"),
+            "pool_size": optconf.Option(default=0, help="The number of the idle pre-started job processes "
+                                                        "connected to the backend (0 - a new process for each job)"),
+            "pool_max_jobs": optconf.Option(default=0, help="Restart the pool process after this number of the jobs "
+                                                            "(0 - unlimited)"),
+            "pool_max_rss": optconf.Option(default=0, help="Restart the pool process when its peak RSS exceeds "
+                                                           "this size (megabytes, 0 - unlimited)"),
+            "broker": optconf.Option(default=False, help="Send the backend calls of the job processes to the worker "
+                                                         "and use its connection (the forked processes are not "
+                                                         "supported)"),
+            "broker_threads": optconf.Option(default=8, help="The maximum number of the concurrent backend calls "
+                                                             "served by the broker"),
+            "coop_jobs": optconf.Option(default=0, help="The maximum number of the jobs of one HEAD running "
+                                                        "cooperatively in one process (0 - disabled)"),
+            "fork_servers": optconf.Option(default=0, help="The maximum number of the HEADs with the fork servers "
+                                                           "for the job processes (0 - disabled)"),
+            "fork_server_idle": optconf.Option(default=600.0, help="Stop the fork server of the HEAD without "
+                                                                   "the new jobs after this number of seconds"),
         },
 
         "collector": {
             "done_lifetime": optconf.Option(default=60, help="Seconds to wait before deleting completed job"),
+            "full_scan_interval": optconf.Option(default=3600, help="Interval of the full scan of the jobs "
+                                                                    "that reconciles the indexes (seconds)"),
+            "remove_batch": optconf.Option(default=100, help="The maximum number of the done jobs "
+                                                             "removed at once"),
+            "remove_rate": optconf.Option(default=0, help="The maximum number of the removed jobs per second, "
+                                                          "so the purges don't starve the other writes (0=unlimited)"),
         },
     }
     for app in ("worker", "collector"):
@@ -25,11 +25,17 @@ class _Collector(Application):
         This application provides cleaning storage of data left after the execution
         of the jobs. Incomplete jobs (due to the failure) are returned to the input
         queue. The completed jobs after expiration of the lifetime are deleted.
+        The backend can use the indexes for the regular rounds and scan all jobs
+        in the full rounds (the first one and after each full_scan_interval).
+        The done jobs are removed by the batches of remove_batch jobs with the limited rate.
+        The sleep between the rounds is interrupted by the watches of the deleted jobs.
     """
 
     def __init__(self, config):
         Application.__init__(self, "collector", config)
         self._processed = 0
+        self._full_scan_at = None
+        self._remove_at = 0
 
     def process(self):
         logger = get_logger()
@@ -41,24 +47,45 @@ class _Collector(Application):
                     logger.debug("No jobs in list, entering to sleep mode with interval  %f seconds...",
                                  self._app_config.empty_sleep)
                 sleep_mode = True
-                time.sleep(self._app_config.empty_sleep)
+                if backend.jobs_gc.wait_deleted(self._app_config.empty_sleep):
+                    logger.debug("Woken up by the deleted job")
 
     def _gc_jobs(self, backend):
         processed = 0
         self._write_collector_state(backend)
-        for (job_id, done) in backend.jobs_gc.get_jobs(self._app_config.done_lifetime):
+        full = (self._full_scan_at is None or time.time() - self._full_scan_at >= self._app_config.full_scan_interval)
+        if full:
+            self._full_scan_at = time.time()
+            get_logger().debug("Starting the full scan of the jobs...")
+        to_remove = []
+        for (job_id, done) in backend.jobs_gc.get_jobs(self._app_config.done_lifetime, full=full):
             logger = get_logger(job_id=job_id)
             logger.debug("Processing: done=%s", done)
             if done:
-                backend.jobs_gc.remove_job_data(job_id)
-                logger.info("Removed done job")
+                to_remove.append(job_id)
+                if len(to_remove) >= self._app_config.remove_batch:
+                    processed += self._remove_jobs(backend, to_remove)
+                    to_remove = []
             else:
                 backend.jobs_gc.push_back_job(job_id)
                 logger.info("Pushed-back unfinished job")
-            processed += 1
-            self._processed += 1
-            self._write_collector_state(backend)
+                processed += 1
+                self._processed += 1
+                self._write_collector_state(backend)
+        if len(to_remove) > 0:
+            processed += self._remove_jobs(backend, to_remove)
         return bool(processed)
 
+    def _remove_jobs(self, backend, job_ids):
+        if self._app_config.remove_rate > 0:
+            self._stop_event.wait(max(self._remove_at - time.time(), 0))
+            self._remove_at = max(self._remove_at, time.time()) + len(job_ids) / self._app_config.remove_rate
+        backend.jobs_gc.remove_jobs_data(job_ids)
+        for job_id in job_ids:
+            get_logger(job_id=job_id).info("Removed done job")
+        self._processed += len(job_ids)
+        self._write_collector_state(backend)
+        return len(job_ids)
+
     def _write_collector_state(self, backend):
         self.set_app_state(backend, {"processed": self._processed})
@@ -1,17 +1,26 @@
 import sys
 import os
 import multiprocessing
+import multiprocessing.connection
+import functools
+import resource
+import select
+import signal
 import time
 
 from contextlog import get_logger
 
 from .. import context
+from .. import imprules
+from .. import broker
 
 from . import init
 from . import Application
 
 
 # =====
+_KILL_TIMEOUT = 10  # Seconds before SIGKILL to the deleted job
+
 _stop = None
 
 
@@ -30,57 +39,142 @@ class _Worker(Application):
         This application performs the jobs. Each job runs in a separate process and
         has its own connection to the backend. It automatically saves the state of
         the job. Worker only ensures that the process must be stopped upon request.
+        With pool_size > 0, the jobs are passed to the pre-started and pre-connected
+        processes of the pool. With fork_servers > 0, the job processes are forked from
+        the per-HEAD servers with the imported rules. With broker=True, the job processes
+        (except the forked ones) send the backend calls to the worker and don't make
+        their own connections. With coop_jobs > 0, up to coop_jobs jobs of one HEAD are
+        running in one process and switch on the checkpoints and on the waits of
+        powny.core.sleep() and powny.core.wait_read().
+        The main loop waits for the exits of the job processes and for the watches of the input
+        queue and of the deleted jobs, the backends without watches are polled.
     """
 
     def __init__(self, config):
         Application.__init__(self, "worker", config)
-        self._manager = _JobsManager(self._config.core.rules_dir)
+        self._broker = (broker.Broker(self._app_config.broker_threads) if self._app_config.broker else None)
+        pool = None
+        if self._app_config.pool_size > 0:
+            pool = _Pool(
+                size=self._app_config.pool_size,
+                make_backend=(self._broker.make_client if self._broker is not None else self.get_backend_object),
+                max_jobs=self._app_config.pool_max_jobs,
+                max_rss=self._app_config.pool_max_rss,
+            )
+        self._manager = _JobsManager(
+            rules_dir=self._config.core.rules_dir,
+            max_deltas=self._app_config.checkpoint_deltas,
+            compact_ratio=self._app_config.checkpoint_compact_ratio,
+            pool=pool,
+            broker=self._broker,
+            fork_servers=self._app_config.fork_servers,
+            fork_server_idle=self._app_config.fork_server_idle,
+            coop_jobs=self._app_config.coop_jobs,
+        )
         self._not_started = 0
+        self._wakeup = _Wakeup()
+        self._last_state = None
+
+    def stop(self):
+        Application.stop(self)
+        self._wakeup.set()
 
     def process(self):
+        try:
+            self._process()
+        finally:
+            self._manager.close()
+
+    def _process(self):
+        with self.get_backend_object().connected() as backend:
+            if self._broker is not None:
+                self._broker.start(backend)
+            try:
+                self._process_jobs(backend)
+            finally:
+                if self._broker is not None:
+                    # The broker releases the jobs on stop(), so their processes must be dead
+                    # before that, otherwise the jobs will be running twice after the release.
+                    self._manager.kill_brokered()
+                    self._broker.stop()
+
+    def _process_jobs(self, backend):
         logger = get_logger()
+        input_watched = backend.jobs_process.watch_input(self._wakeup.set)
+        heartbeat_at = 0
         sleep_mode = False
-        with self.get_backend_object().connected() as backend:
-            while not self._stop_event.is_set():
-                gen_jobs = backend.jobs_process.get_ready_jobs()
-                while not self._stop_event.is_set():
-                    self._manager.manage(backend)
-                    self._write_worker_state(backend)
-
-                    if self._manager.get_current() >= self._app_config.max_jobs:
-                        logger.debug("Have reached the maximum concurrent jobs %(maxjobs)d,"
-                                     " sleeping %(delay)f seconds...",
-                                     {"maxjobs": self._app_config.max_jobs, "delay": self._app_config.max_jobs_sleep})
-                        time.sleep(self._app_config.max_jobs_sleep)
+        while not self._stop_event.is_set():
+            self._wakeup.clear()
+            heartbeat = (time.time() >= heartbeat_at)
+            if heartbeat:
+                heartbeat_at = time.time() + self._app_config.state_interval
+            self._manager.manage(backend, self._wakeup.set, check_deleted=heartbeat)
+            started = self._run_jobs(backend)
+            self._write_worker_state(backend, force=heartbeat)
 
+            full = (self._manager.get_current() >= self._app_config.max_jobs)
+            if full:
+                if not sleep_mode:
+                    logger.debug("Have reached the maximum concurrent jobs %(maxjobs)d, waiting for the exits...",
+                                 {"maxjobs": self._app_config.max_jobs})
+                timeout = self._app_config.max_jobs_sleep
+            else:
+                if not sleep_mode and started == 0:
+                    logger.debug("No jobs in queue, waiting for them...")
+                timeout = self._app_config.empty_sleep
+            sleep_mode = (full or started == 0)
+            if input_watched and self._manager.is_all_watched():
+                timeout = heartbeat_at - time.time()  # Nothing to poll
+            timeout = min(timeout, heartbeat_at - time.time(), self._manager.get_kill_timeout())
+            waitables = self._manager.get_waitables() + [self._wakeup]
+            multiprocessing.connection.wait(waitables, max(timeout, 0))
+
+    def _run_jobs(self, backend):
+        started = 0
+        if self._manager.get_current() < self._app_config.max_jobs:
+            gen_jobs = backend.jobs_process.get_ready_jobs()  # Doesn't wait for the new jobs
+            try:
+                for job in gen_jobs:
+                    if self._manager.run_job(job, self.get_backend_object()):
+                        started += 1
                     else:
-                        try:
-                            job = next(gen_jobs)
-                        except StopIteration:
-                            if not sleep_mode:
-                                logger.debug("No jobs in queue, sleeping for %(delay)f seconds...",
-                                             {"delay": self._app_config.empty_sleep})
-                            sleep_mode = True
-                            time.sleep(self._app_config.empty_sleep)
-                            break
-                        else:
-                            sleep_mode = False
-                            if not self._manager.run_job(job, self.get_backend_object()):
-                                backend.jobs_process.release_job(job.job_id)
-                                self._not_started += 1
-
-    def _write_worker_state(self, backend):
-        self.set_app_state(backend, {
+                        backend.jobs_process.release_job(job.job_id)
+                        self._not_started += 1
+                    if self._manager.get_current() >= self._app_config.max_jobs or self._stop_event.is_set():
+                        break
+            finally:
+                gen_jobs.close()  # Release the claimed jobs for the other workers
+        return started
+
+    def _write_worker_state(self, backend, force):
+        # The state is written on the changes, the heartbeat updates its time
+        state = {
             "active":      self._manager.get_current(),
             "processed":   self._manager.get_finished(),
             "not_started": self._not_started,
-        })
+        }
+        if force or state != self._last_state:
+            self.set_app_state(backend, state)
+            self._last_state = state
 
 
 class _JobsManager:
-    def __init__(self, rules_dir):
+    def __init__(self, rules_dir, max_deltas=0, compact_ratio=0.5, pool=None, broker=None,
+                 fork_servers=0, fork_server_idle=600, coop_jobs=0):
         self._rules_dir = rules_dir
-        self._procs = {}
+        self._checkpoint_opts = {"max_deltas": max_deltas, "compact_ratio": compact_ratio}
+        self._pool = pool
+        self._broker = broker
+        self._max_servers = fork_servers
+        self._server_idle = fork_server_idle
+        self._servers = {}  # head -> _ForkServer
+        self._retired = []  # The stopped servers waiting for their jobs
+        self._coop_jobs = coop_jobs
+        self._coops = []  # _CoopProcess
+        self._procs = {}  # job_id -> (method_name, proc, pool_proc or None)
+        self._watched = {}  # job_id -> jobs_process with the watch of the deletion
+        self._deleted = set()  # Set by the watches
+        self._killing = {}  # job_id -> the deadline of SIGTERM
         self._finished = 0
 
     def get_finished(self):
@@ -89,61 +183,770 @@ class _JobsManager:
     def get_current(self):
         return len(self._procs)
 
+    def get_kill_timeout(self):
+        # Seconds before the next SIGKILL
+        return max(min(self._killing.values(), default=float("inf")) - time.time(), 0)
+
+    def is_all_watched(self):
+        # The deletions and the exits of all jobs wake up the main loop, so nothing has to be polled
+        return (len(self._watched) == len(self._procs) == len(self.get_waitables()))
+
+    def get_waitables(self):
+        # The objects for multiprocessing.connection.wait() which are ready on the exits of the jobs.
+        # The closed pipes are skipped (wait() fails on them), these jobs are reaped by the polling.
+        waitables = [
+            (pool_proc.sentinel if pool_proc is not None else proc.sentinel)
+            for (_, proc, pool_proc) in self._procs.values()
+        ]
+        return [
+            waitable
+            for waitable in waitables
+            if waitable is not None and not getattr(waitable, "closed", False)
+        ]
+
     def run_job(self, job, backend):
         logger = get_logger(job_id=job.job_id, method=job.method_name)
+        coop = self._get_coop_process(job.head, backend)
+        if coop is not None:
+            logger.info("Passing the job to the cooperative process %(pid)d", {"pid": coop.proc.pid})
+            proc = _CoopJob(coop, job.job_id)
+            self._procs[job.job_id] = (job.method_name, proc, None)
+            if not coop.start_job(job, 1):
+                logger.error("Cannot associate job after one second")
+                self._kill(proc, job.job_id)
+                return False
+            return True
+
+        server = self._get_fork_server(job.head, backend)
+        if server is not None:
+            (proc, associated) = server.fork_job(job, 2)
+            if proc is not None:
+                logger.info("Forked job process %(pid)d from the server of HEAD %(head)s",
+                            {"pid": proc.pid, "head": job.head})
+                self._procs[job.job_id] = (job.method_name, proc, None)
+                if not associated:
+                    logger.error("Cannot associate job after one second")
+                    self._kill(proc, job.job_id)
+                    return False
+                return True
+
+        pool_proc = (self._pool.take() if self._pool is not None else None)
+        if pool_proc is not None:
+            logger.info("Passing the job to the pool process %(pid)d", {"pid": pool_proc.proc.pid})
+            self._procs[job.job_id] = (job.method_name, pool_proc.proc, pool_proc)
+            if not pool_proc.start_job(job, self._rules_dir, self._checkpoint_opts, 1):
+                logger.error("Cannot associate job after one second")
+                self._kill(pool_proc.proc, job.job_id)
+                return False
+            return True
+
         logger.info("Starting the job process")
+        if self._broker is not None:
+            backend = self._broker.make_client()
         associated = multiprocessing.Event()
-        proc = multiprocessing.Process(target=_exec_job, args=(job, self._rules_dir, backend, associated))
-        self._procs[job.job_id] = (job.method_name, proc)
+        proc = multiprocessing.Process(
+            target=_exec_job,
+            args=(job, self._rules_dir, backend, associated, self._checkpoint_opts),
+        )
+        self._procs[job.job_id] = (job.method_name, proc, None)
         proc.start()
+        _detach_backend(backend)
         if not associated.wait(1):
             logger.error("Cannot associate job after one second")
-            self._kill(proc)
+            self._kill(proc, job.job_id)
             return False
         return True
 
-    def manage(self, backend):
-        for (job_id, (method_name, proc)) in self._procs.copy().items():
+    def manage(self, backend, wakeup, check_deleted=False):
+        """
+            Reaps the finished jobs and kills the deleted ones without waiting. The deleted jobs are
+            found by the watches (the wakeup is called on the event), the backend without watches
+            is polled. With check_deleted=True, all jobs are polled in case of the lost watches.
+        """
+
+        for (job_id, (method_name, proc, pool_proc)) in self._procs.copy().items():
             logger = get_logger(job_id=job_id, method=method_name)
-            if not proc.is_alive():
+            if pool_proc is not None and pool_proc.is_job_done():
+                logger.info("Finished job in the pool process %(pid)d", {"pid": proc.pid})
+                self._finish(job_id)
+                self._pool.put_back(pool_proc)
+            elif not proc.is_alive():
                 logger.info("Finished job process %(pid)d with retcode %(retcode)d",
                             {"pid": proc.pid, "retcode": proc.exitcode})
                 self._finish(job_id)
-            elif backend.jobs_process.is_deleted_job(job_id):
-                self._kill(proc)
-                self._finish(job_id)
+                if pool_proc is not None:
+                    self._pool.put_back(pool_proc)
+            elif job_id in self._killing:
+                if time.time() >= self._killing[job_id]:
+                    logger.warning("The job process %(pid)d is still alive, sending SIGKILL", {"pid": proc.pid})
+                    proc.kill()
+                    self._killing[job_id] = float("inf")
+            elif self._is_deleted(backend, job_id, wakeup, check_deleted):
+                self._kill(proc, job_id)
+        if self._pool is not None:
+            self._pool.fill()
+        self._retire_fork_servers()
+        self._retire_coop_processes()
+
+    def kill_brokered(self):
+        """
+            Kills the job processes which use the broker and waits for their exits (SIGKILL is sent
+            after _KILL_TIMEOUT seconds). The forked processes have their own connections and are
+            not affected. The killed jobs are continued by the workers from the last checkpoint.
+        """
+
+        procs = {}  # job_id -> multiprocessing.Process
+        for (job_id, (_, proc, pool_proc)) in self._procs.items():
+            if isinstance(proc, _CoopJob):
+                procs[job_id] = proc.coop.proc
+            elif not isinstance(proc, _ForkedProcess):
+                procs[job_id] = proc
+        for proc in set(procs.values()):
+            get_logger().info("Killing job process %(pid)d which uses the broker...", {"pid": proc.pid})
+            proc.terminate()
+        deadline = time.time() + _KILL_TIMEOUT
+        for proc in set(procs.values()):
+            proc.join(max(deadline - time.time(), 0))
+            if proc.is_alive():
+                get_logger().warning("The job process %(pid)d is still alive, sending SIGKILL", {"pid": proc.pid})
+                proc.kill()
+                proc.join()
+        for job_id in procs:
+            pool_proc = self._procs[job_id][2]
+            self._finish(job_id)
+            if pool_proc is not None:
+                self._pool.put_back(pool_proc)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+        for server in self._servers.values():
+            server.stop()
+        self._servers = {}
+        for coop in self._coops:
+            coop.stop()
+        self._coops = []
+
+    def _get_fork_server(self, head, backend):
+        # Returns the ready server or None; a new server imports the rules in background
+        if self._max_servers <= 0:
+            return None
+        server = self._servers.get(head)
+        if server is None or not server.is_alive():
+            get_logger().info("Starting the fork server for HEAD %(head)s", {"head": head})
+            self._servers[head] = _ForkServer(head, self._rules_dir, backend, self._checkpoint_opts)
+            return None
+        server.used = time.time()
+        return (server if server.is_ready() else None)
+
+    def _retire_fork_servers(self):
+        # The server of the stale HEAD doesn't get new jobs, so it will be stopped after fork_server_idle seconds
+        by_usage = sorted(self._servers.values(), key=(lambda server: server.used), reverse=True)
+        for (number, server) in enumerate(by_usage):
+            if number >= self._max_servers or time.time() - server.used >= self._server_idle or not server.is_alive():
+                get_logger().info("Retiring the fork server for HEAD %(head)s", {"head": server.head})
+                self._servers.pop(server.head)
+                server.stop()
+                self._retired.append(server)
+        for server in self._retired:
+            server.poll()
+        self._retired = [server for server in self._retired if server.is_alive()]
+
+    def _get_coop_process(self, head, backend):
+        if self._coop_jobs <= 0:
+            return None
+        for coop in self._coops:
+            if coop.can_take(head):
+                return coop
+        if self._broker is not None:
+            backend = self._broker.make_client()
+        coop = _CoopProcess(backend, self._rules_dir, self._checkpoint_opts, self._coop_jobs)
+        self._coops.append(coop)
+        return coop
+
+    def _retire_coop_processes(self):
+        # Only one idle process is kept
+        idle = False
+        for coop in list(self._coops):
+            coop.poll()
+            if not coop.is_alive():
+                self._coops.remove(coop)
+            elif coop.get_jobs_count() == 0:
+                if idle:
+                    coop.stop()
+                    self._coops.remove(coop)
+                idle = True
+
+    def _is_deleted(self, backend, job_id, wakeup, check_deleted):
+        if job_id in self._deleted:
+            return True
+        if self._watched.get(job_id) is not backend.jobs_process:  # Not watched or watched before the reconnection
+            self._watched[job_id] = backend.jobs_process  # The callback may be called immediately
+            if backend.jobs_process.watch_deleted_job(job_id, functools.partial(self._on_deleted, job_id, wakeup)):
+                return (job_id in self._deleted)
+            self._watched.pop(job_id)
+        elif not check_deleted:
+            return False
+        return backend.jobs_process.is_deleted_job(job_id)
+
+    def _on_deleted(self, job_id, wakeup):
+        # Called from the thread of the backend, does nothing for the finished job
+        if job_id in self._watched:
+            self._deleted.add(job_id)
+            wakeup()
 
     def _finish(self, job_id):
         self._procs.pop(job_id)
+        jobs_process = self._watched.pop(job_id, None)
+        if jobs_process is not None:
+            jobs_process.unwatch_deleted_job(job_id)
+        self._deleted.discard(job_id)
+        self._killing.pop(job_id, None)
         self._finished += 1
 
-    def _kill(self, proc):
+    def _kill(self, proc, job_id):
+        # The process is reaped by manage(), SIGKILL is sent after _KILL_TIMEOUT seconds
         logger = get_logger()
         logger.info("Killing job process %(pid)d...", {"pid": proc.pid})
         try:
             proc.terminate()
-            proc.join()
         except Exception:
             logger.exception("Can't kill process %(pid)d; ignored", {"pid": proc.pid})
-            return
-        logger.info("Killed job process %(pid)d with retcode %(exitcode)d",
-                    {"pid": proc.pid, "exitcode": proc.exitcode})
+        self._killing[job_id] = time.time() + _KILL_TIMEOUT
+
+
+class _Wakeup:
+    """ The self-pipe for multiprocessing.connection.wait(), set() can be called from any thread """
+
+    def __init__(self):
+        (self._read_fd, self._write_fd) = os.pipe()
+        os.set_blocking(self._read_fd, False)
+        os.set_blocking(self._write_fd, False)
+
+    def fileno(self):
+        return self._read_fd
+
+    def set(self):
+        try:
+            os.write(self._write_fd, b"\0")
+        except BlockingIOError:
+            pass  # Already set
 
+    def clear(self):
+        try:
+            while len(os.read(self._read_fd, 4096)) > 0:
+                pass
+        except BlockingIOError:
+            pass
+
+
+# =====
+def _exec_job(job, rules_dir, backend, associated, checkpoint_opts):
+    with backend.connected():
+        _run_job(job, rules_dir, backend, associated.set, checkpoint_opts)
 
-def _exec_job(job, rules_dir, backend, associated):
+
+def _detach_backend(backend):
+    # The parent must close its end of the broker pipe to see the exit of the job process
+    if isinstance(backend, broker.Client):
+        backend.detach()
+
+
+def _run_job(job, rules_dir, backend, on_associated, checkpoint_opts):
     logger = get_logger(job_id=job.job_id, method=job.method_name)
     rules_path = os.path.join(rules_dir, job.head)
-    with backend.connected():
-        logger.debug("Associating job with PID %(pid)d", {"pid": os.getpid()})
-        backend.jobs_process.associate_job(job.job_id)
-        associated.set()
-
-        sys.path.insert(0, rules_path)
-        thread = context.JobThread(
-            backend=backend,
-            job_id=job.job_id,
-            state=job.state,
-            extra={"request": job.request, "head": job.head},
-        )
+    logger.debug("Associating job with PID %(pid)d", {"pid": os.getpid()})
+    backend.jobs_process.associate_job(job.job_id)
+    on_associated()
+
+    sys.path.insert(0, rules_path)
+    try:
+        thread = _make_job_thread(job, backend, checkpoint_opts)
         thread.start()
         thread.join()
+    finally:
+        _unload_rules(rules_path)
+
+
+def _make_job_thread(job, backend, checkpoint_opts):
+    return context.JobThread(
+        backend=backend,
+        job_id=job.job_id,
+        state=job.state,
+        extra={"request": job.request, "head": job.head},
+        **checkpoint_opts
+    )
+
+
+def _unload_rules(rules_path):
+    # The process may be reused for the job with another HEAD, so the modules of the rules are unloaded
+    sys.path.remove(rules_path)
+    for (name, module) in list(sys.modules.items()):
+        if (getattr(module, "__file__", None) or "").startswith(rules_path + os.sep):
+            sys.modules.pop(name)
+
+
+# =====
+class _Pool:
+    """
+        The pool of the warm job processes: they are started and connected to the backend
+        in advance and get the jobs over the pipes. A process is recycled after max_jobs jobs
+        or when its peak RSS exceeds max_rss megabytes (zero disables the limits).
+        The size limits the idle and the busy processes together. If there is no ready process,
+        the manager starts a separate one for the job. Each taken process must be put back.
+    """
+
+    def __init__(self, size, make_backend, max_jobs=0, max_rss=0):
+        self._size = size
+        self._make_backend = make_backend
+        self._max_jobs = max_jobs
+        self._max_rss = max_rss
+        self._idle = []
+        self._busy = set()
+
+    def fill(self):
+        self._idle = [pool_proc for pool_proc in self._idle if pool_proc.proc.is_alive()]
+        while len(self._idle) + len(self._busy) < self._size:
+            self._idle.append(_PoolProcess(self._make_backend(), self._max_jobs, self._max_rss))
+
+    def take(self):
+        for pool_proc in self._idle:
+            if pool_proc.is_ready():
+                self._idle.remove(pool_proc)
+                self._busy.add(pool_proc)
+                return pool_proc
+        return None
+
+    def put_back(self, pool_proc):
+        # The process which has failed or has been killed with the job is stopped and replaced by fill()
+        self._busy.remove(pool_proc)
+        if pool_proc.is_job_done() and not pool_proc.is_recycled() and pool_proc.proc.is_alive():
+            self._idle.append(pool_proc)
+        else:
+            pool_proc.stop()
+
+    def close(self):
+        for pool_proc in self._idle:
+            pool_proc.stop()
+        self._idle = []
+
+
+class _PoolProcess:
+    def __init__(self, backend, max_jobs, max_rss):
+        (self._conn, child_conn) = multiprocessing.Pipe()
+        self.proc = multiprocessing.Process(
+            target=_run_pool_process,
+            args=(child_conn, backend, max_jobs, max_rss),
+        )
+        self.proc.start()
+        child_conn.close()
+        _detach_backend(backend)
+        self.sentinel = self._conn  # Ready on the messages and on the exit
+        self._ready = False
+        self._done = False
+        self._recycled = False
+
+    def is_ready(self):
+        # The process sends "ready" after the connection to the backend
+        if not self._ready:
+            self._ready = (self._receive() == ("ready", None))
+        return self._ready
+
+    def start_job(self, job, rules_dir, checkpoint_opts, timeout):
+        self._done = False
+        try:
+            self._conn.send((job, rules_dir, checkpoint_opts))
+        except OSError:
+            return False
+        return (self._receive(timeout) == ("associated", job.job_id))
+
+    def is_job_done(self):
+        if not self._done:
+            message = self._receive()
+            if message is not None and message[0] == "done":
+                (self._done, self._recycled) = (True, message[1])
+        return self._done
+
+    def is_recycled(self):
+        return self._recycled
+
+    def stop(self):
+        try:
+            self._conn.send(None)
+        except OSError:
+            pass
+        self._conn.close()
+
+    def _receive(self, timeout=0):
+        try:
+            if self._conn.poll(timeout):
+                return self._conn.recv()
+        except (EOFError, OSError):
+            pass
+        return None
+
+
+class _ForkServer:
+    """
+        The process with the imported rules of one HEAD. The job processes are forked from it,
+        so they share the modules copy-on-write. The server is not connected to the backend,
+        each job process makes its own connection. The server reports the exit codes of its
+        children and exits after stop() when all of them are finished.
+    """
+
+    def __init__(self, head, rules_dir, backend, checkpoint_opts):
+        self.head = head
+        self.used = time.time()
+        (self._conn, child_conn) = multiprocessing.Pipe()
+        self.proc = multiprocessing.Process(
+            target=_run_fork_server,
+            args=(child_conn, head, rules_dir, backend, checkpoint_opts),
+        )
+        self.proc.start()
+        child_conn.close()
+        self.sentinel = self._conn
+        self._ready = False
+        self._stopped = False
+        self._exited = {}  # pid -> retcode
+
+    def is_alive(self):
+        return self.proc.is_alive()
+
+    def is_ready(self):
+        self.poll()
+        return (self._ready and not self._stopped)
+
+    def fork_job(self, job, timeout):
+        # Returns (proc, associated) or (None, False) if the server is not available
+        try:
+            self._conn.send(job)
+        except OSError:
+            return (None, False)
+        deadline = time.time() + timeout
+        while True:
+            message = self._receive(max(deadline - time.time(), 0))
+            if message is None:
+                return (None, False)
+            if message[0] == "started":
+                (job_id, pid, associated) = message[1]
+                assert job_id == job.job_id
+                return (_ForkedProcess(self, pid), associated)
+
+    def poll(self):
+        while self._receive() is not None:
+            pass
+
+    def get_exitcode(self, pid):
+        self.poll()
+        return self._exited.get(pid)
+
+    def stop(self):
+        if not self._stopped:
+            self._stopped = True
+            try:
+                self._conn.send(None)
+            except OSError:
+                pass
+
+    def _receive(self, timeout=0):
+        try:
+            if self._conn.poll(timeout):
+                message = self._conn.recv()
+                if message[0] == "ready":
+                    self._ready = True
+                elif message[0] == "exited":
+                    (pid, retcode) = message[1]
+                    self._exited[pid] = retcode
+                return message
+        except (EOFError, OSError):
+            pass
+        return None
+
+
+class _ForkedProcess:
+    # The same interface as multiprocessing.Process for _JobsManager
+
+    def __init__(self, server, pid):
+        self._server = server
+        self.pid = pid
+
+    @property
+    def exitcode(self):
+        return self._server.get_exitcode(self.pid)
+
+    def is_alive(self):
+        if self.exitcode is not None:
+            return False
+        if not self._server.is_alive() and self._server.get_exitcode(self.pid) is None:
+            # The server was killed and can't report the exit code
+            try:
+                os.kill(self.pid, 0)
+            except ProcessLookupError:
+                return False
+        return True
+
+    @property
+    def sentinel(self):
+        return (self._server.sentinel if self._server.is_alive() else None)
+
+    def terminate(self):
+        self._send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self._send_signal(signal.SIGKILL)
+
+    def _send_signal(self, signum):
+        try:
+            os.kill(self.pid, signum)
+        except ProcessLookupError:
+            pass
+
+
+def _run_fork_server(conn, head, rules_dir, backend, checkpoint_opts):
+    logger = get_logger(head=head)
+    imprules.Loader(prefix=rules_dir).get_exposed(head)
+    logger.info("Loaded the rules of HEAD %(head)s into the fork server", {"head": head})
+    conn.send(("ready", None))
+    parent_pid = os.getppid()
+    children = set()
+    stopped = False
+    while not stopped or len(children) > 0:
+        for pid in list(children):
+            (exited_pid, status) = os.waitpid(pid, os.WNOHANG)
+            if exited_pid != 0:
+                children.remove(pid)
+                retcode = (os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status))
+                _send_quietly(conn, ("exited", (pid, retcode)))
+
+        if stopped or os.getppid() != parent_pid:
+            stopped = True
+            time.sleep(0.1)
+            continue
+        try:
+            if not conn.poll(0.1):
+                continue
+            job = conn.recv()
+        except EOFError:
+            stopped = True
+            continue
+        if job is None:
+            stopped = True
+            continue
+        (pid, associated) = _fork_job(conn, job, rules_dir, backend, checkpoint_opts)
+        children.add(pid)
+        conn.send(("started", (job.job_id, pid, associated)))
+
+
+def _fork_job(conn, job, rules_dir, backend, checkpoint_opts):
+    (read_fd, write_fd) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        retcode = 1
+        try:
+            conn.close()
+            os.close(read_fd)
+            with backend.connected():
+                _run_job(job, rules_dir, backend, (lambda: os.write(write_fd, b"1")), checkpoint_opts)
+            retcode = 0
+        except Exception:
+            get_logger(job_id=job.job_id).exception("Unhandled exception in the forked job process")
+        finally:
+            os._exit(retcode)  # pylint: disable=protected-access
+    os.close(write_fd)
+    try:
+        associated = (len(select.select([read_fd], [], [], 1)[0]) > 0 and os.read(read_fd, 1) == b"1")
+    finally:
+        os.close(read_fd)
+    return (pid, associated)
+
+
+def _send_quietly(conn, message):
+    try:
+        conn.send(message)
+    except OSError:
+        pass
+
+
+def _run_pool_process(conn, backend, max_jobs, max_rss):
+    parent_pid = os.getppid()
+    jobs = 0
+    with backend.connected():
+        conn.send(("ready", None))
+        while True:
+            try:
+                while not conn.poll(1):
+                    if os.getppid() != parent_pid:
+                        return  # The worker is dead
+                message = conn.recv()
+            except EOFError:
+                return
+            if message is None:
+                return
+            (job, rules_dir, checkpoint_opts) = message
+            _run_job(job, rules_dir, backend, (lambda: conn.send(("associated", job.job_id))), checkpoint_opts)
+            jobs += 1
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024  # Kilobytes on Linux
+            recycled = ((max_jobs > 0 and jobs >= max_jobs) or (max_rss > 0 and rss >= max_rss))
+            conn.send(("done", recycled))
+            if recycled:
+                return
+
+
+# =====
+class _CoopProcess:
+    """
+        The process which runs up to max_jobs jobs of one HEAD by context.Scheduler.
+        The HEAD is changed when the process has no jobs. The deleted job is cancelled;
+        if it's still running after _KILL_TIMEOUT seconds, the whole process is killed.
+    """
+
+    def __init__(self, backend, rules_dir, checkpoint_opts, max_jobs):
+        (self._conn, child_conn) = multiprocessing.Pipe()
+        self.proc = multiprocessing.Process(
+            target=_run_coop_process,
+            args=(child_conn, backend, rules_dir, checkpoint_opts),
+        )
+        self.proc.start()
+        child_conn.close()
+        _detach_backend(backend)
+        self.sentinel = self._conn
+        self._max_jobs = max_jobs
+        self._head = None
+        self._jobs = set()
+        self._stopped = False
+
+    def is_alive(self):
+        return self.proc.is_alive()
+
+    def can_take(self, head):
+        self.poll()
+        return (
+            not self._stopped and self.is_alive() and len(self._jobs) < self._max_jobs
+            and (len(self._jobs) == 0 or self._head == head)
+        )
+
+    def get_jobs_count(self):
+        return len(self._jobs)
+
+    def start_job(self, job, timeout):
+        self._head = job.head
+        self._jobs.add(job.job_id)
+        try:
+            self._conn.send(("job", job))
+        except OSError:
+            return False
+        deadline = time.time() + timeout
+        while True:
+            message = self._receive(max(deadline - time.time(), 0))
+            if message is None:
+                return False
+            if message == ("associated", job.job_id):
+                return True
+
+    def has_job(self, job_id):
+        self.poll()
+        return (job_id in self._jobs and self.is_alive())
+
+    def cancel(self, job_id):
+        _send_quietly(self._conn, ("cancel", job_id))
+
+    def poll(self):
+        while self._receive() is not None:
+            pass
+
+    def stop(self):
+        if not self._stopped:
+            self._stopped = True
+            _send_quietly(self._conn, None)
+
+    def _receive(self, timeout=0):
+        try:
+            if self._conn.poll(timeout):
+                message = self._conn.recv()
+                if message[0] == "done":
+                    self._jobs.discard(message[1])
+                return message
+        except (EOFError, OSError):
+            pass
+        return None
+
+
+class _CoopJob:
+    # The same interface as multiprocessing.Process for _JobsManager
+
+    def __init__(self, coop, job_id):
+        self.coop = coop
+        self._job_id = job_id
+        self.pid = coop.proc.pid
+
+    @property
+    def exitcode(self):
+        if self.is_alive():
+            return None
+        return (self.coop.proc.exitcode or 0)
+
+    def is_alive(self):
+        return self.coop.has_job(self._job_id)
+
+    @property
+    def sentinel(self):
+        return self.coop.sentinel
+
+    def terminate(self):
+        self.coop.cancel(self._job_id)
+
+    def kill(self):
+        # The job which blocks the process ignores the cancel, so the whole process is killed.
+        # Its other jobs are released with its connection and continued from the last checkpoints.
+        self.coop.proc.kill()
+
+
+def _run_coop_process(conn, backend, rules_dir, checkpoint_opts):
+    logger = get_logger()
+    parent_pid = os.getppid()
+    scheduler = context.Scheduler()
+    rules_path = None
+    stopped = False
+    with backend.connected():
+        while not stopped or scheduler.get_jobs_count() > 0:
+            if os.getppid() != parent_pid:
+                stopped = True  # The worker is dead, finishing the current jobs
+            (finished, ready) = scheduler.run_once(1, ([] if stopped else [conn]))
+            for job_id in finished:
+                _send_quietly(conn, ("done", job_id))
+            if len(ready) == 0:
+                continue
+            try:
+                message = conn.recv()
+            except EOFError:
+                stopped = True
+                continue
+            if message is None:
+                stopped = True
+                continue
+
+            (command, arg) = message
+            if command == "cancel":
+                scheduler.cancel(arg)
+                try:
+                    backend.jobs_process.release_job(arg)
+                except Exception:
+                    logger.exception("Can't release the cancelled job %(job_id)s", {"job_id": arg})
+                _send_quietly(conn, ("done", arg))
+
+            elif command == "job":
+                job = arg
+                job_rules_path = os.path.join(rules_dir, job.head)
+                if job_rules_path != rules_path:
+                    assert scheduler.get_jobs_count() == 0, "The HEAD can't be changed with the running jobs"
+                    if rules_path is not None:
+                        _unload_rules(rules_path)
+                    rules_path = job_rules_path
+                    sys.path.insert(0, rules_path)
+                try:
+                    backend.jobs_process.associate_job(job.job_id)
+                except Exception:
+                    logger.exception("Can't associate the job %(job_id)s", {"job_id": job.job_id})
+                    continue
+                conn.send(("associated", job.job_id))
+                scheduler.add(_make_job_thread(job, backend, checkpoint_opts))
@@ -12,6 +12,14 @@ class DeleteTimeoutError(Exception):
     pass
 
 
+class PartialAddError(Exception):
+    """ Only some of the jobs have been added, the added attribute contains their ids """
+
+    def __init__(self, msg, added):
+        super().__init__(msg)
+        self.added = added
+
+
 JobState = collections.namedtuple("JobState", (
     "head",
     "method_name",
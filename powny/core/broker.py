@@ -0,0 +1,197 @@
+import threading
+import contextlib
+import concurrent.futures
+import pickle
+import multiprocessing
+import multiprocessing.connection
+
+from contextlog import get_logger
+
+
+# =====
+_IFACES = ("jobs_process", "cas_storage")
+
+
+# =====
+class Broker:
+    """
+        Serves the calls of jobs_process and cas_storage from the job processes with the one
+        connection of the worker to the backend. Each job process gets its own pipe by make_client().
+        The job locks are owned by the session of the worker, so the broker releases the lock
+        of the job if its process has exited without done_job(). The calls are received by one thread
+        and executed concurrently by up to threads threads, so the round trips of the different job
+        processes to the backend are overlapped; the responses are matched by the call ids.
+        After stop(), the running jobs are released and continued by the other workers from the last state.
+    """
+
+    def __init__(self, threads=8):
+        self._threads = threads
+        self._backend = None
+        self._executor = None
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._conns = {}  # conn -> set of the associated jobs
+        (self._wakeup_read, self._wakeup_write) = multiprocessing.Pipe(duplex=False)
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self, backend):
+        assert self._thread is None, "The broker is already started"
+        self._backend = backend
+        self._executor = concurrent.futures.ThreadPoolExecutor(self._threads)
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._serve, name="broker", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop_event.set()
+            self._wakeup_write.send(None)
+            self._thread.join()
+            self._thread = None
+            self._executor.shutdown(wait=True)  # Waits for the running calls
+            self._executor = None
+            with self._lock:
+                for conn in list(self._conns):
+                    self._drop(conn)
+
+    def make_client(self):
+        (conn, client_conn) = multiprocessing.Pipe()
+        with self._lock:
+            self._conns[conn] = set()
+        self._wakeup_write.send(None)
+        return Client(client_conn)
+
+    def get_clients_count(self):
+        with self._lock:
+            return len(self._conns)
+
+    def _serve(self):
+        logger = get_logger()
+        logger.info("Broker started")
+        while not self._stop_event.is_set():
+            with self._lock:
+                conns = list(self._conns)
+            for conn in multiprocessing.connection.wait(conns + [self._wakeup_read], timeout=1):
+                if conn is self._wakeup_read:
+                    conn.recv()
+                    continue
+                try:
+                    (call_id, iface_name, method_name, args, kwargs) = conn.recv()
+                except (EOFError, OSError):
+                    with self._lock:
+                        self._drop(conn)
+                    continue
+                except Exception:
+                    logger.exception("Can't receive the call from the job process, dropping it")
+                    with self._lock:
+                        self._drop(conn)
+                    continue
+                self._executor.submit(self._serve_call, conn, call_id, iface_name, method_name, args, kwargs)
+        logger.info("Broker stopped")
+
+    def _serve_call(self, conn, call_id, iface_name, method_name, args, kwargs):
+        (status, result) = self._call(conn, iface_name, method_name, args, kwargs)
+        try:
+            with self._send_lock:
+                try:
+                    conn.send((call_id, status, result))
+                except (pickle.PicklingError, TypeError, AttributeError):
+                    conn.send((call_id, "error", RuntimeError("Unpicklable result: {!r}".format(result))))
+        except OSError:
+            with self._lock:
+                self._drop(conn)
+        except Exception:
+            # The client would wait for the response forever, so it's disconnected
+            get_logger().exception("Can't send the response to the job process, dropping it")
+            with self._lock:
+                self._drop(conn)
+
+    def _call(self, conn, iface_name, method_name, args, kwargs):
+        try:
+            if iface_name not in _IFACES or method_name.startswith("_"):
+                raise AttributeError("Can't call {}.{}() through the broker".format(iface_name, method_name))
+            result = getattr(getattr(self._backend, iface_name), method_name)(*args, **kwargs)
+            if iface_name == "jobs_process":
+                job_id = kwargs.get("job_id", (args[0] if len(args) > 0 else None))
+                with self._lock:
+                    jobs = self._conns.get(conn)
+                    if jobs is not None:
+                        if method_name == "associate_job":
+                            jobs.add(job_id)
+                        elif method_name in ("done_job", "release_job"):
+                            jobs.discard(job_id)
+                if jobs is None and method_name == "associate_job":
+                    # The process has exited during the call, so nobody else will release the job
+                    self._backend.jobs_process.release_job(job_id)
+            return ("ok", result)
+        except Exception as err:
+            return ("error", err)
+
+    def _drop(self, conn):
+        for job_id in self._conns.pop(conn, ()):
+            logger = get_logger(job_id=job_id)
+            logger.info("The job process has exited without done_job(), releasing the job")
+            try:
+                self._backend.jobs_process.release_job(job_id)
+            except Exception:
+                logger.exception("Can't release the job; ignored")
+        conn.close()
+
+
+class Client:
+    """
+        The backend for the job process which sends the calls to the broker of the worker.
+        Only jobs_process and cas_storage are available.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._send_lock = threading.Lock()
+        self._recv_lock = threading.Lock()
+        self._last_id = 0
+        self._responses = {}  # call_id -> (status, result) received by the other threads
+        self.jobs_process = _Proxy(self, "jobs_process")
+        self.cas_storage = _Proxy(self, "cas_storage")
+
+    @contextlib.contextmanager
+    def connected(self):
+        yield self
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def is_connected(self):
+        return (not self._conn.closed)
+
+    def detach(self):
+        # Called by the worker after the start of the job process
+        self._conn.close()
+
+    def call(self, iface_name, method_name, args, kwargs):
+        with self._send_lock:
+            self._last_id += 1
+            call_id = self._last_id
+            self._conn.send((call_id, iface_name, method_name, args, kwargs))
+        with self._recv_lock:
+            while call_id not in self._responses:
+                (response_id, status, result) = self._conn.recv()
+                self._responses[response_id] = (status, result)
+            (status, result) = self._responses.pop(call_id)
+        if status == "error":
+            raise result
+        return result
+
+
+class _Proxy:
+    def __init__(self, client, iface_name):
+        self._client = client
+        self._iface_name = iface_name
+
+    def __getattr__(self, method_name):
+        if method_name.startswith("_"):
+            raise AttributeError(method_name)
+        return (lambda *args, **kwargs: self._client.call(self._iface_name, method_name, args, kwargs))
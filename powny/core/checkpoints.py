@@ -0,0 +1,187 @@
+import zlib
+import collections
+
+
+# =====
+class CheckpointError(Exception):
+    pass
+
+
+IncrementalState = collections.namedtuple("IncrementalState", (
+    "base",      # The full snapshot (bytes); the backend can store it separately and return None here
+    "deltas",    # The chain of the deltas: each one is made against the previous snapshot
+    "checksum",  # CRC-32 of the last snapshot
+))
+
+
+_BLOCK_SIZE = 64
+_COPY_OP_SIZE = 16  # Approximate size of the pickled copy operation
+_HASH_MODULUS = (1 << 30) - 35  # The largest prime in one digit of the CPython int for the rolling hash
+_ROLLING_HASH_MIN_BLOCK = 512  # The shorter blocks are sliced at each position, it's faster than the arithmetic
+
+
+# =====
+def make_delta(old, new, block_size=_BLOCK_SIZE):
+    """
+        Makes the binary delta between two snapshots: a tuple of the operations, where the bytes
+        are the literal data and the (offset, length) pairs are copies from the old snapshot.
+        The common prefix and suffix are found first, the middle part is matched by the blocks
+        of the old snapshot. The large blocks are found with the rolling hash, so each position
+        of the new one costs O(1); the short ones are looked up by the slices.
+    """
+
+    prefix = _get_common_prefix(old, new)
+    suffix = _get_common_prefix(old[prefix:][::-1], new[prefix:][::-1])
+    ops = []
+    if prefix > 0:
+        ops.append((0, prefix))
+    _make_middle_delta(old, new, prefix, len(new) - suffix, block_size, ops)
+    if suffix > 0:
+        _append_copy(ops, len(old) - suffix, suffix)
+    return tuple(ops)
+
+
+def apply_delta(old, delta):
+    return b"".join(
+        (op if isinstance(op, bytes) else old[op[0]:op[0] + op[1]])
+        for op in delta
+    )
+
+
+def get_delta_size(delta):
+    return sum((len(op) if isinstance(op, bytes) else _COPY_OP_SIZE) for op in delta)
+
+
+def restore_data(state):
+    """ Returns the last snapshot for the incremental state or the state itself for the full one """
+
+    if not isinstance(state, IncrementalState):
+        return state
+    if state.base is None:
+        raise CheckpointError("The base snapshot is missing")
+    data = state.base
+    for delta in state.deltas:
+        data = apply_delta(data, delta)
+    if zlib.crc32(data) != state.checksum:
+        raise CheckpointError("Invalid checksum of the restored snapshot")
+    return data
+
+
+class Checkpointer:
+    """
+        Makes the incremental states from the sequential snapshots of the job. A new base is written
+        instead of the delta (compaction) when the chain has max_deltas items or the deltas
+        are larger than compact_ratio of the base.
+    """
+
+    def __init__(self, state, max_deltas, compact_ratio):
+        self._max_deltas = max_deltas
+        self._compact_ratio = compact_ratio
+        self._state = (state if isinstance(state, IncrementalState) else None)
+        self._deltas_size = (sum(map(get_delta_size, self._state.deltas)) if self._state is not None else 0)
+        self._data = restore_data(state)
+
+    def get_data(self):
+        return self._data
+
+    def make_state(self, data):
+        if self._state is not None and len(self._state.deltas) < self._max_deltas:
+            delta = make_delta(self._data, data)
+            deltas_size = self._deltas_size + get_delta_size(delta)
+            if deltas_size <= len(self._state.base) * self._compact_ratio:
+                self._state = IncrementalState(
+                    base=self._state.base,
+                    deltas=self._state.deltas + (delta,),
+                    checksum=zlib.crc32(data),
+                )
+                self._deltas_size = deltas_size
+                self._data = data
+                return self._state
+        self._state = IncrementalState(base=data, deltas=(), checksum=zlib.crc32(data))
+        self._deltas_size = 0
+        self._data = data
+        return self._state
+
+
+# =====
+def _get_common_prefix(old, new):
+    old = memoryview(old)
+    new = memoryview(new)
+    (low, high) = (0, min(len(old), len(new)))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if old[low:middle] == new[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _make_middle_delta(old, new, start, end, block_size, ops):
+    if start >= end:
+        return
+    rolling = (block_size >= _ROLLING_HASH_MIN_BLOCK)
+    find_block = (_find_block_rolling if rolling else _find_block)
+    index = {}
+    for offset in range(0, len(old) - block_size + 1, block_size):
+        key = (_hash_block(old, offset, block_size) if rolling else old[offset:offset + block_size])
+        index.setdefault(key, offset)
+
+    literal = pos = start
+    while pos + block_size <= end:
+        (pos, offset) = find_block(index, old, new, pos, end - block_size, block_size)
+        if offset is None:
+            break
+        length = block_size
+        while (
+            pos + length + block_size <= end
+            and new[pos + length:pos + length + block_size] == old[offset + length:offset + length + block_size]
+        ):
+            length += block_size
+        while pos + length < end and offset + length < len(old) and new[pos + length] == old[offset + length]:
+            length += 1
+        if literal < pos:
+            ops.append(new[literal:pos])
+        _append_copy(ops, offset, length)
+        pos += length
+        literal = pos
+    if literal < end:
+        ops.append(new[literal:end])
+
+
+def _find_block(index, old, new, pos, last, block_size):  # pylint: disable=unused-argument
+    # Returns (pos, offset) of the first block of the new snapshot from pos up to last which is found
+    # in the old one, or (None, None). The index is keyed by the blocks.
+    while pos <= last:
+        offset = index.get(new[pos:pos + block_size])
+        if offset is not None:
+            return (pos, offset)
+        pos += 1
+    return (None, None)
+
+
+def _find_block_rolling(index, old, new, pos, last, block_size):
+    # The same as _find_block() with the index keyed by the hashes of the blocks. The hash is rolled
+    # to the next position in O(1): the first byte of the block is removed and the next one is appended.
+    out_factor = pow(256, block_size - 1, _HASH_MODULUS)
+    block_hash = _hash_block(new, pos, block_size)
+    while True:
+        offset = index.get(block_hash)
+        if offset is not None and old[offset:offset + block_size] == new[pos:pos + block_size]:
+            return (pos, offset)
+        if pos >= last:
+            return (None, None)
+        block_hash = ((block_hash - new[pos] * out_factor) * 256 + new[pos + block_size]) % _HASH_MODULUS
+        pos += 1
+
+
+def _hash_block(data, offset, block_size):
+    # The same polynomial hash (base 256) as the rolling one in _find_block_rolling()
+    return int.from_bytes(data[offset:offset + block_size], "big") % _HASH_MODULUS
+
+
+def _append_copy(ops, offset, length):
+    if len(ops) > 0 and not isinstance(ops[-1], bytes) and sum(ops[-1]) == offset:
+        ops[-1] = (ops[-1][0], ops[-1][1] + length)
+    else:
+        ops.append((offset, length))
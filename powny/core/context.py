@@ -3,12 +3,23 @@ import inspect
 import pickle
 import copy
 import threading
+import collections
+import select
+import time
 
 from contextlog import get_logger
 
+from . import checkpoints
+
 
 # =====
+_current = threading.local()  # The job which is running by the Scheduler in this thread
+
+
 def get_context():
+    job = getattr(_current, "job", None)
+    if job is not None:
+        return job
     thread = threading.current_thread()
     assert isinstance(thread, JobThread), "Called not from a job context!"
     return thread
@@ -30,6 +41,26 @@ def save_job_state():
     return get_context().save()  # pylint: disable=maybe-no-member
 
 
+def set_job_lifetime(lifetime):
+    return get_context().set_lifetime(lifetime)  # pylint: disable=maybe-no-member
+
+
+def sleep(seconds):
+    """ The same as time.sleep(), but the Scheduler runs the other jobs while this one is waiting """
+
+    get_context().wait(None, time.time() + seconds)  # pylint: disable=maybe-no-member
+
+
+def wait_read(fileobj, timeout=None):
+    """
+        Waits until the file object (or the descriptor) is readable, returns False on timeout.
+        The Scheduler runs the other jobs while this one is waiting.
+    """
+
+    deadline = (None if timeout is None else time.time() + timeout)
+    return get_context().wait(fileobj, deadline)  # pylint: disable=maybe-no-member
+
+
 # =====
 def dump_call(method, kwargs):
     """ Собирает из метода и его аргументов континулет и пиклит его """
@@ -44,7 +75,7 @@ def restore_call(state):
 
     get_logger().debug("Restoring the continulet state...")
     import _continuation
-    cont = pickle.loads(state)
+    cont = pickle.loads(checkpoints.restore_data(state))
     assert isinstance(cont, _continuation.continulet), "The unpickled state is a garbage!"
     return cont
 
@@ -58,13 +89,20 @@ class JobThread(threading.Thread):
         получить метаданные текущей задачи, используя threading.current_thread().
     """
 
-    def __init__(self, backend, job_id, state, extra, __unpickle=False):  # pylint: disable=unused-argument
+    def __init__(self, backend, job_id, state, extra, __unpickle=False,  # pylint: disable=unused-argument
+                 max_deltas=0, compact_ratio=0.5):
         threading.Thread.__init__(self, name="JobThread::" + job_id)
         self._backend = backend
         self._job_id = job_id
         self._state = state
         self._extra = extra
+        self._max_deltas = max_deltas  # Zero disables the incremental states
+        self._compact_ratio = compact_ratio
+        self._lifetime = None
+        self._checkpointer = None
         self._cont = None
+        self._init_error = None
+        self._finished = False
         self._log_context = get_logger().get_context()  # Proxy context into the continulet
 
     def __getstate__(self):
@@ -81,7 +119,7 @@ class JobThread(threading.Thread):
         #        https://docs.python.org/3.2/library/pickle.html#pickle.object.__getnewargs__
         return ((None,) * 4) + (True,)  # Unpickle as current context
 
-    def __new__(cls, backend, job_id, state, extra, __unpickle=False):
+    def __new__(cls, backend, job_id, state, extra, __unpickle=False, **_):
         if __unpickle:
             # Шаг 3. При распикливании, вместо создания нового объекта, возвращаем ссылку на текущий
             #        контекст, предполагая, что он и является контекстом той задачи, в которой
@@ -112,51 +150,174 @@ class JobThread(threading.Thread):
         stack = traceback.extract_stack(inspect.currentframe())
         self._cont.switch(stack)
 
+    def wait(self, fileobj, deadline):
+        # Switches to run() or to the Scheduler without the checkpoint
+        return self._cont.switch(_Wait(fileobj, deadline))
+
+    def set_lifetime(self, lifetime):
+        # Seconds to keep the finished job instead of done_lifetime of the collector.
+        # It's not saved in the checkpoints, so it should be set after the last save().
+        self._lifetime = lifetime
+
     ###
 
     def run(self):
+        value = None
+        while not self.is_finished():
+            wait = self.step(value)
+            value = (wait.block() if wait is not None else None)
+        if self._init_error is not None:
+            raise self._init_error
+
+    def is_finished(self):
+        return self._finished
+
+    def step(self, value=None):
+        """
+            Runs the job up to the next checkpoint or the next wait (the value is the result of the wait).
+            Returns the _Wait object or None.
+        """
+
         logger = get_logger(**self._log_context)
 
-        logger.debug("Initializing context...")
+        if self._cont is None:
+            logger.debug("Initializing context...")
+            try:
+                self._checkpointer = checkpoints.Checkpointer(self._state, self._max_deltas, self._compact_ratio)
+                self._cont = restore_call(self._checkpointer.get_data())
+            except Exception as err:
+                logger.exception("Context initialization has failed")
+                self._init_error = err
+                self._finished = True
+                self._backend.jobs_process.done_job(
+                    job_id=self._job_id,
+                    retval=None,
+                    exc=traceback.format_exc(),
+                    lifetime=self._lifetime,
+                )
+                return None
+            logger.debug("Activation...")
+
         try:
-            self._cont = restore_call(self._state)
+            logger.debug("Entering continulet...")
+            result = self._cont.switch(value)
+            logger.debug("Exited from continulet")
+            if self._cont.is_pending():
+                if isinstance(result, _Wait):
+                    return result
+                self._backend.jobs_process.save_job_state(
+                    job_id=self._job_id,
+                    state=self._make_state(),
+                    stack=result,
+                )
+            else:  # Done
+                self._backend.jobs_process.done_job(
+                    job_id=self._job_id,
+                    retval=result,
+                    exc=None,
+                    lifetime=self._lifetime,
+                )
+                self._finished = True
+                logger.debug("Job finished")
         except Exception:
-            logger.exception("Context initialization has failed")
+            logger.exception("Unhandled step error")
+            # self._cont.switch() switches the stack, so we will see a valid exception, up to this place
+            # in the rule. sys.exc_info() return a raw exception data. Some of them can't be pickled, for
+            # example, traceback-object. For those who use the API, easier to read the text messages.
+            # traceback.format_exc() simply converts data from sys.exc_info() into a string.
             self._backend.jobs_process.done_job(
                 job_id=self._job_id,
                 retval=None,
                 exc=traceback.format_exc(),
+                lifetime=self._lifetime,
             )
-            raise
+            self._finished = True
+            logger.debug("Job finished")
+        return None
+
+    def _make_state(self):
+        state = pickle.dumps(self._cont)
+        if self._max_deltas > 0:
+            state = self._checkpointer.make_state(state)
+        return state
+
+
+class _Wait(collections.namedtuple("_Wait", ("fileobj", "deadline"))):
+    def get_timeout(self):
+        return (None if self.deadline is None else max(self.deadline - time.time(), 0))
 
-        logger.debug("Activation...")
-        while self._cont.is_pending():
+    def block(self):
+        if self.fileobj is None:
+            time.sleep(self.get_timeout())
+            return None
+        return (len(select.select([self.fileobj], [], [], self.get_timeout())[0]) > 0)
+
+
+class Scheduler:
+    """
+        Runs many jobs (not started JobThread objects) in the current thread. The scheduler switches
+        between them on the checkpoints and on sleep() and wait_read(). The job which blocks
+        the thread by other means blocks all jobs of the scheduler.
+    """
+
+    def __init__(self):
+        self._jobs = {}  # job_id -> job
+        self._ready = collections.OrderedDict()  # job_id -> the value for the next step
+        self._waits = {}  # job_id -> _Wait
+
+    def add(self, job):
+        self._jobs[job.get_job_id()] = job
+        self._ready[job.get_job_id()] = None
+
+    def cancel(self, job_id):
+        # The job is dropped without done_job()
+        self._jobs.pop(job_id, None)
+        self._ready.pop(job_id, None)
+        self._waits.pop(job_id, None)
+
+    def get_jobs_count(self):
+        return len(self._jobs)
+
+    def run_once(self, timeout=None, fileobjs=()):
+        """
+            Makes one step of each ready job, then waits up to timeout seconds for the waiting jobs
+            and for the fileobjs. Returns (the list of the finished job ids, the list of the ready fileobjs).
+        """
+
+        finished = []
+        ready = self._ready
+        self._ready = collections.OrderedDict()
+        for (job_id, value) in ready.items():
+            job = self._jobs[job_id]
+            _current.job = job
             try:
-                logger.debug("Entering continulet...")
-                stack_or_retval = self._cont.switch()
-                logger.debug("Exited from continulet")
-                if self._cont.is_pending():  # In progress
-                    self._backend.jobs_process.save_job_state(
-                        job_id=self._job_id,
-                        state=pickle.dumps(self._cont),
-                        stack=stack_or_retval,
-                    )
-                else:  # Done
-                    self._backend.jobs_process.done_job(
-                        job_id=self._job_id,
-                        retval=stack_or_retval,
-                        exc=None,
-                    )
-            except Exception:
-                logger.exception("Unhandled step error")
-                # self._cont.switch() switches the stack, so we will see a valid exception, up to this place
-                # in the rule. sys.exc_info() return a raw exception data. Some of them can't be pickled, for
-                # example, traceback-object. For those who use the API, easier to read the text messages.
-                # traceback.format_exc() simply converts data from sys.exc_info() into a string.
-                self._backend.jobs_process.done_job(
-                    job_id=self._job_id,
-                    retval=None,
-                    exc=traceback.format_exc(),
-                )
-                break
-        logger.debug("Job finished")
+                wait = job.step(value)
+            finally:
+                _current.job = None
+            if job.is_finished():
+                self._jobs.pop(job_id)
+                finished.append(job_id)
+            elif wait is not None:
+                self._waits[job_id] = wait
+            else:
+                self._ready[job_id] = None  # After the checkpoint
+
+        if len(self._ready) > 0:
+            timeout = 0
+        for wait in self._waits.values():
+            wait_timeout = wait.get_timeout()
+            if wait_timeout is not None and (timeout is None or wait_timeout < timeout):
+                timeout = wait_timeout
+        waited = [wait.fileobj for wait in self._waits.values() if wait.fileobj is not None]
+        readable = set(select.select(waited + list(fileobjs), [], [], timeout)[0])
+
+        now = time.time()
+        for (job_id, wait) in list(self._waits.items()):
+            if wait.fileobj is not None and wait.fileobj in readable:
+                self._ready[job_id] = True
+            elif wait.deadline is not None and wait.deadline <= now:
+                self._ready[job_id] = (None if wait.fileobj is None else False)
+            else:
+                continue
+            self._waits.pop(job_id)
+        return (finished, [fileobj for fileobj in fileobjs if fileobj in readable])
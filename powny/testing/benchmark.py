@@ -0,0 +1,139 @@
+import sys
+import os
+import argparse
+import logging
+import tempfile
+import shutil
+import multiprocessing
+import contextlib
+import uuid
+import time
+
+from ..core import backends
+from ..backends.memory import storage
+from ..backends.zookeeper import zoo
+
+
+# =====
+def run_workload(backend, jobs, batch, state_size):
+    """
+        The same workload for any backend: the jobs are added by batches (API), each one is claimed,
+        checkpointed once and finished (Worker), then all of them are collected (Collector).
+        Returns [(phase, seconds), ...].
+    """
+
+    job = backends.JobState(
+        head="0123456789abcdef",
+        method_name="benchmark",
+        kwargs={},
+        state=os.urandom(state_size),
+        job_id=None,
+        request=None,
+    )
+    phases = []
+
+    start = time.time()
+    for offset in range(0, jobs, batch):
+        backend.jobs_control.add_jobs(job.head, [job] * min(batch, jobs - offset))
+    phases.append(("add", time.time() - start))
+
+    start = time.time()
+    processed = 0
+    while processed < jobs:
+        for ready in backend.jobs_process.get_ready_jobs(timeout=1):
+            backend.jobs_process.save_job_state(ready.job_id, job.state, ["benchmark"])
+            backend.jobs_process.done_job(ready.job_id, retval=None, exc=None)
+            processed += 1
+            if processed == jobs:
+                break
+    phases.append(("process", time.time() - start))
+
+    start = time.time()
+    collected = 0
+    while collected < jobs:
+        job_ids = [job_id for (job_id, done) in backend.jobs_gc.get_jobs(0) if done]
+        backend.jobs_gc.remove_jobs_data(job_ids)
+        collected += len(job_ids)
+    phases.append(("gc", time.time() - start))
+
+    return phases
+
+
+# =====
+@contextlib.contextmanager
+def _make_memory(options):  # pylint: disable=unused-argument
+    tmp_dir = tempfile.mkdtemp()
+    address = os.path.join(tmp_dir, "storage.sock")
+    authkey = uuid.uuid4().hex
+    server = multiprocessing.Process(target=storage.serve, args=(address, authkey.encode()))
+    server.start()
+    try:
+        yield {"address": address, "authkey": authkey, "start_server": False}
+    finally:
+        server.terminate()
+        server.join()
+        shutil.rmtree(tmp_dir)
+
+
+@contextlib.contextmanager
+def _make_sqlite(options):
+    tmp_dir = (options.sqlite_dir or tempfile.gettempdir())
+    path = os.path.join(tmp_dir, "powny-benchmark-{}.sqlite3".format(uuid.uuid4().hex))
+    try:
+        yield {"path": path, "synchronous": options.sqlite_synchronous}
+    finally:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+@contextlib.contextmanager
+def _make_zookeeper(options):
+    kwargs = {
+        "nodes":           options.zookeeper_nodes,
+        "timeout":         10,
+        "start_timeout":   10,
+        "start_retries":   1,
+        "randomize_hosts": True,
+    }
+    chroot = "/powny-benchmark-{}".format(uuid.uuid4().hex)
+    try:
+        yield dict(kwargs, chroot=chroot)
+    finally:
+        with zoo.Client(chroot=None, **kwargs).connected() as client:
+            with client.make_write_request("cleanup()") as request:
+                request.delete(chroot, recursive=True)
+
+
+_BACKENDS = {
+    "memory":    _make_memory,
+    "sqlite":    _make_sqlite,
+    "zookeeper": _make_zookeeper,
+}
+
+
+def main():
+    args_parser = argparse.ArgumentParser(prog="powny.testing.benchmark",
+                                          description="Compare the backends on the same jobs workload")
+    args_parser.add_argument("--backends", nargs="+", choices=sorted(_BACKENDS), default=sorted(_BACKENDS))
+    args_parser.add_argument("--jobs", type=int, default=1000)
+    args_parser.add_argument("--batch", type=int, default=10, help="The jobs per add_jobs() call")
+    args_parser.add_argument("--state-size", type=int, default=1024, help="The size of the job state (bytes)")
+    args_parser.add_argument("--sqlite-dir", default=None, help="The directory of the SQLite database")
+    args_parser.add_argument("--sqlite-synchronous", default="normal")
+    args_parser.add_argument("--zookeeper-nodes", nargs="+", default=["localhost:2181"])
+    options = args_parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)  # The pipelined batches are reported as the slow operations
+
+    print("{:<10} {:<8} {:>10} {:>10}".format("backend", "phase", "seconds", "jobs/s"))
+    for name in options.backends:
+        with _BACKENDS[name](options) as kwargs:
+            with backends.get_backend_class(name)(**kwargs).connected() as backend:
+                phases = run_workload(backend, options.jobs, options.batch, options.state_size)
+        for (phase, seconds) in phases:
+            print("{:<10} {:<8} {:>10.3f} {:>10.0f}".format(name, phase, seconds, options.jobs / seconds))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,14 +4,15 @@ from contextlog import get_logger
 
 from ..core import context
 from ..core.backends import make_job_id
+from ..core.checkpoints import IncrementalState
 
 
 # =====
-def run_in_context(method, kwargs=None, job_id=None, extra=None, fatal=True):
+def run_in_context(method, kwargs=None, job_id=None, extra=None, fatal=True, max_deltas=0):
     if callable(method):
         state = context.dump_call(method, (kwargs or {}))
     else:
-        assert isinstance(method, bytes)
+        assert isinstance(method, (bytes, IncrementalState))
         state = method
 
     backend = _Backend()
@@ -20,6 +21,7 @@ def run_in_context(method, kwargs=None, job_id=None, extra=None, fatal=True):
         job_id=(job_id or make_job_id()),
         state=state,
         extra=extra,
+        max_deltas=max_deltas,
     )
     thread.start()
     thread.join()
@@ -33,6 +35,27 @@ def run_in_context(method, kwargs=None, job_id=None, extra=None, fatal=True):
     return _Result(job_id, backend.steps, backend.end)
 
 
+def run_in_scheduler(methods, max_deltas=0):
+    # methods -- [(method, kwargs), ...], the jobs are running cooperatively in the current thread
+    scheduler = context.Scheduler()
+    jobs = []
+    for (method, kwargs) in methods:
+        backend = _Backend()
+        job = context.JobThread(
+            backend=backend,
+            job_id=make_job_id(),
+            state=context.dump_call(method, (kwargs or {})),
+            extra=None,
+            max_deltas=max_deltas,
+        )
+        scheduler.add(job)
+        jobs.append((job, backend))
+    order = []
+    while scheduler.get_jobs_count() > 0:
+        order += scheduler.run_once(1)[0]
+    return ([_Result(job.get_job_id(), backend.steps, backend.end) for (job, backend) in jobs], order)
+
+
 _Step = collections.namedtuple("_Step", ("job_id", "state", "stack"))
 _End = collections.namedtuple("_End", ("job_id", "retval", "exc"))
 _Result = collections.namedtuple("_Result", ("job_id", "steps", "end"))
@@ -52,5 +75,5 @@ class _Backend:
     def _save_job_state(self, job_id, state, stack):
         self.steps.append(_Step(job_id, state, stack))
 
-    def _done_job(self, job_id, retval, exc):
+    def _done_job(self, job_id, retval, exc, lifetime=None):  # pylint: disable=unused-argument
         self.end = _End(job_id, retval, exc)
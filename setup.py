@@ -22,6 +22,8 @@ if __name__ == "__main__":
             "powny.core.optconf.loaders",
             "powny.backends",
             "powny.backends.zookeeper",
+            "powny.backends.memory",
+            "powny.backends.sqlite",
             "powny.testing",
         ],
 
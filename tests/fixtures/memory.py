@@ -0,0 +1,29 @@
+import multiprocessing
+
+import pytest
+
+from powny.backends.memory import storage
+from powny.backends.memory import Backend
+
+
+# =====
+@pytest.yield_fixture
+def mbackend_kwargs(tmpdir):
+    address = str(tmpdir.join("storage.sock"))
+    server = multiprocessing.Process(target=storage.serve, args=(address, b"test"))
+    server.start()
+    try:
+        yield {
+            "address":      address,
+            "authkey":      "test",
+            "start_server": False,
+        }
+    finally:
+        server.terminate()
+        server.join()
+
+
+@pytest.yield_fixture
+def mbackend(mbackend_kwargs):
+    with Backend(**mbackend_kwargs).connected() as backend:
+        yield backend
@@ -0,0 +1,18 @@
+import pytest
+
+from powny.backends.sqlite import Backend
+
+
+# =====
+@pytest.fixture
+def sbackend_kwargs(tmpdir):
+    return {
+        "path":          str(tmpdir.join("powny.sqlite3")),
+        "poll_interval": 0.05,
+    }
+
+
+@pytest.yield_fixture
+def sbackend(sbackend_kwargs):
+    with Backend(**sbackend_kwargs).connected() as backend:
+        yield backend
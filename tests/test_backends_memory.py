@@ -0,0 +1,164 @@
+# pylint: disable=redefined-outer-name
+
+
+import os
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+from powny.core import backends
+from powny.backends.memory import Backend
+from powny.testing import benchmark
+
+from .fixtures.memory import mbackend_kwargs  # pylint: disable=unused-import
+from .fixtures.memory import mbackend  # pylint: disable=unused-import
+mbackend_kwargs  # flake8 suppression pylint: disable=pointless-statement
+mbackend  # flake8 suppression pylint: disable=pointless-statement
+
+
+# =====
+def _hold_lock(backend_kwargs, job_id, locked, stop):
+    with Backend(**backend_kwargs).connected() as backend:
+        backend.jobs_process.associate_job(job_id)
+        locked.set()
+        stop.wait()
+
+
+class TestJobs:
+    fresh_job = backends.JobState(
+        head="0123456789abcdef",
+        method_name="method",
+        kwargs={"a": 1},
+        state=b"pickled_function",
+        job_id=None,
+        request=None,
+    )
+
+    def test_get_info(self, mbackend):
+        assert mbackend.get_info()["jobs"] == 0
+
+    def test_process(self, mbackend):
+        job_ids = mbackend.jobs_control.add_jobs(self.fresh_job.head, [self.fresh_job] * 2)
+        assert mbackend.jobs_control.get_input_size() == 2
+        assert mbackend.jobs_control.get_request_count() == 1
+        assert sorted(mbackend.jobs_control.get_jobs_list()) == sorted(job_ids)
+
+        ready_jobs = [job for job in mbackend.jobs_process.get_ready_jobs()]
+        assert [job.job_id for job in ready_jobs] == job_ids
+        assert ready_jobs[0].state == self.fresh_job.state
+        assert mbackend.jobs_control.get_job_info(job_ids[0])["locked"] is not None
+
+        mbackend.jobs_process.save_job_state(job_ids[0], b"state", ["stack"])
+        assert mbackend.jobs_control.get_job_info(job_ids[0])["stack"] == ["stack"]
+        mbackend.jobs_process.done_job(job_ids[0], retval=True, exc=None)
+        job_info = mbackend.jobs_control.get_job_info(job_ids[0])
+        assert job_info["retval"] is True
+        assert job_info["locked"] is None
+        assert isinstance(job_info["finished"], str)
+
+        mbackend.jobs_process.release_job(job_ids[1])
+        assert sorted(mbackend.jobs_gc.get_jobs(0)) == sorted([(job_ids[0], True), (job_ids[1], False)])
+        assert list(mbackend.jobs_gc.get_jobs(0)) == []  # Locked by the collector
+        mbackend.jobs_gc.remove_jobs_data([job_ids[0]])
+        mbackend.jobs_gc.remove_jobs_data([job_ids[0]])  # Already removed
+        mbackend.jobs_gc.push_back_job(job_ids[1])
+        assert mbackend.jobs_control.get_job_info(job_ids[0]) is None
+        assert [job.job_id for job in mbackend.jobs_process.get_ready_jobs()] == [job_ids[1]]
+
+    def test_lifetime(self, mbackend):
+        job_ids = mbackend.jobs_control.add_jobs(self.fresh_job.head, [self.fresh_job] * 3)
+        list(mbackend.jobs_process.get_ready_jobs())
+        mbackend.jobs_process.done_job(job_ids[0], retval=True, exc=None)
+        mbackend.jobs_process.done_job(job_ids[1], retval=True, exc=None, lifetime=0)
+        mbackend.jobs_process.done_job(job_ids[2], retval=True, exc=None, lifetime=3600)
+        assert list(mbackend.jobs_gc.get_jobs(3600)) == [(job_ids[1], True)]
+        assert list(mbackend.jobs_gc.get_jobs(0, full=True)) == [(job_ids[0], True)]
+
+    def test_get_ready_jobs_timeout(self, mbackend):
+        def add_job():
+            time.sleep(1)
+            mbackend.jobs_control.add_jobs(self.fresh_job.head, [self.fresh_job])
+
+        adder = threading.Thread(target=add_job)
+        adder.start()
+        before = time.time()
+        assert len(list(mbackend.jobs_process.get_ready_jobs(timeout=3))) == 1
+        assert time.time() - before >= 3
+        adder.join()
+
+    def test_dead_lock_owner(self, mbackend, mbackend_kwargs):
+        job_id = mbackend.jobs_control.add_jobs(self.fresh_job.head, [self.fresh_job])[0]
+        next(mbackend.jobs_process.get_ready_jobs())
+        (locked, stop) = (multiprocessing.Event(), multiprocessing.Event())
+        proc = multiprocessing.Process(target=_hold_lock, args=(mbackend_kwargs, job_id, locked, stop))
+        proc.start()
+        assert locked.wait(10)
+        assert list(mbackend.jobs_gc.get_jobs(0)) == []
+        proc.terminate()
+        proc.join()
+        assert list(mbackend.jobs_gc.get_jobs(0)) == [(job_id, False)]
+
+    def test_delete(self, mbackend):
+        job_id = mbackend.jobs_control.add_jobs(self.fresh_job.head, [self.fresh_job])[0]
+        assert not mbackend.jobs_process.is_deleted_job(job_id)
+        with pytest.raises(backends.DeleteTimeoutError):
+            mbackend.jobs_control.delete_job(job_id, timeout=1)
+        assert mbackend.jobs_process.is_deleted_job(job_id)
+        assert list(mbackend.jobs_gc.get_jobs(0)) == [(job_id, True)]
+        mbackend.jobs_gc.remove_job_data(job_id)
+        assert mbackend.jobs_control.delete_job(job_id) is False
+
+
+class TestRules:
+    def test_head_cycle(self, mbackend):
+        assert mbackend.rules.get_head() is None
+        mbackend.rules.set_head("0123456789abcdef")
+        assert mbackend.rules.get_head() == "0123456789abcdef"
+
+
+class TestAppsState:
+    def test_state_cycle(self, mbackend, mbackend_kwargs):
+        with Backend(**mbackend_kwargs).connected() as backend:
+            backend.system_apps_state.set_state("worker", {"active": 1})
+            full_state = mbackend.system_apps_state.get_full_state()
+            assert list(full_state) == ["worker"]
+            assert list(full_state["worker"].values())[0]["state"] == {"active": 1}
+        assert mbackend.system_apps_state.get_full_state() == {}
+
+
+class TestCasStorage:
+    def test_replace(self, mbackend):
+        cas_storage = mbackend.cas_storage
+        with pytest.raises(backends.CasNoValueError):
+            cas_storage.get_value("/foo/bar")
+        assert cas_storage.set_value("/foo/bar", value=1, version=0) is True
+        assert cas_storage.set_value("/foo/bar", value=2, version=0) is False
+        (old, write_ok) = cas_storage.replace_value("/foo/bar", value=2, version=1)
+        assert (old.value, old.version, write_ok) == (1, 0, True)
+        with pytest.raises(backends.CasVersionError):
+            cas_storage.replace_value("/foo/bar", value=3, version=1)
+
+    def test_many(self, mbackend):
+        cas_storage = mbackend.cas_storage
+        assert cas_storage.set_many({"/foo": (1, 0), "/bar": (2, 0)}) == {"/foo": True, "/bar": True}
+        assert cas_storage.set_many({"/foo": (3, 1), "/bar": (4, 0)}) == {"/foo": True, "/bar": False}
+        assert [data.value for data in cas_storage.get_many(["/foo", "/bar", "/baz"], default=None)] == [3, 2, None]
+
+
+class TestAddress:
+    def test_tcp_address(self):
+        with pytest.raises(RuntimeError):
+            Backend(address="localhost:12345", start_server=False).open()
+
+    def test_socket_mode(self, mbackend, mbackend_kwargs):
+        assert mbackend.get_info()["jobs"] == 0
+        assert os.stat(mbackend_kwargs["address"]).st_mode & 0o077 == 0
+
+
+class TestBenchmark:
+    def test_workload(self, mbackend):
+        phases = benchmark.run_workload(mbackend, jobs=25, batch=10, state_size=16)
+        assert [phase for (phase, _) in phases] == ["add", "process", "gc"]
+        assert mbackend.jobs_control.get_jobs_list() == []
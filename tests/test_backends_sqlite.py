@@ -0,0 +1,194 @@
+# pylint: disable=protected-access
+# pylint: disable=redefined-outer-name
+
+
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+from powny.core import backends
+from powny.backends.sqlite import Backend
+from powny.backends.sqlite import ifaces
+from powny.testing import benchmark
+
+from .fixtures.sqlite import sbackend_kwargs  # pylint: disable=unused-import
+from .fixtures.sqlite import sbackend  # pylint: disable=unused-import
+sbackend_kwargs  # flake8 suppression pylint: disable=pointless-statement
+sbackend  # flake8 suppression pylint: disable=pointless-statement
+
+
+# =====
+def _hold_lock(backend_kwargs, job_id, locked, stop):
+    with Backend(**backend_kwargs).connected() as backend:
+        backend.jobs_process.associate_job(job_id)
+        locked.set()
+        stop.wait()
+
+
+class TestJobs:
+    fresh_job = backends.JobState(
+        head="0123456789abcdef",
+        method_name="method",
+        kwargs={"a": 1},
+        state=b"pickled_function",
+        job_id=None,
+        request=None,
+    )
+
+    def test_get_info(self, sbackend):
+        assert sbackend.get_info()["jobs"] == 0
+
+    def test_process(self, sbackend):
+        job_ids = sbackend.jobs_control.add_jobs(self.fresh_job.head, [self.fresh_job] * 2)
+        assert sbackend.jobs_control.get_input_size() == 2
+        assert sbackend.jobs_control.get_request_count() == 1
+        assert sorted(sbackend.jobs_control.get_jobs_list()) == sorted(job_ids)
+
+        ready_jobs = [job for job in sbackend.jobs_process.get_ready_jobs()]
+        assert [job.job_id for job in ready_jobs] == job_ids
+        assert ready_jobs[0].state == self.fresh_job.state
+        assert sbackend.jobs_control.get_job_info(job_ids[0])["locked"] is not None
+
+        sbackend.jobs_process.save_job_state(job_ids[0], b"state", ["stack"])
+        assert sbackend.jobs_control.get_job_info(job_ids[0])["stack"] == ["stack"]
+        sbackend.jobs_process.done_job(job_ids[0], retval=True, exc=None)
+        job_info = sbackend.jobs_control.get_job_info(job_ids[0])
+        assert job_info["retval"] is True
+        assert job_info["locked"] is None
+        assert isinstance(job_info["finished"], str)
+
+        sbackend.jobs_process.release_job(job_ids[1])
+        assert sorted(sbackend.jobs_gc.get_jobs(0)) == sorted([(job_ids[0], True), (job_ids[1], False)])
+        assert list(sbackend.jobs_gc.get_jobs(0)) == []  # Locked by the collector
+        sbackend.jobs_gc.remove_jobs_data([job_ids[0]])
+        sbackend.jobs_gc.push_back_job(job_ids[1])
+        assert sbackend.jobs_control.get_job_info(job_ids[0]) is None
+        assert [job.job_id for job in sbackend.jobs_process.get_ready_jobs()] == [job_ids[1]]
+
+    def test_lifetime(self, sbackend):
+        job_ids = sbackend.jobs_control.add_jobs(self.fresh_job.head, [self.fresh_job] * 3)
+        list(sbackend.jobs_process.get_ready_jobs())
+        sbackend.jobs_process.done_job(job_ids[0], retval=True, exc=None)
+        sbackend.jobs_process.done_job(job_ids[1], retval=True, exc=None, lifetime=0)
+        sbackend.jobs_process.done_job(job_ids[2], retval=True, exc=None, lifetime=3600)
+        assert list(sbackend.jobs_gc.get_jobs(3600)) == [(job_ids[1], True)]
+        assert list(sbackend.jobs_gc.get_jobs(0, full=True)) == [(job_ids[0], True)]
+
+    def test_get_ready_jobs_timeout(self, sbackend):
+        def add_job():
+            time.sleep(1)
+            sbackend.jobs_control.add_jobs(self.fresh_job.head, [self.fresh_job])
+
+        adder = threading.Thread(target=add_job)
+        adder.start()
+        before = time.time()
+        assert len(list(sbackend.jobs_process.get_ready_jobs(timeout=3))) == 1
+        assert time.time() - before >= 3
+        adder.join()
+
+    def test_dead_lock_owner(self, sbackend, sbackend_kwargs):
+        job_id = sbackend.jobs_control.add_jobs(self.fresh_job.head, [self.fresh_job])[0]
+        next(sbackend.jobs_process.get_ready_jobs())
+        (locked, stop) = (multiprocessing.Event(), multiprocessing.Event())
+        proc = multiprocessing.Process(target=_hold_lock, args=(sbackend_kwargs, job_id, locked, stop))
+        proc.start()
+        assert locked.wait(10)
+        assert list(sbackend.jobs_gc.get_jobs(0)) == []
+        proc.terminate()
+        proc.join()
+        assert list(sbackend.jobs_gc.get_jobs(0)) == [(job_id, False)]
+
+    def test_delete(self, sbackend):
+        job_id = sbackend.jobs_control.add_jobs(self.fresh_job.head, [self.fresh_job])[0]
+        assert not sbackend.jobs_process.is_deleted_job(job_id)
+        with pytest.raises(backends.DeleteTimeoutError):
+            sbackend.jobs_control.delete_job(job_id, timeout=1)
+        assert sbackend.jobs_process.is_deleted_job(job_id)
+        assert list(sbackend.jobs_gc.get_jobs(0)) == [(job_id, True)]
+        sbackend.jobs_gc.remove_job_data(job_id)
+        assert sbackend.jobs_control.delete_job(job_id) is False
+
+    def test_gc_deleted_running(self, sbackend):
+        job_id = sbackend.jobs_control.add_jobs(self.fresh_job.head, [self.fresh_job])[0]
+        list(sbackend.jobs_process.get_ready_jobs())
+        sbackend.jobs_process.release_job(job_id)
+        with pytest.raises(backends.DeleteTimeoutError):
+            sbackend.jobs_control.delete_job(job_id, timeout=0)
+        assert list(sbackend.jobs_gc.get_jobs(0)) == [(job_id, True)]  # Running and deleted, but only once
+
+    def test_gc_query_plan(self, sbackend):
+        with sbackend._db.reading() as cursor:
+            plan = [row[-1] for row in cursor.execute("EXPLAIN QUERY PLAN " + ifaces._GC_QUERY, (0, 0))]
+        assert not any(step.startswith("SCAN") for step in plan), plan
+        for index in ("jobs_deleted", "jobs_finished", "jobs_expires", "jobs_running"):
+            assert any(step.startswith("SEARCH jobs USING INDEX {} ".format(index)) for step in plan), plan
+
+
+class TestRules:
+    def test_head_cycle(self, sbackend):
+        assert sbackend.rules.get_head() is None
+        sbackend.rules.set_head("0123456789abcdef")
+        assert sbackend.rules.get_head() == "0123456789abcdef"
+
+
+class TestAppsState:
+    def test_state_cycle(self, sbackend, sbackend_kwargs):
+        with Backend(**sbackend_kwargs).connected() as backend:
+            backend.system_apps_state.set_state("worker", {"active": 1})
+            full_state = sbackend.system_apps_state.get_full_state()
+            assert list(full_state) == ["worker"]
+            assert list(full_state["worker"].values())[0]["state"] == {"active": 1}
+        assert sbackend.system_apps_state.get_full_state() == {}
+
+
+class TestCasStorage:
+    def test_replace(self, sbackend):
+        cas_storage = sbackend.cas_storage
+        with pytest.raises(backends.CasNoValueError):
+            cas_storage.get_value("/foo/bar")
+        assert cas_storage.set_value("/foo/bar", value=1, version=0) is True
+        assert cas_storage.set_value("/foo/bar", value=2, version=0) is False
+        (old, write_ok) = cas_storage.replace_value("/foo/bar", value=2, version=1)
+        assert (old.value, old.version, write_ok) == (1, 0, True)
+        with pytest.raises(backends.CasVersionError):
+            cas_storage.replace_value("/foo/bar", value=3, version=1)
+
+    def test_many(self, sbackend):
+        cas_storage = sbackend.cas_storage
+        assert cas_storage.set_many({"/foo": (1, 0), "/bar": (2, 0)}) == {"/foo": True, "/bar": True}
+        assert cas_storage.set_many({"/foo": (3, 1), "/bar": (4, 0)}) == {"/foo": True, "/bar": False}
+        assert [data.value for data in cas_storage.get_many(["/foo", "/bar", "/baz"], default=None)] == [3, 2, None]
+
+
+class TestDurability:
+    def test_reopen(self, sbackend_kwargs):
+        with Backend(**sbackend_kwargs).connected() as backend:
+            job_id = backend.jobs_control.add_jobs("0123456789abcdef", [TestJobs.fresh_job])[0]
+            next(backend.jobs_process.get_ready_jobs())
+            backend.jobs_process.save_job_state(job_id, b"state", ["stack"])
+            backend.rules.set_head("0123456789abcdef")
+        with Backend(**sbackend_kwargs).connected() as backend:
+            assert backend.rules.get_head() == "0123456789abcdef"
+            job_info = backend.jobs_control.get_job_info(job_id)
+            assert job_info["stack"] == ["stack"]
+            assert job_info["locked"] is None  # The session was closed
+            assert list(backend.jobs_gc.get_jobs(0)) == [(job_id, False)]
+
+    def test_save_interval(self, sbackend_kwargs):
+        with Backend(save_interval=60, **sbackend_kwargs).connected() as backend:
+            job_id = backend.jobs_control.add_jobs("0123456789abcdef", [TestJobs.fresh_job])[0]
+            next(backend.jobs_process.get_ready_jobs())
+            backend.jobs_process.save_job_state(job_id, b"first", ["first"])
+            backend.jobs_process.save_job_state(job_id, b"second", ["second"])
+            assert backend.jobs_control.get_job_info(job_id)["stack"] == ["first"]
+        with Backend(**sbackend_kwargs).connected() as backend:
+            assert backend.jobs_control.get_job_info(job_id)["stack"] == ["second"]  # Flushed by close()
+
+
+class TestBenchmark:
+    def test_workload(self, sbackend):
+        phases = benchmark.run_workload(sbackend, jobs=25, batch=10, state_size=16)
+        assert [phase for (phase, _) in phases] == ["add", "process", "gc"]
+        assert sbackend.jobs_control.get_jobs_list() == []
@@ -23,6 +23,7 @@ def test_get_info(zclient_kwargs, zclient_chroot):
         info = backend.get_info()
         assert "zookeeper.version" in info["envi"]
         assert "zk_version" in info["mntr"]
+        assert info["stats"]["ops"]["get_children"]["count"] > 0
 
 
 def test_ifaces(zclient_kwargs, zclient_chroot):
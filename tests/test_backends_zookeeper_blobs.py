@@ -0,0 +1,76 @@
+# pylint: disable=redefined-outer-name
+
+
+import os
+
+import pytest
+
+from powny.backends.zookeeper import blobs
+
+from .fixtures.zookeeper import zclient  # pylint: disable=unused-import
+zclient  # flake8 suppression pylint: disable=pointless-statement
+
+
+# =====
+class TestOffloader:
+    def test_no_store(self):
+        offloader = blobs.Offloader(None, 0)
+        assert offloader.pack("job", b"x" * 100) == b"x" * 100
+        assert offloader.unpack("job", b"x" * 100) == b"x" * 100
+        with pytest.raises(blobs.BlobError):
+            offloader.unpack("job", blobs.BlobRef(digest="0" * 64, size=1, pickled=False))
+        offloader.cleanup("job")
+
+    def test_threshold(self, tmpdir):
+        offloader = blobs.Offloader(blobs.FsStore(str(tmpdir)), 10)
+        assert offloader.pack("job", None) is None
+        assert offloader.pack("job", b"small") == b"small"
+        ref = offloader.pack("job", b"x" * 10)
+        assert isinstance(ref, blobs.BlobRef)
+        assert not ref.pickled
+        assert offloader.unpack("job", ref) == b"x" * 10
+
+    def test_pickled(self, tmpdir):
+        offloader = blobs.Offloader(blobs.FsStore(str(tmpdir)), 10)
+        value = {"retval": list(range(100))}
+        ref = offloader.pack("job", value)
+        assert ref.pickled
+        assert offloader.unpack("job", ref) == value
+
+    def test_corrupted(self, tmpdir):
+        offloader = blobs.Offloader(blobs.FsStore(str(tmpdir)), 10)
+        ref = offloader.pack("job", b"x" * 100)
+        with open(os.path.join(str(tmpdir), "job", ref.digest), "wb") as blob_file:
+            blob_file.write(b"y" * 100)
+        with pytest.raises(blobs.BlobError):
+            offloader.unpack("job", ref)
+
+    def test_cleanup(self, tmpdir):
+        offloader = blobs.Offloader(blobs.FsStore(str(tmpdir)), 10)
+        first = offloader.pack("job", b"x" * 100)
+        second = offloader.pack("job", b"y" * 100)
+        offloader.cleanup("job", keep=[second, None])
+        with pytest.raises(blobs.BlobError):
+            offloader.unpack("job", first)
+        assert offloader.unpack("job", second) == b"y" * 100
+        offloader.cleanup("job")
+        assert not os.path.exists(os.path.join(str(tmpdir), "job"))
+
+
+class TestZnodeStore:
+    def test_chunks(self, zclient):
+        store = blobs.ZnodeStore(zclient, "/blobs", 7)
+        offloader = blobs.Offloader(store, 10)
+        data = bytes(range(100))
+        ref = offloader.pack("job", data)
+        assert len(zclient.get_children("/blobs/job/" + ref.digest)) == 15
+        assert offloader.pack("job", data) == ref  # Idempotent
+        assert offloader.unpack("job", ref) == data
+
+        other = offloader.pack("job", b"x" * 100)
+        offloader.cleanup("job", keep=[other])
+        assert zclient.get_children("/blobs/job") == [other.digest]
+        offloader.cleanup("job")
+        offloader.cleanup("job")
+        with pytest.raises(blobs.BlobError):
+            offloader.unpack("job", other)
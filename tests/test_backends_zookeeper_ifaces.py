@@ -1,6 +1,9 @@
+# pylint: disable=protected-access
 # pylint: disable=redefined-outer-name
 
 
+import os
+import functools
 import threading
 import time
 
@@ -8,12 +11,23 @@ import pytest
 
 from powny.core import (
     backends,
+    checkpoints,
     tools,
 )
+from powny.backends.zookeeper import zoo
 from powny.backends.zookeeper import ifaces
+from powny.backends.zookeeper import blobs
 
 from .fixtures.zookeeper import zclient  # pylint: disable=unused-import
+from .fixtures.zookeeper import zbackend_kwargs  # pylint: disable=unused-import
 zclient  # flake8 suppression pylint: disable=pointless-statement
+zbackend_kwargs  # flake8 suppression pylint: disable=pointless-statement
+
+
+# =====
+def _is_children_watched(zclient, path):
+    zclient.exists("/")  # The responses of the previous async reads are received before it
+    return (zclient.zk.chroot + path in zclient.zk._child_watchers)
 
 
 # =====
@@ -45,6 +59,121 @@ class TestJobs:
             control_iface.add_jobs(self.func_head, [self.fresh_job])
             assert control_iface.get_input_size() == count + 1
 
+    def test_add_jobs_partial(self, zclient, zbackend_kwargs, monkeypatch, tmpdir):
+        ifaces.init(zclient)
+        job_ids = [backends.make_job_id() for _ in range(20)]
+        with zclient.make_write_request() as request:
+            request.create(ifaces._get_path_job(job_ids[15]))
+        monkeypatch.setattr(ifaces, "make_job_id", iter(job_ids).__next__)
+        with zoo.Client(max_request_size=2000, **zbackend_kwargs).connected() as client:
+            offloader = ifaces.make_offloader(client, "fs", str(tmpdir), 10, 0)
+            control_iface = ifaces.JobsControl(client, offloader=offloader)
+            with pytest.raises(backends.PartialAddError) as exc_info:
+                control_iface.add_jobs(self.func_head, [self.fresh_job] * 20)
+            added = exc_info.value.added
+            assert 0 < len(added) <= 15
+            assert added == job_ids[:len(added)]
+            assert control_iface.get_input_size() == len(added)
+            assert sorted(os.listdir(str(tmpdir))) == sorted(added)  # The states of the others are removed
+
+    def test_get_ready_jobs_timeout(self, zclient):
+        ifaces.init(zclient)
+        control_iface = ifaces.JobsControl(zclient)
+        process_iface = ifaces.JobsProcess(zclient)
+
+        def add_job():
+            time.sleep(1)
+            control_iface.add_jobs(self.func_head, [self.fresh_job])
+
+        adder = threading.Thread(target=add_job)
+        adder.daemon = True
+        adder.start()
+
+        before = time.time()
+        ready_jobs = process_iface.get_ready_jobs(timeout=10)
+        assert next(ready_jobs).head == self.func_head
+        assert time.time() - before < 10
+        adder.join()
+
+        before = time.time()
+        with pytest.raises(StopIteration):
+            next(ready_jobs)
+        assert time.time() - before >= 10
+
+    def test_get_ready_jobs_batch(self, zclient):
+        ifaces.init(zclient)
+        control_iface = ifaces.JobsControl(zclient)
+        process_iface = ifaces.JobsProcess(zclient, claim_batch=3)
+        job_ids = control_iface.add_jobs(self.func_head, [self.fresh_job] * 5)
+        assert sorted(job.job_id for job in process_iface.get_ready_jobs()) == sorted(job_ids)
+        assert control_iface.get_input_size() == 0
+
+    def test_get_ready_jobs_claim_batch(self, zclient):
+        ifaces.init(zclient)
+        control_iface = ifaces.JobsControl(zclient)
+        process_iface = ifaces.JobsProcess(zclient, claim_batch=5)
+        job_ids = control_iface.add_jobs(self.func_head, [self.fresh_job] * 5)
+        zoo._stats.reset()
+        assert sorted(job.job_id for job in process_iface.get_ready_jobs()) == sorted(job_ids)
+        assert zoo._stats.get()["labels"]["get_ready_jobs()"]["count"] == 1  # One write for the round
+
+    def test_get_ready_jobs_claim_conflict(self, zclient):
+        ifaces.init(zclient)
+        control_iface = ifaces.JobsControl(zclient)
+        process_iface = ifaces.JobsProcess(zclient, claim_batch=5)
+        job_ids = control_iface.add_jobs(self.func_head, [self.fresh_job] * 5)
+        with zclient.make_write_request() as request:
+            request.create(ifaces._get_path_job_lock(job_ids[2]))  # Locked by the collector
+        assert sorted(job.job_id for job in process_iface.get_ready_jobs()) == sorted(job_ids[:2] + job_ids[3:])
+        assert control_iface.get_input_size() == 1  # The entry of the locked job is released
+
+    def test_get_ready_jobs_close(self, zclient):
+        ifaces.init(zclient)
+        control_iface = ifaces.JobsControl(zclient)
+        process_iface = ifaces.JobsProcess(zclient, claim_batch=5)
+        job_ids = control_iface.add_jobs(self.func_head, [self.fresh_job] * 5)
+
+        ready_jobs = process_iface.get_ready_jobs()
+        first_id = next(ready_jobs).job_id
+        ready_jobs.close()  # Releases the other four
+
+        other_iface = ifaces.JobsProcess(zclient, claim_batch=5)
+        other_ids = [job.job_id for job in other_iface.get_ready_jobs()]
+        assert sorted([first_id] + other_ids) == sorted(job_ids)
+
+    def test_partitions(self, zclient):
+        ifaces.init(zclient, input_partitions=4)
+        control_iface = ifaces.JobsControl(zclient, input_partitions=4)
+        job_ids = control_iface.add_jobs(self.func_head, [self.fresh_job] * 20)
+        assert control_iface.get_input_size() == 20
+        assert len([
+            partition
+            for partition in range(4)
+            if zclient.get_children_count(ifaces._get_path_input_queue(partition)) > 0
+        ]) > 1
+
+        process_iface = ifaces.JobsProcess(zclient, input_partitions=4, preferred_partitions=[2], claim_batch=3)
+        assert sorted(job.job_id for job in process_iface.get_ready_jobs()) == sorted(job_ids)
+        assert control_iface.get_input_size() == 0
+
+    def test_partitions_wait(self, zclient):
+        ifaces.init(zclient, input_partitions=4)
+        control_iface = ifaces.JobsControl(zclient, input_partitions=4)
+        process_iface = ifaces.JobsProcess(zclient, input_partitions=4)
+
+        def add_jobs():
+            time.sleep(1)
+            control_iface.add_jobs(self.func_head, [self.fresh_job] * 4)
+
+        adder = threading.Thread(target=add_jobs)
+        adder.daemon = True
+        adder.start()
+
+        before = time.time()
+        assert len(list(process_iface.get_ready_jobs(timeout=3))) == 4
+        assert time.time() - before < 10
+        adder.join()
+
     def test_delete_wait(self, zclient):
         ifaces.init(zclient)
         control_iface = ifaces.JobsControl(zclient)
@@ -74,6 +203,84 @@ class TestJobs:
         assert time.time() - before >= 3
         assert control_iface.get_job_info(job_id) is None
 
+    def test_watches(self, zclient):
+        ifaces.init(zclient)
+        control_iface = ifaces.JobsControl(zclient)
+        process_iface = ifaces.JobsProcess(zclient)
+
+        input_changed = threading.Event()
+        assert process_iface.watch_input(input_changed.set)
+        assert list(process_iface.get_ready_jobs()) == []  # Sets the watch of the empty queue
+        job_ids = control_iface.add_jobs(self.func_head, [self.fresh_job] * 3)
+        assert input_changed.wait(5)
+
+        assert sorted(job.job_id for job in process_iface.get_ready_jobs()) == sorted(job_ids)
+        deleted = []
+        for job_id in job_ids:
+            process_iface.associate_job(job_id)
+            assert process_iface.watch_deleted_job(job_id, functools.partial(deleted.append, job_id))
+        assert all(_is_children_watched(zclient, ifaces._get_path_job(job_id)) for job_id in job_ids)
+        assert deleted == []
+        with pytest.raises(backends.DeleteTimeoutError):
+            control_iface.delete_job(job_ids[0], timeout=1)
+        time.sleep(1)
+        assert deleted == [job_ids[0]]
+
+        # Already deleted
+        assert process_iface.watch_deleted_job(job_ids[0], functools.partial(deleted.append, job_ids[0]))
+        deadline = time.time() + 5
+        while len(deleted) < 2 and time.time() < deadline:
+            time.sleep(0.1)  # Called by the async read
+        assert deleted == [job_ids[0]] * 2
+
+        # Unwatched
+        process_iface.unwatch_deleted_job(job_ids[1])
+        with pytest.raises(backends.DeleteTimeoutError):
+            control_iface.delete_job(job_ids[1], timeout=1)
+        time.sleep(1)
+        assert deleted == [job_ids[0]] * 2
+        process_iface.unwatch_deleted_job(job_ids[2])
+        assert process_iface._deleted_watchers == {}
+
+    def test_watch_deleted_removed(self, zclient):
+        ifaces.init(zclient)
+        control_iface = ifaces.JobsControl(zclient)
+        process_iface = ifaces.JobsProcess(zclient)
+        gc_iface = ifaces.JobsGc(zclient)
+
+        job_id = control_iface.add_jobs(self.func_head, [self.fresh_job])[0]
+        assert len(list(process_iface.get_ready_jobs())) == 1
+        assert process_iface.watch_deleted_job(job_id, (lambda: None))
+        process_iface.release_job(job_id)  # The watch is set again by the change of the children
+        assert list(gc_iface.get_jobs(0)) == [(job_id, False)]
+        gc_iface.remove_job_data(job_id)
+        assert not _is_children_watched(zclient, ifaces._get_path_job(job_id))  # Gone with the job
+
+    def test_watch_deleted_reconnect(self, zclient):
+        ifaces.init(zclient)
+        control_iface = ifaces.JobsControl(zclient)
+        process_iface = ifaces.JobsProcess(zclient)
+
+        job_id = control_iface.add_jobs(self.func_head, [self.fresh_job])[0]
+        assert len(list(process_iface.get_ready_jobs())) == 1
+        deleted = threading.Event()
+        assert process_iface.watch_deleted_job(job_id, deleted.set)
+        assert _is_children_watched(zclient, ifaces._get_path_job(job_id))
+        zclient.zk._child_watchers.pop(zclient.zk.chroot + ifaces._get_path_job(job_id))  # Like the expired session
+        process_iface._on_state_changed(zoo.STATE_CONNECTED)
+        with pytest.raises(backends.DeleteTimeoutError):
+            control_iface.delete_job(job_id, timeout=0.1)
+        assert deleted.wait(5)
+
+    def test_close(self, zclient):
+        ifaces.init(zclient)
+        listeners = len(zclient.zk.state_listeners)
+        for _ in range(5):
+            ifaces.JobsControl(zclient, input_partitions=3, info_cache_size=10).close()
+            ifaces.JobsProcess(zclient, input_partitions=3).close()
+            ifaces.JobsGc(zclient, input_partitions=3).close()
+        assert len(zclient.zk.state_listeners) == listeners
+
     def test_remove_fresh_job(self, zclient):
         ifaces.init(zclient)
         control_iface = ifaces.JobsControl(zclient)
@@ -91,6 +298,261 @@ class TestJobs:
         gc_iface.remove_job_data(job_id)
         assert control_iface.get_job_info(job_id) is None
 
+    def test_offloaded_state(self, zclient, tmpdir):
+        ifaces.init(zclient)
+        offloader = ifaces.make_offloader(zclient, "fs", str(tmpdir), 10, 0)
+        control_iface = ifaces.JobsControl(zclient, offloader=offloader)
+        process_iface = ifaces.JobsProcess(zclient, offloader=offloader)
+        gc_iface = ifaces.JobsGc(zclient, offloader=offloader)
+
+        job_id = control_iface.add_jobs(self.func_head, [self.fresh_job])[0]
+        ready_job = next(process_iface.get_ready_jobs())
+        assert ready_job.state == self.func_state
+        process_iface.associate_job(job_id)
+        process_iface.save_job_state(job_id, b"x" * 100, ["stack"])
+        process_iface.save_job_state(job_id, b"y" * 100, ["stack"])
+        process_iface.done_job(job_id, retval=list(range(100)), exc=None)
+        assert control_iface.get_job_info(job_id)["retval"] == list(range(100))
+        assert len(os.listdir(os.path.join(str(tmpdir), job_id))) == 1  # Only retval
+        offloader.cleanup(job_id)
+        with pytest.raises(blobs.BlobError):
+            control_iface.get_job_info(job_id)  # Not a missing job
+
+        assert list(gc_iface.get_jobs(0)) == [(job_id, True)]
+        gc_iface.remove_job_data(job_id)
+        assert not os.path.exists(os.path.join(str(tmpdir), job_id))
+
+    def test_incremental_state(self, zclient):
+        ifaces.init(zclient)
+        control_iface = ifaces.JobsControl(zclient)
+        process_iface = ifaces.JobsProcess(zclient)
+        gc_iface = ifaces.JobsGc(zclient)
+
+        job_id = control_iface.add_jobs(self.func_head, [self.fresh_job])[0]
+        next(process_iface.get_ready_jobs())
+        checkpointer = checkpoints.Checkpointer(self.func_state, max_deltas=3, compact_ratio=0.5)
+        for data in (b"x" * 1000, b"x" * 999 + b"y"):
+            process_iface.save_job_state(job_id, checkpointer.make_state(data), ["stack"])
+        assert zclient.get(ifaces._get_path_job_base(job_id)) == b"x" * 1000
+        assert zclient.get(ifaces._get_path_job_state(job_id))["state"].base is None
+
+        gc_iface.push_back_job(job_id)
+        ready_job = next(ifaces.JobsProcess(zclient).get_ready_jobs())
+        assert checkpoints.restore_data(ready_job.state) == b"x" * 999 + b"y"
+
+        gc_iface.remove_job_data(job_id)
+        assert control_iface.get_job_info(job_id) is None
+
+    def test_job_info_cache(self, zclient):
+        ifaces.init(zclient)
+        control_iface = ifaces.JobsControl(zclient, info_cache_size=10)
+        process_iface = ifaces.JobsProcess(zclient)
+        gc_iface = ifaces.JobsGc(zclient)
+
+        job_id = control_iface.add_jobs(self.func_head, [self.fresh_job])[0]
+        self._assert_job_info_new(control_iface.get_job_info(job_id))
+        assert not control_iface._info_cache.get(job_id)[0].final
+        next(process_iface.get_ready_jobs())
+        process_iface.associate_job(job_id)
+        self._assert_job_info_taken(control_iface.get_job_info(job_id))  # The mutable parts are refreshed
+
+        process_iface.done_job(job_id, retval=True, exc=None)
+        self._assert_job_info_finished(control_iface.get_job_info(job_id), True)
+        assert control_iface._info_cache.get(job_id)[0].final
+        self._assert_job_info_finished(control_iface.get_job_info(job_id), True)
+
+        assert list(gc_iface.get_jobs(0)) == [(job_id, True)]  # Locks the job
+        gc_iface.remove_job_data(job_id)
+        deadline = time.time() + 5
+        while len(control_iface._info_cache) > 0 and time.time() < deadline:
+            time.sleep(0.1)  # Wait for the watch
+        assert control_iface.get_job_info(job_id) is None
+
+    def test_job_info_cache_bounds(self):
+        client = zoo.Client(nodes=["localhost:2181"], timeout=1, start_timeout=1, start_retries=1,
+                            randomize_hosts=False, chroot=None)
+        cache = ifaces._JobInfoCache(client, 3, 1000)
+        for number in range(5):
+            cache.put(str(number), {"foo": number}, True, cache.get(str(number))[1])
+        assert len(cache) == 3
+        assert cache.get("0")[0] is None
+        assert cache.get("2")[0].job_info == {"foo": 2}  # Becomes the most recent one
+        cache.put("5", {"foo": 5}, True, cache.get("5")[1])
+        assert cache.get("3")[0] is None
+        assert cache.get("2")[0] is not None
+
+        cache.put("large-1", {"foo": "x" * 600}, False, cache.get("large-1")[1])
+        cache.put("large-2", {"foo": "x" * 600}, False, cache.get("large-2")[1])
+        assert cache.get("large-1")[0] is None  # Evicted by the bytes limit
+        assert cache.get("large-2")[0] is not None
+        assert len(cache) == 1
+        cache.put("too-large", {"foo": "x" * 1000}, False, cache.get("too-large")[1])
+        assert cache.get("too-large")[0] is None
+
+        generation = cache.get("6")[1]
+        cache.evict("6")
+        cache.put("6", {"foo": 6}, False, generation)
+        assert cache.get("6")[0] is None  # Evicted during the reading
+        cache.put("6", {"foo": 6}, False, cache.get("6")[1])
+        assert cache.get("6")[0] is not None  # Read after the eviction
+
+        generation = cache.get("7")[1]
+        cache.evict("2")
+        cache.put("7", {"foo": 7}, False, generation)
+        assert cache.get("7")[0] is not None  # The eviction of the other job
+
+        generation = cache.get("8")[1]
+        for number in range(4):
+            cache.evict("other-{}".format(number))  # The eviction of "6" is forgotten
+        cache.put("8", {"foo": 8}, False, generation)
+        assert cache.get("8")[0] is None  # So the older reads are dropped
+
+        generation = cache.get("9")[1]
+        cache.evict()
+        cache.put("9", {"foo": 9}, False, generation)
+        assert cache.get("9")[0] is None  # The whole cache was dropped
+
+    def test_gc_wait_deleted(self, zclient):
+        ifaces.init(zclient)
+        control_iface = ifaces.JobsControl(zclient)
+        process_iface = ifaces.JobsProcess(zclient)
+        gc_iface = ifaces.JobsGc(zclient)
+
+        job_id = control_iface.add_jobs(self.func_head, [self.fresh_job])[0]
+        assert next(process_iface.get_ready_jobs()).job_id == job_id  # Locked by the worker
+        assert list(gc_iface.get_jobs(60)) == []
+        assert not gc_iface.wait_deleted(0.1)
+
+        with pytest.raises(backends.DeleteTimeoutError):
+            control_iface.delete_job(job_id, timeout=0.1)
+        assert gc_iface.wait_deleted(5)
+        assert list(gc_iface.get_jobs(60)) == []  # Still locked, the lock is watched now
+        assert not gc_iface.wait_deleted(0.1)
+
+        process_iface.release_job(job_id)
+        assert gc_iface.wait_deleted(5)
+        assert list(gc_iface.get_jobs(60)) == [(job_id, True)]
+
+    def test_gc_indexes(self, zclient):
+        ifaces.init(zclient)
+        control_iface = ifaces.JobsControl(zclient)
+        process_iface = ifaces.JobsProcess(zclient)
+        gc_iface = ifaces.JobsGc(zclient)
+
+        job_ids = control_iface.add_jobs(self.func_head, [self.fresh_job] * 5)
+        assert len(list(process_iface.get_ready_jobs())) == 5
+        assert sorted(zclient.get_children(ifaces._PATH_RUNNING)) == sorted(job_ids)
+        process_iface.done_job(job_ids[0], retval=True, exc=None)
+        process_iface.done_job(job_ids[1], retval=True, exc=None, lifetime=0)
+        process_iface.done_job(job_ids[2], retval=True, exc=None, lifetime=3600)
+        process_iface.release_job(job_ids[3])  # Lost job
+        with pytest.raises(backends.DeleteTimeoutError):
+            control_iface.delete_job(job_ids[4], timeout=0.1)  # There is no collector
+        process_iface.release_job(job_ids[4])  # The locked deleted job is skipped by the collector
+        assert sorted(zclient.get_children(ifaces._PATH_RUNNING)) == sorted(job_ids[3:])
+        assert zclient.get_children(ifaces._PATH_DELETED) == [job_ids[4]]
+
+        assert sorted(gc_iface.get_jobs(3600)) == sorted([
+            (job_ids[1], True),
+            (job_ids[3], False),
+            (job_ids[4], True),
+        ])
+        assert list(gc_iface.get_jobs(0, full=True)) == []  # The indexed jobs are skipped by the full scan
+        gc_iface.push_back_job(job_ids[3])
+        for job_id in (job_ids[1], job_ids[4]):
+            gc_iface.remove_job_data(job_id)
+        assert zclient.get_children(ifaces._PATH_RUNNING) == []
+        assert zclient.get_children(ifaces._PATH_DELETED) == []
+
+        assert list(gc_iface.get_jobs(0)) == [(job_ids[0], True)]
+        gc_iface.remove_job_data(job_ids[0])
+        assert control_iface.get_job_info(job_ids[2])["finished"] is not None
+        assert sorted(control_iface.get_jobs_list()) == sorted([job_ids[2], job_ids[3]])
+
+    def test_gc_skip_locked(self, zclient):
+        ifaces.init(zclient)
+        control_iface = ifaces.JobsControl(zclient)
+        process_iface = ifaces.JobsProcess(zclient)
+        gc_iface = ifaces.JobsGc(zclient)
+
+        job_ids = control_iface.add_jobs(self.func_head, [self.fresh_job] * 5)
+        assert len(list(process_iface.get_ready_jobs())) == 5
+        with pytest.raises(backends.DeleteTimeoutError):
+            control_iface.delete_job(job_ids[0], timeout=0.1)
+        zoo._stats.reset()
+        assert list(gc_iface.get_jobs(3600)) == []
+        stats = zoo._stats.get()
+        assert "get_jobs()" not in stats["labels"]  # No failed creations of the locks
+        assert "get" not in stats["ops"]  # The states of the locked jobs are not read
+        assert not gc_iface.wait_deleted(0)
+
+        process_iface.release_job(job_ids[0])  # Wakes up the collector by the watch of the lock
+        assert gc_iface.wait_deleted(5)
+        assert list(gc_iface.get_jobs(3600)) == [(job_ids[0], True)]
+
+    def test_remove_jobs_data(self, zclient, zbackend_kwargs):
+        ifaces.init(zclient)
+        with zoo.Client(max_request_size=2000, **zbackend_kwargs).connected() as client:
+            control_iface = ifaces.JobsControl(client)
+            process_iface = ifaces.JobsProcess(client)
+            gc_iface = ifaces.JobsGc(client)
+
+            job_ids = control_iface.add_jobs(self.func_head, [self.fresh_job] * 20)
+            for job in process_iface.get_ready_jobs():
+                if job.job_id != job_ids[-1]:
+                    process_iface.done_job(job.job_id, retval=True, exc=None)
+            process_iface.release_job(job_ids[-1])
+            with pytest.raises(backends.DeleteTimeoutError):
+                control_iface.delete_job(job_ids[-1], timeout=0.1)
+            zoo._stats.reset()
+            assert sorted(gc_iface.get_jobs(0)) == sorted((job_id, True) for job_id in job_ids)
+            gc_iface.remove_jobs_data(job_ids[:10] + ["foobar"] + job_ids[10:])  # Falls back for the missing job
+            assert control_iface.get_jobs_list() == []
+            assert zclient.get_children(ifaces._PATH_RUNNING) == []
+            assert zclient.get_children(ifaces._PATH_DELETED) == []
+            assert zoo._stats.get()["labels"]["remove_jobs_data()"]["count"] > 1  # Splitted
+
+    def test_gc_sharding(self, zclient, zbackend_kwargs):
+        ifaces.init(zclient)
+        control_iface = ifaces.JobsControl(zclient)
+        process_iface = ifaces.JobsProcess(zclient)
+        job_ids = control_iface.add_jobs(self.func_head, [self.fresh_job] * 20)
+        for job in process_iface.get_ready_jobs():
+            process_iface.done_job(job.job_id, retval=True, exc=None)
+
+        with zoo.Client(**zbackend_kwargs).connected() as client:
+            gc_ifaces = [ifaces.JobsGc(zclient, sharding=True), ifaces.JobsGc(client, sharding=True)]
+            assert list(gc_ifaces[0].get_jobs(3600)) == []  # Registers the first collector
+            assert list(gc_ifaces[1].get_jobs(3600)) == []
+            deadline = time.time() + 5
+            while len(gc_ifaces[0]._ring._points) < 2 * ifaces._RING_POINTS and time.time() < deadline:
+                list(gc_ifaces[0].get_jobs(3600))  # Wait for the watch
+                time.sleep(0.1)
+            assert len(zclient.get_children(ifaces._PATH_COLLECTORS)) == 2
+
+            found = [set(gc_iface.get_jobs(0)) for gc_iface in gc_ifaces]
+            assert len(found[0]) > 0
+            assert len(found[1]) > 0
+            assert found[0] | found[1] == {(job_id, True) for job_id in job_ids}
+            assert len(found[0] & found[1]) == 0
+        deadline = time.time() + 5
+        while len(zclient.get_children(ifaces._PATH_COLLECTORS)) > 1 and time.time() < deadline:
+            time.sleep(0.1)
+        assert len(zclient.get_children(ifaces._PATH_COLLECTORS)) == 1  # The ephemeral node of the closed client
+
+    def test_hash_ring(self):
+        job_ids = [backends.make_job_id() for _ in range(1000)]
+        ring = ifaces._HashRing(["a", "b", "c"])
+        owners = {job_id: ring.get_owner(job_id) for job_id in job_ids}
+        for member in ("a", "b", "c"):
+            assert 150 < list(owners.values()).count(member) < 550
+
+        new_ring = ifaces._HashRing(["a", "b", "c", "d"])
+        moved = [job_id for job_id in job_ids if new_ring.get_owner(job_id) != owners[job_id]]
+        assert all(new_ring.get_owner(job_id) == "d" for job_id in moved)  # Only to the new member
+        assert 100 < len(moved) < 450
+        assert ifaces._HashRing([]).get_owner(job_ids[0]) is None
+
     def test_get_job_info_none(self, zclient):
         control_iface = ifaces.JobsControl(zclient)
         assert control_iface.get_job_info("foobar") is None
@@ -213,6 +675,21 @@ class TestRules:
             rules_iface.set_head("foobar{}".format(count))
             assert rules_iface.get_head() == "foobar{}".format(count)
 
+    def test_head_cache(self, zclient, zbackend_kwargs):
+        ifaces.init(zclient)
+        rules_iface = ifaces.Rules(zclient, cache=True)
+        assert rules_iface.get_head() is None
+        rules_iface.set_head("foobar")
+        assert rules_iface.get_head() == "foobar"
+        assert len(rules_iface._cache) == 1
+
+        with zoo.Client(**zbackend_kwargs).connected() as client:
+            ifaces.Rules(client).set_head("barfoo")  # From the other process
+        deadline = time.time() + 5
+        while len(rules_iface._cache) > 0 and time.time() < deadline:
+            time.sleep(0.1)  # Wait for the watch
+        assert rules_iface.get_head() == "barfoo"
+
 
 class TestAppsState:
     def test_state_cycle(self, zclient):
@@ -302,3 +779,69 @@ class TestCasStorage:
         result = cas_storage.get_value("/foo/bar")
         assert result.value == 2
         assert result.version == 1
+
+    def test_concurrent_replace(self, zclient, zbackend_kwargs):
+        ifaces.init(zclient)
+
+        def increment():
+            with zoo.Client(**zbackend_kwargs).connected() as client:
+                cas_storage = ifaces.CasStorage(client)
+                for _ in range(10):
+                    while True:
+                        old = cas_storage.get_value("/foo/counter", default=0)
+                        version = (old.version or 0) + 1
+                        if cas_storage.replace_value("/foo/counter", value=old.value + 1, version=version,
+                                                     default=0, fatal_write=False)[1]:
+                            break
+
+        threads = [threading.Thread(target=increment) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert ifaces.CasStorage(zclient).get_value("/foo/counter").value == 30
+
+    def test_cache(self, zclient):
+        ifaces.init(zclient)
+        cas_storage = ifaces.CasStorage(zclient)
+        cached_storage = ifaces.CasStorage(zclient, cache=True)
+
+        assert cached_storage.get_value("/foo/bar", default=None).value is None
+        assert cas_storage.set_value("/foo/bar", value=1, version=0) is True
+        time.sleep(1)
+        assert cached_storage.get_value("/foo/bar").value == 1
+
+        assert cached_storage.set_value("/foo/bar", value=2, version=1) is True
+        assert cached_storage.get_value("/foo/bar").value == 2
+        assert cas_storage.set_value("/foo/bar", value=3, version=2) is True
+        time.sleep(1)
+        assert cached_storage.get_value("/foo/bar").value == 3
+
+    def test_many(self, zclient):
+        ifaces.init(zclient)
+        cas_storage = ifaces.CasStorage(zclient)
+
+        with pytest.raises(backends.CasNoValueError):
+            cas_storage.get_many(["/foo/bar", "/foo/baz"])
+        assert [data.value for data in cas_storage.get_many(["/foo/bar", "/foo/baz"], default=0)] == [0, 0]
+
+        assert cas_storage.set_many({
+            "/foo/bar": (1, 0),
+            "/foo/baz": (2, 0),
+            "/qux/bar": (3, None),
+        }) == {"/foo/bar": True, "/foo/baz": True, "/qux/bar": True}
+        assert [
+            (data.value, data.version)
+            for data in cas_storage.get_many(["/foo/bar", "/foo/baz", "/qux/bar"])
+        ] == [(1, 0), (2, 0), (3, None)]
+
+        assert cas_storage.set_many({"/foo/bar": (4, 1), "/foo/baz": (5, 0)}) == {"/foo/bar": True, "/foo/baz": False}
+        with pytest.raises(backends.CasVersionError):
+            cas_storage.replace_many({"/foo/bar": (6, 2), "/foo/baz": (7, 0)})
+        assert cas_storage.get_value("/foo/bar").value == 4
+
+        results = cas_storage.replace_many({"/foo/bar": (6, 2), "/foo/baz": (7, 1)})
+        assert [(old.value, write_ok) for (old, write_ok) in (results["/foo/bar"], results["/foo/baz"])] == [
+            (4, True),
+            (2, True),
+        ]
@@ -13,8 +13,10 @@ import pytest
 from powny.backends.zookeeper import zoo
 
 from .fixtures.zookeeper import zclient  # pylint: disable=unused-import
+from .fixtures.zookeeper import zclient_kwargs  # pylint: disable=unused-import
 from .fixtures.zookeeper import zbackend_kwargs  # pylint: disable=unused-import
 zclient  # flake8 suppression pylint: disable=pointless-statement
+zclient_kwargs  # flake8 suppression pylint: disable=pointless-statement
 zbackend_kwargs  # flake8 suppression pylint: disable=pointless-statement
 
 
@@ -24,6 +26,11 @@ def test_empty_value():
         zoo.EmptyValue()
 
 
+def test_missing_value():
+    with pytest.raises(RuntimeError):
+        zoo.MissingValue()
+
+
 class TestEncodeValue:
     def test_encode_value(self):
         obj = ("foobar",)
@@ -38,6 +45,24 @@ class TestEncodeValue:
         encoded = zoo._encode_value(zoo.EmptyValue)
         assert encoded == b""
 
+    def test_encode_value_protocol(self):
+        obj = ("foobar",)
+        encoded = zoo._encode_value(obj, protocol=2)
+        assert encoded == pickle.dumps(obj, protocol=2)
+
+    def test_encode_value_compressed(self):
+        for (compression, header) in (("zlib", 0xF1), ("lzma", 0xF2)):
+            obj = "x" * 10000
+            encoded = zoo._encode_value(obj, compression=compression, compress_threshold=1024)
+            assert encoded[0] == header
+            assert len(encoded) < len(pickle.dumps(obj))
+            assert zoo._decode_value(encoded) == obj
+
+    def test_encode_value_below_threshold(self):
+        obj = "x" * 100
+        encoded = zoo._encode_value(obj, compression="zlib", compress_threshold=1024)
+        assert encoded == pickle.dumps(obj)
+
 
 class TestDecodeValue():
     def test_decode_value(self):
@@ -55,6 +80,14 @@ class TestDecodeValue():
         with pytest.raises(AssertionError):
             zoo._decode_value("foobar")
 
+    def test_decode_value_old_protocols(self):
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            assert zoo._decode_value(pickle.dumps({"foo": "bar"}, protocol=protocol)) == {"foo": "bar"}
+
+    def test_decode_value_unknown_codec(self):
+        with pytest.raises(AssertionError):
+            zoo._decode_value(b"\xff" + pickle.dumps(None))
+
 
 class TestCatchZk:
     def test_catch_zk_no_node_error(self):
@@ -63,6 +96,9 @@ class TestCatchZk:
     def test_catch_zk_node_exists_error(self):
         self._test_catch_zk_exc(kazoo.exceptions.NodeExistsError, zoo.NodeExistsError)
 
+    def test_catch_zk_not_empty_error(self):
+        self._test_catch_zk_exc(kazoo.exceptions.NotEmptyError, zoo.NotEmptyError)
+
     def test_catch_zk_runtime_error(self):
         self._test_catch_zk_exc(RuntimeError, RuntimeError)
 
@@ -82,6 +118,83 @@ class TestCatchZk:
             method()
 
 
+class TestWriteRequestChunks:
+    def _make_request(self, max_size):
+        client = zoo.Client(nodes=["localhost:2181"], timeout=1, start_timeout=1, start_retries=1,
+                            randomize_hosts=False, chroot=None)
+        return zoo._WriteRequest(client, "test", max_size)
+
+    def test_size(self):
+        request = self._make_request(None)
+        assert request.get_size() == 0
+        request.create("/foo", b"x" * 100)
+        size = request.get_size()
+        assert size > 100
+        request.delete("/foo")
+        assert request.get_size() > size
+
+    def test_chunks_by_groups(self):
+        request = self._make_request(1000)
+        for number in range(10):
+            request.create("/node-{}".format(number), b"x" * 300)
+            request.create("/node-{}/child".format(number), b"x" * 100)
+            request.mark_boundary(number)
+        chunks = request._make_chunks()
+        assert len(chunks) > 1
+        assert [tag for (tags, _) in chunks for tag in tags] == list(range(10))
+        for (tags, ops) in chunks:
+            assert len(ops) == len(tags) * 2  # The groups are never split
+
+    def test_chunks_large_group(self):
+        request = self._make_request(100)
+        request.create("/small", b"")
+        request.mark_boundary("small")
+        request.create("/large", b"x" * 1000)
+        request.mark_boundary("large")
+        request.create("/tail", b"")
+        request.mark_boundary()
+        chunks = request._make_chunks()
+        assert [tags for (tags, _) in chunks] == [["small"], ["large"], []]
+
+    def test_empty_boundary(self):
+        request = self._make_request(100)
+        request.mark_boundary("foo")
+        request.create("/node", b"")
+        request.mark_boundary("bar")
+        request.mark_boundary("baz")
+        assert [tags for (tags, _) in request._make_chunks()] == [["bar"]]
+
+
+class TestStats:
+    def test_record(self):
+        stats = zoo._Stats()
+        measurement = zoo._Measurement()
+        measurement.written = 10
+        stats.record("create", "foo()", 0.0015, measurement)
+        measurement = zoo._Measurement()
+        measurement.read = 5
+        measurement.error = True
+        stats.record("get", None, 100, measurement)
+        result = stats.get()
+        assert set(result["ops"]) == {"create", "get"}
+        assert set(result["labels"]) == {"foo()"}
+        item = result["ops"]["create"]
+        assert (item["count"], item["errors"], item["read"], item["written"]) == (1, 0, 0, 10)
+        assert item["latency"]["0.002"] == 1
+        assert sum(item["latency"].values()) == 1
+        item = result["ops"]["get"]
+        assert (item["count"], item["errors"], item["read"], item["written"]) == (1, 1, 5, 0)
+        assert item["latency"]["inf"] == 1
+        measurement = zoo._Measurement()
+        measurement.count = 3
+        stats.record("exists", None, 0.0015, measurement)
+        item = stats.get()["ops"]["exists"]
+        assert item["count"] == 3
+        assert item["latency"]["0.002"] == 3
+        stats.reset()
+        assert stats.get() == {"ops": {}, "labels": {}}
+
+
 class TestClient:
     def test_connect(self, zclient):
         pass
@@ -105,6 +218,34 @@ class TestClient:
 
     # ===
 
+    def test_stats(self, zclient):
+        zoo._stats.reset()
+        with zclient.make_write_request("test_stats()") as request:
+            request.create("/test-node", "x" * 100)
+        assert zclient.get("/test-node") == "x" * 100
+        with pytest.raises(zoo.NoNodeError):
+            zclient.get("/foobar")
+        stats = zclient.get_stats()
+        assert stats["ops"]["create"]["written"] > 100
+        assert stats["ops"]["get"]["count"] == 2
+        assert stats["ops"]["get"]["errors"] == 1
+        assert stats["ops"]["get"]["read"] > 100
+        assert stats["labels"]["test_stats()"]["count"] == 1
+
+    def test_stats_ops(self, zclient):
+        with zclient.make_write_request() as request:
+            request.create("/test-node", "x" * 100)
+            request.create("/test-node/child")
+        zoo._stats.reset()
+        assert zclient.exists_many(["/test-node", "/foobar", "/"]) == [True, False, True]
+        assert zclient.get_children_count("/test-node") == 1
+        assert zclient.get_children("/test-node") == ["child"]
+        stats = zclient.get_stats()
+        assert stats["ops"]["exists"]["count"] == 3  # Each entry of the batch
+        assert stats["ops"]["get"]["count"] == 1  # get_children_count()
+        assert stats["ops"]["get"]["read"] > 100
+        assert stats["ops"]["get_children"]["read"] == len("child")
+
     def test_write_exception(self, zclient):
         with pytest.raises(RuntimeError):
             with zclient.make_write_request():
@@ -127,6 +268,13 @@ class TestClient:
         assert zclient.get("/test-node-1") == 0
         assert zclient.get("/test-node-2") == 1
 
+    def test_create_compressed(self, zclient_kwargs, zclient):
+        with zoo.Client(chroot=None, compression="zlib", compress_threshold=0, **zclient_kwargs).connected() as client:
+            with client.make_write_request() as request:
+                request.create("/powny-tests/test-node", "x" * 10000)
+            assert zclient.zk.get("/test-node")[0][0] == 0xF1
+        assert zclient.get("/test-node") == "x" * 10000
+
     def test_create_empty(self, zclient):
         with zclient.make_write_request() as request:
             request.create("/test-node")
@@ -212,6 +360,44 @@ class TestClient:
 
     # ===
 
+    def test_splittable(self, zclient_kwargs, zclient):
+        with zoo.Client(chroot="/powny-tests", max_request_size=1000, **zclient_kwargs).connected() as client:
+            with client.make_write_request(splittable=True) as request:
+                for number in range(20):
+                    request.create("/test-node-{}".format(number), "x" * 200)
+                    request.mark_boundary(number)
+                assert request.get_size() > 1000
+        assert len(zclient.get_children("/")) == 20
+
+    def test_splittable_partial_error(self, zclient_kwargs, zclient):
+        with zclient.make_write_request() as request:
+            request.create("/test-node-15")
+        with zoo.Client(chroot="/powny-tests", max_request_size=1000, **zclient_kwargs).connected() as client:
+            with pytest.raises(zoo.PartialWriteError) as exc_info:
+                with client.make_write_request(splittable=True) as request:
+                    for number in range(20):
+                        request.create("/test-node-{}".format(number), "x" * 200)
+                        request.mark_boundary(number)
+        committed = exc_info.value.committed
+        assert 0 < len(committed) <= 15  # The chunk with the existing node is not committed
+        assert committed == list(range(len(committed)))
+        assert isinstance(exc_info.value.__cause__, zoo.NodeExistsError)
+        for number in range(20):
+            assert zclient.exists("/test-node-{}".format(number)) == (number in committed or number == 15)
+
+    def test_splittable_first_chunk_error(self, zclient_kwargs, zclient):
+        with zclient.make_write_request() as request:
+            request.create("/test-node-0")
+        with zoo.Client(chroot="/powny-tests", max_request_size=1000, **zclient_kwargs).connected() as client:
+            with pytest.raises(zoo.NodeExistsError):
+                with client.make_write_request(splittable=True) as request:
+                    for number in range(20):
+                        request.create("/test-node-{}".format(number), "x" * 200)
+                        request.mark_boundary(number)
+        assert zclient.get_children("/") == ["test-node-0"]
+
+    # ===
+
     def test_get_children(self, zclient):
         with zclient.make_write_request() as request:
             nodes = sorted(["node-{}".format(count) for count in range(5)])
@@ -224,6 +410,57 @@ class TestClient:
         with pytest.raises(zoo.NoNodeError):
             zclient.get_children("/test-node")
 
+    def test_get_children_counts(self, zclient):
+        with zclient.make_write_request() as request:
+            request.create("/test-node-1")
+            request.create("/test-node-2")
+            request.create("/test-node-2/child")
+        assert zclient.get_children_counts(["/test-node-1", "/test-node-2"]) == [0, 1]
+        with pytest.raises(zoo.NoNodeError):
+            zclient.get_children_counts(["/test-node-1", "/test-node-3"])
+
+    # ===
+
+    def test_get_many(self, zclient):
+        with zclient.make_write_request() as request:
+            request.create("/test-node-1", 1)
+            request.create("/test-node-2")
+        assert zclient.get_many(["/test-node-1", "/test-node-2", "/test-node-3"]) == [
+            1,
+            zoo.EmptyValue,
+            zoo.MissingValue,
+        ]
+        assert zclient.get_many([]) == []
+
+    def test_get_versioned(self, zclient):
+        assert zclient.get_versioned("/test-node") == (zoo.MissingValue, None)
+        with zclient.make_write_request() as request:
+            request.create("/test-node", 1)
+        assert zclient.get_versioned("/test-node") == (1, 0)
+        with zclient.make_write_request() as request:
+            request.set("/test-node", 2, version=0)
+        assert zclient.get_versioned("/test-node") == (2, 1)
+        with pytest.raises(zoo.BadVersionError):
+            with zclient.make_write_request() as request:
+                request.set("/test-node", 3, version=0)
+        assert zclient.get("/test-node") == 2
+
+    def test_get_cache(self, zclient, zbackend_kwargs):
+        cache = zclient.get_cache()
+        assert cache.get_versioned("/test-node") == (zoo.MissingValue, None)
+        with zoo.Client(**zbackend_kwargs).connected() as client:
+            with client.make_write_request() as request:
+                request.create("/test-node", 1)
+            time.sleep(1)
+            assert len(cache) == 0
+            assert cache.get_versioned("/test-node") == (1, 0)
+            assert cache.get_versioned("/test-node") == (1, 0)
+            assert len(cache) == 1
+            with client.make_write_request() as request:
+                request.set("/test-node", 2)
+            time.sleep(1)
+            assert cache.get_versioned("/test-node") == (2, 1)
+
     # ===
 
     def test_exists_true(self, zclient):
@@ -307,6 +544,105 @@ class TestQueue:
         with pytest.raises(StopIteration):
             next(iterator)
 
+    def test_take_consume_release(self, zclient):
+        with zclient.make_write_request() as request:
+            request.create("/queue")
+        queue = zclient.get_queue("/queue")
+        with zclient.make_write_request() as request:
+            for count in range(5):
+                queue.put(request, count)
+
+        taken = queue.take(3)
+        assert len(taken) == 3
+        with zclient.make_write_request() as request:
+            for (name, _) in taken[:2]:
+                queue.consume(request, name)
+        queue.release(taken[2][0])
+
+        other = zclient.get_queue("/queue")
+        rest = other.take(10)
+        assert len(rest) == 3
+        assert sorted(value for (_, value) in taken[:2] + rest) == list(range(5))
+        assert other.take(10) == []
+
+    def test_take_read_error(self, zclient, monkeypatch):
+        with zclient.make_write_request() as request:
+            request.create("/queue")
+        queue = zclient.get_queue("/queue")
+        with zclient.make_write_request() as request:
+            for count in range(3):
+                queue.put(request, count)
+
+        def get_async(path):
+            raise RuntimeError("Can't read {}".format(path))
+
+        with monkeypatch.context() as patch:
+            patch.setattr(zclient, "get_async", get_async)
+            with pytest.raises(RuntimeError):
+                queue.take(3)
+        assert len(zclient.get_queue("/queue").take(3)) == 3  # The locks are released
+
+    def test_wait(self, zclient):
+        with zclient.make_write_request() as request:
+            request.create("/queue")
+        queue = zclient.get_queue("/queue")
+        with pytest.raises(StopIteration):
+            next(iter(queue))
+
+        def put():
+            time.sleep(1)
+            with zclient.make_write_request() as request:
+                queue.put(request, 1)
+
+        putter = threading.Thread(target=put)
+        putter.daemon = True
+        putter.start()
+
+        before = time.time()
+        assert queue.wait(10)
+        assert time.time() - before < 10
+        assert next(iter(queue)) == 1
+        putter.join()
+
+    def test_wait_timeout(self, zclient):
+        with zclient.make_write_request() as request:
+            request.create("/queue")
+        queue = zclient.get_queue("/queue")
+        with pytest.raises(StopIteration):
+            next(iter(queue))
+        assert not queue.wait(1)
+        with pytest.raises(StopIteration):
+            next(iter(queue))
+
+    def test_skipped_lock_released(self, zclient, zbackend_kwargs):
+        with zclient.make_write_request() as request:
+            request.create("/queue")
+        changed = threading.Event()
+        queue = zclient.get_queue("/queue", changed.set)
+        with zclient.make_write_request() as request:
+            queue.put(request, 1)
+
+        with zoo.Client(**zbackend_kwargs).connected() as client:
+            other = client.get_queue("/queue")
+            taken = other.take(1)
+            assert len(taken) == 1
+            assert queue.take(1) == []  # Skipped by the lock of the other consumer
+            assert not queue.is_stale()
+            other.release(taken[0][0])  # The consumer has failed before consume()
+            assert changed.wait(5)
+            assert queue.is_stale()
+            assert [value for (_, value) in queue.take(1)] == [1]
+            other.close()
+
+    def test_close(self, zclient):
+        listeners = len(zclient.zk.state_listeners)
+        queues = [zclient.get_queue("/queue") for _ in range(10)]
+        assert len(zclient.zk.state_listeners) == listeners + 10
+        for queue in queues:
+            queue.close()
+        assert len(zclient.zk.state_listeners) == listeners
+        assert len(zclient._listeners) == 0
+
 
 class TestCounter:
     def test_get_no_node_error(self, zclient):
@@ -326,27 +662,60 @@ class TestCounter:
         counter = zclient.get_counter("/counter")
         assert counter.get() == 10
 
-    def test_increment(self, zclient, zbackend_kwargs):
-        self._test_increment(zclient, zbackend_kwargs, False)
-
-    def test_increment_with_lock(self, zclient, zbackend_kwargs):
-        self._test_increment(zclient, zbackend_kwargs, True)
-
-    def _test_increment(self, client, client_kwargs, with_lock):
-        with client.make_write_request() as request:
+    def test_increment(self, zclient):
+        with zclient.make_write_request() as request:
             request.create("/counter")
-        counter = client.get_counter("/counter")
+        counter = zclient.get_counter("/counter")
         for previous in range(5):
-            if with_lock:
-                thread = threading.Thread(target=self._lock_queue, args=(client_kwargs,))
-                thread.daemon = True
-                thread.start()
             assert counter.increment() == previous
-            if with_lock:
-                thread.join()
         assert counter.get() == 5
 
-    def _lock_queue(self, client_kwargs):
-        with zoo.Client(**client_kwargs).connected() as client:
-            with client.zk.Lock("/counter/__lock__"):
-                time.sleep(1)
+    def test_increment_conflict(self, zclient, zbackend_kwargs, monkeypatch):
+        with zclient.make_write_request() as request:
+            request.create("/counter")
+        counter = zclient.get_counter("/counter")
+        get_versioned = zclient.get_versioned
+        reads = []
+
+        def racing_get_versioned(path):
+            result = get_versioned(path)
+            if len(reads) == 0:
+                # Another client changes the counter between the read and the versioned write
+                with zoo.Client(**zbackend_kwargs).connected() as client:
+                    assert client.get_counter("/counter").increment() == 0
+            reads.append(result)
+            return result
+
+        monkeypatch.setattr(zclient, "get_versioned", racing_get_versioned)
+        assert counter.increment() == 1
+        assert len(reads) == 2  # Retried after the version conflict
+        assert counter.get() == 2
+
+    def test_increment_concurrent(self, zclient, zbackend_kwargs):
+        with zclient.make_write_request() as request:
+            request.create("/counter")
+        results = []
+
+        def increment():
+            with zoo.Client(**zbackend_kwargs).connected() as client:
+                counter = client.get_counter("/counter")
+                results.extend(counter.increment() for _ in range(20))
+
+        threads = [threading.Thread(target=increment) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sorted(results) == list(range(80))
+        assert zclient.get_counter("/counter").get() == 80
+
+    def test_increment_reserve(self, zclient):
+        with zclient.make_write_request() as request:
+            request.create("/counter")
+        first = zclient.get_counter("/counter", reserve=10)
+        second = zclient.get_counter("/counter", reserve=10)
+        assert [first.increment() for _ in range(3)] == [0, 1, 2]
+        assert second.increment() == 10
+        assert first.get() == 20
+        assert [first.increment() for _ in range(8)] == [3, 4, 5, 6, 7, 8, 9, 20]
+        assert first.get() == 30
@@ -0,0 +1,140 @@
+# pylint: disable=redefined-outer-name,protected-access
+
+
+import time
+
+import pytest
+
+from powny.core import tools
+from powny.core.apps import worker
+from powny.backends.memory import Backend
+
+from .fixtures.memory import mbackend_kwargs  # pylint: disable=unused-import
+mbackend_kwargs  # flake8 suppression pylint: disable=pointless-statement
+
+
+# =====
+_RULES_DIR = "rules"
+_HEAD = "0123456789abcdef"
+
+
+def _wait_for(check, timeout=30):
+    deadline = time.time() + timeout
+    while not check():
+        assert time.time() < deadline, "Timed out"
+        time.sleep(0.1)
+
+
+def _run_jobs(manager, backend_kwargs, count):
+    # Returns the pids of the processes which have run the jobs
+    (exposed, _) = tools.make_loader(_RULES_DIR).get_exposed(_HEAD)
+    job = tools.make_job(_HEAD, "rules.test.empty_method", {}, exposed)
+    pids = {}
+    with Backend(**backend_kwargs).connected() as backend:
+        job_ids = backend.jobs_control.add_jobs(_HEAD, [job] * count)
+
+        def is_finished():
+            manager.manage(backend, (lambda: None))
+            for ready_job in backend.jobs_process.get_ready_jobs():
+                assert manager.run_job(ready_job, Backend(**backend_kwargs))
+                pids[ready_job.job_id] = manager._procs[ready_job.job_id][1].pid
+            return all(backend.jobs_control.get_job_info(job_id)["finished"] is not None for job_id in job_ids)
+
+        _wait_for(is_finished)
+        _wait_for(lambda: manager.manage(backend, (lambda: None)) or manager.get_current() == 0)
+        for job_id in job_ids:
+            assert backend.jobs_control.get_job_info(job_id)["exc"] is None
+    return [pids[job_id] for job_id in job_ids]
+
+
+@pytest.yield_fixture
+def make_manager():
+    managers = []
+
+    def make(**kwargs):
+        managers.append(worker._JobsManager(rules_dir=_RULES_DIR, **kwargs))
+        return managers[-1]
+
+    try:
+        yield make
+    finally:
+        for manager in managers:
+            manager.close()
+
+
+# =====
+class TestJobsManager:
+    def test_process(self, mbackend_kwargs, make_manager):
+        manager = make_manager()
+        assert len(set(_run_jobs(manager, mbackend_kwargs, 2))) == 2
+        assert manager.get_finished() == 2
+
+    def test_pool(self, mbackend_kwargs, make_manager):
+        pool = worker._Pool(size=1, make_backend=(lambda: Backend(**mbackend_kwargs)))
+        manager = make_manager(pool=pool)
+        pool.fill()
+        _wait_for(lambda: all(pool_proc.is_ready() for pool_proc in pool._idle))
+        pid = pool._idle[0].proc.pid
+
+        # The busy process is counted by the size, so it's reused for the next job
+        assert _run_jobs(manager, mbackend_kwargs, 1) == [pid]
+        assert len(pool._idle) == 1
+        _wait_for(lambda: pool._idle[0].is_ready())
+        assert _run_jobs(manager, mbackend_kwargs, 1) == [pid]
+        assert len(pool._idle) == 1
+
+    def test_pool_recycle(self, mbackend_kwargs, make_manager):
+        pool = worker._Pool(size=1, make_backend=(lambda: Backend(**mbackend_kwargs)), max_jobs=1)
+        manager = make_manager(pool=pool)
+        pool.fill()
+        _wait_for(lambda: all(pool_proc.is_ready() for pool_proc in pool._idle))
+        pid = pool._idle[0].proc.pid
+
+        assert _run_jobs(manager, mbackend_kwargs, 1) == [pid]
+        assert len(pool._idle) == 1
+        assert pool._idle[0].proc.pid != pid
+
+    def test_fork_server(self, mbackend_kwargs, make_manager):
+        manager = make_manager(fork_servers=1)
+        backend = Backend(**mbackend_kwargs)
+        assert manager._get_fork_server(_HEAD, backend) is None  # Starts the server
+        _wait_for(lambda: manager._get_fork_server(_HEAD, backend) is not None)
+        server_pid = manager._servers[_HEAD].proc.pid
+
+        pids = _run_jobs(manager, mbackend_kwargs, 2)
+        assert len(set(pids)) == 2
+        assert server_pid not in pids
+
+    def test_coop(self, mbackend_kwargs, make_manager):
+        manager = make_manager(coop_jobs=2)
+        pids = _run_jobs(manager, mbackend_kwargs, 2)
+        assert len(set(pids)) == 1
+        assert len(manager._coops) == 1
+
+    def test_closed_sentinel(self, mbackend_kwargs, make_manager):
+        pool = worker._Pool(size=1, make_backend=(lambda: Backend(**mbackend_kwargs)))
+        manager = make_manager(pool=pool)
+        pool.fill()
+        _wait_for(lambda: all(pool_proc.is_ready() for pool_proc in pool._idle))
+        pool_proc = pool.take()
+        manager._procs["foo"] = ("method", pool_proc.proc, pool_proc)
+        assert manager.get_waitables() == [pool_proc.sentinel]
+        pool_proc.stop()  # Closes the pipe
+        assert manager.get_waitables() == []
+        assert not manager.is_all_watched()
+        pool_proc.proc.join()
+
+    def test_deleted_after_finish(self, make_manager):
+        manager = make_manager()
+        wakeups = []
+        manager._on_deleted("foo", (lambda: wakeups.append(None)))  # The watch of the finished job
+        assert manager._deleted == set()
+        assert wakeups == []
+
+    def test_coop_kill(self, mbackend_kwargs):
+        coop = worker._CoopProcess(Backend(**mbackend_kwargs), _RULES_DIR, {}, 2)
+        coop_job = worker._CoopJob(coop, "foo")
+        coop_job.kill()  # Doesn't wait for the cancel
+        coop.proc.join(10)
+        assert coop.proc.exitcode == -9
+        assert not coop_job.is_alive()
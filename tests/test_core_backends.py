@@ -5,6 +5,8 @@ import pytest
 
 from powny.core import backends
 import powny.backends.zookeeper
+import powny.backends.memory
+import powny.backends.sqlite
 
 from .fixtures.zookeeper import zclient  # pylint: disable=unused-import
 from .fixtures.zookeeper import zbackend_kwargs  # pylint: disable=unused-import
@@ -17,6 +19,12 @@ class TestBackends:
     def test_get_backend_zookeeper(self):
         assert backends.get_backend_class("zookeeper") == powny.backends.zookeeper.Backend
 
+    def test_get_backend_memory(self):
+        assert backends.get_backend_class("memory") == powny.backends.memory.Backend
+
+    def test_get_backend_sqlite(self):
+        assert backends.get_backend_class("sqlite") == powny.backends.sqlite.Backend
+
     def test_get_backend_import_error(self):
         with pytest.raises(ImportError):
             backends.get_backend_class("foobar")
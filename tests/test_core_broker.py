@@ -0,0 +1,123 @@
+# pylint: disable=redefined-outer-name
+
+
+import threading
+
+import pytest
+
+from powny.core import broker
+from powny.core.backends import CasNoValueError
+
+
+# =====
+class _JobsProcess:
+    def __init__(self):
+        self.calls = []
+        self.released = threading.Event()
+
+    def associate_job(self, job_id):
+        self.calls.append(("associate_job", job_id))
+
+    def done_job(self, job_id, retval, exc, lifetime=None):
+        self.calls.append(("done_job", job_id, retval))
+
+    def release_job(self, job_id):
+        self.calls.append(("release_job", job_id))
+        self.released.set()
+
+
+class _CasStorage:
+    def __init__(self):
+        self.barrier = threading.Barrier(2, timeout=5)
+
+    def wait_other(self, value):
+        self.barrier.wait()  # Broken if the calls are served one by one
+        return value
+
+    def get_value(self, path):
+        raise CasNoValueError(path)
+
+    def get_lock(self, path):
+        return threading.Lock()  # Unpicklable
+
+
+class _Backend:
+    def __init__(self):
+        self.jobs_process = _JobsProcess()
+        self.cas_storage = _CasStorage()
+
+
+@pytest.fixture
+def backend():
+    return _Backend()
+
+
+@pytest.fixture
+def running_broker(backend):
+    obj = broker.Broker()
+    obj.start(backend)
+    try:
+        yield obj
+    finally:
+        obj.stop()
+
+
+# =====
+class TestBroker:
+    def test_calls(self, backend, running_broker):
+        client = running_broker.make_client()
+        with client.connected():
+            client.jobs_process.associate_job("foo")
+            client.jobs_process.done_job(job_id="foo", retval=1, exc=None)
+        assert backend.jobs_process.calls == [("associate_job", "foo"), ("done_job", "foo", 1)]
+
+    def test_exception(self, running_broker):
+        client = running_broker.make_client()
+        with pytest.raises(CasNoValueError):
+            client.cas_storage.get_value("/foo")
+
+    def test_private(self, running_broker):
+        client = running_broker.make_client()
+        with pytest.raises(AttributeError):
+            client.jobs_process._calls  # pylint: disable=protected-access,pointless-statement
+        with pytest.raises(AttributeError):
+            client.call("jobs_gc", "get_jobs", (), {})
+
+    def test_release_on_exit(self, backend, running_broker):
+        client = running_broker.make_client()
+        client.jobs_process.associate_job("foo")
+        client.jobs_process.associate_job("bar")
+        client.jobs_process.done_job("bar", None, None)
+        client.detach()  # Like the exit of the process
+        assert backend.jobs_process.released.wait(5)
+        assert backend.jobs_process.calls[-1] == ("release_job", "foo")
+        assert ("release_job", "bar") not in backend.jobs_process.calls
+        assert running_broker.get_clients_count() == 0
+
+    def test_unpicklable_result(self, running_broker):
+        client = running_broker.make_client()
+        with pytest.raises(RuntimeError):
+            client.cas_storage.get_lock("/foo")
+        with pytest.raises(CasNoValueError):
+            client.cas_storage.get_value("/foo")  # The broker is still serving
+
+    def test_concurrent_calls(self, running_broker):
+        results = []
+
+        def call(value):
+            results.append(running_broker.make_client().cas_storage.wait_other(value))
+
+        thread = threading.Thread(target=call, args=(1,))
+        thread.start()
+        call(2)
+        thread.join()
+        assert sorted(results) == [1, 2]
+
+    def test_concurrent_calls_of_client(self, running_broker):
+        client = running_broker.make_client()
+        results = []
+        thread = threading.Thread(target=(lambda: results.append(client.cas_storage.wait_other(1))))
+        thread.start()
+        results.append(client.cas_storage.wait_other(2))
+        thread.join()
+        assert sorted(results) == [1, 2]  # The responses are matched by the call ids
@@ -0,0 +1,77 @@
+import pickle
+
+import pytest
+
+from powny.core import checkpoints
+
+
+# =====
+def _make_data(count, extra=()):
+    items = [list(range(number, number + 20)) for number in range(count)]
+    items[count // 2:count // 2] = extra
+    return pickle.dumps(items)
+
+
+def test_delta():
+    old = _make_data(1000)
+    for new in (
+        old,
+        b"",
+        _make_data(1000, [[1, 2, 3]]),
+        _make_data(500),
+        _make_data(2000),
+        old[100:] + old[:100],
+    ):
+        delta = checkpoints.make_delta(old, new)
+        assert checkpoints.apply_delta(old, delta) == new
+    assert checkpoints.get_delta_size(checkpoints.make_delta(old, _make_data(1000, [[1, 2, 3]]))) < 200
+
+
+def test_delta_block_sizes():
+    old = _make_data(1000)
+    new = b"x" + old[200:] + old[:200]  # The shift which is not aligned to the blocks
+    for block_size in (8, 64, 1024):
+        delta = checkpoints.make_delta(old, new, block_size)
+        assert checkpoints.apply_delta(old, delta) == new
+        assert checkpoints.get_delta_size(delta) < block_size * 4 + 100
+
+
+def test_delta_empty():
+    assert checkpoints.apply_delta(b"", checkpoints.make_delta(b"", b"foo")) == b"foo"
+    assert checkpoints.make_delta(b"foo", b"foo") == ((0, 3),)
+
+
+def test_checkpointer():
+    checkpointer = checkpoints.Checkpointer(b"initial", max_deltas=3, compact_ratio=0.5)
+    assert checkpointer.get_data() == b"initial"
+    states = [
+        checkpointer.make_state(_make_data(1000, [[index]] * index))
+        for index in range(6)
+    ]
+    assert [len(state.deltas) for state in states] == [0, 1, 2, 3, 0, 1]
+    assert states[3].base is states[0].base
+    for (index, state) in enumerate(states):
+        assert checkpoints.restore_data(state) == _make_data(1000, [[index]] * index)
+
+    checkpointer = checkpoints.Checkpointer(states[-1], max_deltas=3, compact_ratio=0.5)
+    assert checkpointer.get_data() == _make_data(1000, [[5]] * 5)
+    assert len(checkpointer.make_state(_make_data(1000)).deltas) == 2
+
+
+def test_checkpointer_compact_ratio():
+    checkpointer = checkpoints.Checkpointer(b"initial", max_deltas=10, compact_ratio=0.5)
+    checkpointer.make_state(_make_data(100))
+    assert len(checkpointer.make_state(_make_data(100, [[1]])).deltas) == 1
+    assert len(checkpointer.make_state(_make_data(300)).deltas) == 0
+
+
+def test_restore_full():
+    assert checkpoints.restore_data(b"full") == b"full"
+
+
+def test_restore_invalid():
+    state = checkpoints.Checkpointer(b"", 3, 0.5).make_state(b"foo")
+    with pytest.raises(checkpoints.CheckpointError):
+        checkpoints.restore_data(state._replace(base=None))
+    with pytest.raises(checkpoints.CheckpointError):
+        checkpoints.restore_data(state._replace(base=b"bar"))
@@ -1,5 +1,10 @@
+import os
+
 from powny.core import context
-from powny.testing.context import run_in_context
+from powny.testing.context import (
+    run_in_context,
+    run_in_scheduler,
+)
 
 
 # =====
@@ -32,6 +37,19 @@ def test_restore():
     assert result.end.exc is None
 
 
+def test_restore_incremental():
+    result = run_in_context(_func_ok, {"limit": 5}, max_deltas=2)
+    assert len(result.steps) == 5
+    assert [len(step.state.deltas) for step in result.steps] == [0, 1, 2, 0, 1]
+    job_id = result.steps[2].job_id
+    state = result.steps[2].state
+
+    result = run_in_context(state, job_id=job_id, max_deltas=2)
+    assert len(result.steps) == 2
+    assert result.end.retval == "LIMIT: 5"
+    assert result.end.exc is None
+
+
 def test_get_job_id():
     def func_get_job_id():
         return context.get_job_id()
@@ -81,3 +99,38 @@ def test_failed_after_success():
 
     assert result.end.retval is None
     assert result.end.exc.startswith("Traceback (most recent call last):\n")
+
+
+def test_sleep():
+    def func_sleep():
+        context.sleep(0.1)
+        return "OK"
+
+    result = run_in_context(func_sleep)
+    assert len(result.steps) == 0
+    assert result.end.retval == "OK"
+
+
+def test_wait_read():
+    def func_wait_read():
+        (read_fd, write_fd) = os.pipe()
+        timed_out = context.wait_read(read_fd, 0.1)
+        os.write(write_fd, b"x")
+        return (timed_out, context.wait_read(read_fd, 1))
+
+    result = run_in_context(func_wait_read)
+    assert result.end.retval == (False, True)
+
+
+def test_scheduler():
+    def func_sleep(delay):
+        context.save_job_state()
+        context.sleep(delay)
+        return context.get_job_id()
+
+    (results, order) = run_in_scheduler([(func_sleep, {"delay": 0.5}), (func_sleep, {"delay": 0.1})])
+    for result in results:
+        assert len(result.steps) == 1
+        assert result.end.retval == result.job_id
+        assert result.end.exc is None
+    assert order == [results[1].job_id, results[0].job_id]